@@ -6,13 +6,15 @@ import csv
 import sys
 from pprint import pprint
 
+from common.linkcache import LinkCache, ticket_digests
+from common.prepaymentlink import PrepaymentLinker, STAGE_SIMILAR_TITLE
+
 if __name__ == '__main__':
     ### SET UP WORKING FOLDER AND MAIN VARIABLES
     home = os.path.expanduser("~")
     working_folder = os.path.join(home, 'OATs', 'ART-wd')
     zendesk_export = os.path.join(working_folder, 'zendesk-export-2017-04-19-1127-4115070e8d.csv')
     apollo_export = os.path.join(working_folder, 'LST_ApolloOAOutputs_v3_20170504.csv')
-    row2zd_number_file = 'ART-row_to_ZD_number.csv'
     output_fields = []
     zd_dict = {}
     titles_not_matching_ZD_in_previous_run = []
@@ -43,39 +45,43 @@ if __name__ == '__main__':
     ###POPULATE DICTIONARIES
     (zd_dict, title2zd_dict, doi2zd_dict, oa2zd_dict, apollo2zd_dict, zd2zd_dict) = art.action_index_zendesk_data_general(zendesk_export)
     doi2apollo = art.action_populate_doi2apollo(apollo_export)
-    row2zd_number = {}
-    if row2zd_number_file in os.listdir():
-        for row in open(row2zd_number_file):
-            a = row.split('\t')
-            row2zd_number[a[0]] = a[1]
+    # links found in previous runs, unless their tickets changed since
+    link_cache = LinkCache(ticket_digests(zd_dict))
 
     output_dict = {}
-    output_row2zd_number = open(row2zd_number_file, 'w')
     ###MATCH EACH ROW OF INPUT FILE TO A ZENDEK TICKET (ZD_DICT ENTRY) AND MERGE THE DATA IN A SINGLE DICT
     with open(input_csv_filename) as csvfile:
         reader = csv.DictReader(csvfile)
         row_counter = 0
+        records = {}
         for row in reader:
             output_dict[row_counter] = row
             doi = row[input_doi_field]
             title = row[input_title_field]
-            publisher = ''
-            if row_counter in row2zd_number.keys():
-                zd_number = row2zd_number[row_counter]
-            else:
-                if not title in titles_not_matching_ZD_in_previous_run:
-                    (zd_number, fail_reason) = art.match_prepayment_deal_to_zd(doi, title, publisher, doi2zd_dict, doi2apollo, apollo2zd_dict, title2zd_dict, institution='University of Cambridge', restrict_to_rcuk_policy=False)
-                else:
-                    print('ART0-I: Previous run did not return a ZD match; skipping')
-                    zd_number = ''
-            if zd_number:
-                print('art-i: detected zd_number:', zd_number)
-                output_row2zd_number.write(str(row_counter) + '\t' + zd_number + '\n')
-                output_dict[row_counter].update(zd_dict[zd_number])
-            else:
-                print('art-i: zd_number could not be found for row', row_counter)
+            if title not in titles_not_matching_ZD_in_previous_run:
+                records[row_counter] = (doi, title)
             row_counter += 1
-    output_row2zd_number.close()
+    # rows are matched all at once, using a pool of processes for matches by similarity of title
+    linker = PrepaymentLinker(zd_dict, doi2zd_dict, title2zd_dict, doi2apollo, apollo2zd_dict,
+                              art.manual_title2zd_dict, art.manual_doi2title, link_cache=link_cache, source='art-i')
+    links = linker.link(records)
+    link_cache.close()
+    for row_counter in output_dict.keys():
+        if row_counter in links.keys():
+            link = links[row_counter]
+            if link.stage == STAGE_SIMILAR_TITLE:
+                print('art-i: most similar title in ZD (please review):', link.similar_titles[0][1], link.zd_number)
+                zd_number = ''
+            else:
+                zd_number = link.zd_number
+        else:
+            print('ART0-I: Previous run did not return a ZD match; skipping')
+            zd_number = ''
+        if zd_number:
+            print('art-i: detected zd_number:', zd_number)
+            output_dict[row_counter].update(zd_dict[zd_number])
+        else:
+            print('art-i: zd_number could not be found for row', row_counter)
 
     ###CHOOSE ADDITIONAL OUTPUT FIELDNAMES
     funders_report_fieldnames = ['COAF policy [flag]', 'COAF payment [flag]', 'Arthritis Research UK [flag]',
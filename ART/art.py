@@ -20,14 +20,25 @@ import logging
 import logging.config
 import os
 import re
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 try:
     import dateutil.parser
+    from common.oatsutils import convert_date_str_to_yyyy_mm_dd
 except ModuleNotFoundError:
     print('WARNING: Could not load the dateutil module. Please install it if you have admin rights. Conversion of dates will not work properly during this run')
 
 from pprint import pprint
 from difflib import SequenceMatcher
 
+from common.csvprobe import extract_csv_header
+from common.doi import clean_doi, normalise_doi
+from common.europepmc import get_europepmc_index
+from common.linkcache import LinkCache, ticket_digests
+from common.oatslogging import get_plain_log
+from common.prepaymentlink import PrepaymentLinker, STAGE_SIMILAR_TITLE
+from common.titlematch import TitleIndex
+
 # create logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -49,8 +60,6 @@ home = os.path.expanduser("~")
 #working_folder = os.path.join(home, 'Dropbox', 'Midas-wd')
 working_folder = os.path.join(home, 'OATs', 'Midas-wd')
 
-DOI_CLEANUP = ['http://dx.doi.org/', 'https://doi.org/', 'http://dev.biologists.org/lookup/doi/', 'http://www.hindawi.com/journals/jdr/aip/2848759/']
-DOI_FIX = {'0.1136/jmedgenet-2016-104295':'10.1136/jmedgenet-2016-104295'}
 
 ### OUTPUT FILES USING THE PREFIXES BELOW LIST RECORDS FROM PREPAYMENT DEALS (SPRINGER COMPACT, WILEY, OUP)
 ### EACH PREPAYMENT DEAL HAS A LIST OF TITLES TO BE EXCLUDED; THE SPRINGER ONE IS exclude_titles_springer
@@ -288,6 +297,21 @@ def similar(a, b):
     '''
     return(SequenceMatcher(None, a, b).ratio())
 
+title_indexes = {}
+
+def get_title_index(title_dict):
+    '''
+    Returns a TitleIndex of the keys of title_dict, building it on first use. The index is rebuilt if
+    title_dict has changed size since it was built
+    :param title_dict: a dictionary of zendesk tickets, indexed by title
+    :return: TitleIndex
+    '''
+    index = title_indexes.get(id(title_dict))
+    if (index is None) or (len(index) != len(title_dict)):
+        index = TitleIndex(title_dict.keys())
+        title_indexes[id(title_dict)] = index
+    return index
+
 def merge_csv_files(list_of_files, output_filename, repeated_header=1):
     '''
     This function merges CSV files
@@ -312,21 +336,6 @@ def merge_csv_files(list_of_files, output_filename, repeated_header=1):
         f.close() # not really needed
     fout.close()
 
-def extract_csv_header(inputfile, enc = 'utf-8', delim = ','):
-    '''
-    This function returns a list of the fields contained in the header (first row) of
-    a CSV file
-    :param inputfile: path of CSV file
-    :param enc: encoding of CSV file
-    '''
-    outputlist = []
-    with open(inputfile, encoding = enc) as csvfile:
-        headerreader = csv.reader(csvfile, delimiter=delim)
-        #~ print(type(headerreader))
-        for row in headerreader:
-            outputlist.append(row)
-    return(outputlist[0])
-
 def output_debug_info(outcsv, row_dict, csvheader = []):
     '''
     This function appends a row to an output CSV file
@@ -572,7 +581,7 @@ def plug_in_metadata(metadata_file, matching_field, translation_dict, warning_me
         for row in reader:
             mf = row[matching_field]
             if matching_field in ['doi', 'DOI']:
-                mf = prune_and_cleanup_string(mf, DOI_CLEANUP)
+                mf = normalise_doi(mf)
             try:
                 zd_number = translation_dict[mf]
             except KeyError:
@@ -591,6 +600,35 @@ def plug_in_metadata(metadata_file, matching_field, translation_dict, warning_me
                         zd_dict[zd].update(row)
             row_counter += 1
 
+def plug_in_europepmc_index(europepmc_map, translation_dict):
+    '''
+    This function appends data from the Europe PMC map to the dictionary produced from the zendesk export
+    (zd_dict), like plug_in_metadata(europepmc_map, 'DOI', translation_dict), but looks up each DOI in an index of
+    the map (see common.europepmc) instead of reading the whole map. The index is built the first time a
+    version of the map is used
+    :param europepmc_map: path of the Europe PMC PMID_PMCID_DOI map
+    :param translation_dict: dictionary to be used to match DOIs to a zendesk number
+    '''
+    with get_europepmc_index(europepmc_map) as index:
+        matches = []
+        for doi, zd_number in translation_dict.items():
+            if (not zd_number) or (normalise_doi(doi) != doi):
+                # rows of the map are matched by their cleaned up DOI, so they can never match this key
+                continue
+            matches.extend((position, zd_number, row) for position, row in index.lookup_with_positions(doi))
+    # rows are merged in the order of the map, like plug_in_metadata, so the same row wins when several rows
+    # update a ticket
+    matches.sort(key=lambda m: m[0])
+    for position, zd_number, row in matches:
+        if type(zd_number) == type('string'):
+            for field in row.keys():
+                if (field in zd_dict[zd_number].keys()) and (position == 0):
+                    print('WARNING: Dictionary for ZD ticket', zd_number, 'already contains a field named', field + '. It will be overwritten by the value in file', europepmc_map)
+            zd_dict[zd_number].update(row)
+        elif type(zd_number) == type(['list']):
+            for zd in zd_number:
+                zd_dict[zd].update(row)
+
 def process_repeated_fields(zd_list, report_field_list, ticket):
     '''
     This function populates fields in the output report that do NOT have a 1 to 1
@@ -625,49 +663,8 @@ def plog(*args, logfilename=logfile, terminal=True):
     :param args: the argumes to output
     :param terminal: if set to false, suppresses terminal output
     '''
-    with open(logfilename, 'a') as f:
-        if terminal == True:
-            print(' '.join(map(str, args)))
-        for a in args:
-            try:
-                f.write(str(a))
-                f.write(' ')
-            except UnicodeEncodeError:
-                f.write('UnicodeEncodeError')
-                f.write(' ')
-        f.write('\n')
-
-def prune_and_cleanup_string(string, pruning_list, typo_dict={}):
-    '''
-    A function to prune substrings from a string and/or correct typos (replace original string
-    by corrected string)
-    :param string: original string
-    :param pruning_list: list of substrings to be replaced by an empty string
-    :param typo_dict: a dictionary mapping strings to corrected strings
-    :return: corrected string
-    '''
-    for a in pruning_list:
-        string = string.replace(a, '')
-    if typo_dict.keys() and (string in typo_dict.keys()):
-        string = typo_dict[string]
-    return(string.strip())
-
-def convert_date_str_to_yyyy_mm_dd(string, dateutil_options=None):
-    '''
-    Function to convert dates to format YYYY-MM-DD
-    :param string: original date string
-    :param dateutil_options: options to be passed to dateutil
-    :return: converted date or empty string if failed to convert
-    '''
-    try:
-        d = dateutil.parser.parse(string, dateutil_options)
-    except ValueError:
-        d = datetime.datetime(1, 1, 1)
-    d = d.strftime('%Y-%m-%d')
-    if d == '1-01-01':
-        return('')
-    else:
-        return(d)
+    # the log file is kept open for the whole run
+    get_plain_log(logfilename).plog(*args, terminal=terminal)
 
 def debug_export_excluded_records(excluded_debug_file, excluded_recs_logfile, excluded_recs):
     with open(excluded_debug_file, 'w') as csvfile:
@@ -688,13 +685,15 @@ def debug_export_excluded_records_prepayment(excluded_debug_file, excluded_recs,
         for ticket in excluded_recs:
             writer.writerow(excluded_recs[ticket])
             
-def heuristic_match_by_title(title, publisher, title2zd_dict, policy_dict={}):
+def heuristic_match_by_title(title, publisher, title2zd_dict, policy_dict={}, similar_titles=None):
     '''
     A function to match publications to zendesk data based on similarity of title
     :param title: the title we are trying to match (e.g. title of article in prepayment deal csv)
     :param publisher: the name of the publisher
     :param title2zd_dict: a dictionary of zendesk tickets, indexed by title
     :param policy_dict: a dictionary of zendesk tickets covered by a funder's policy, indexed by title
+    :param similar_titles: matches of title in title2zd_dict, if already found (e.g. by PrepaymentLinker);
+                            if None, they are looked up in get_title_index(title2zd_dict)
     :return:
     '''
     plog('INFO: Attempting heuristic_match_by_title for', title)
@@ -702,14 +701,9 @@ def heuristic_match_by_title(title, publisher, title2zd_dict, policy_dict={}):
     possible_matches = []
     out_of_policy = []
     if policy_dict:
-        plog('DEBUG: policy_dict:', policy_dict)
-        for t in policy_dict.keys():
-            #print('t:', t)
-            similarity = similar(title.upper(), t)
-            if similarity > 0.8:
-                possible_matches.append((similarity, t))
+        plog('DEBUG: policy_dict contains', len(policy_dict), 'titles')
+        possible_matches += get_title_index(policy_dict).matches(title.upper())
         if len(possible_matches) > 0:
-            possible_matches.sort(reverse=True)
             most_similar_title = possible_matches[0][1]
             zd_number = policy_dict[most_similar_title]
     #       print('\nWARNING: publisher record matched to ZD via similarity in title. Please review the matches carefully in the log file.\n')
@@ -718,13 +712,10 @@ def heuristic_match_by_title(title, publisher, title2zd_dict, policy_dict={}):
             plog('ZD        title: ' + most_similar_title.lower() + '\n')
             plog("Entry for manual_title2zd_dict: '" + title + "' : '" + zd_number + "',\n\n\n")
         else:
-            for t in title2zd_dict.keys():
-                #print('t:', t)
-                similarity = similar(title.upper(), t)
-                if similarity > 0.8:
-                    possible_matches.append((similarity, t))
+            if similar_titles is None:
+                similar_titles = get_title_index(title2zd_dict).matches(title.upper())
+            possible_matches += similar_titles
             if len(possible_matches) > 0:
-                possible_matches.sort(reverse=True)
                 most_similar_title = possible_matches[0][1]
                 zd_number = title2zd_dict[most_similar_title]
                 out_of_policy.append((title, zd_number))
@@ -742,13 +733,10 @@ def heuristic_match_by_title(title, publisher, title2zd_dict, policy_dict={}):
                 f.write("'''" + i[0].strip() + "''', ")
     else:
         plog('DEBUG: policy_dict is empty')
-        for t in title2zd_dict.keys():
-            # print('t:', t)
-            similarity = similar(title.upper(), t)
-            if similarity > 0.8:
-                possible_matches.append((similarity, t))
+        if similar_titles is None:
+            similar_titles = get_title_index(title2zd_dict).matches(title.upper())
+        possible_matches += similar_titles
         if len(possible_matches) > 0:
-            possible_matches.sort(reverse=True)
             most_similar_title = possible_matches[0][1]
             zd_number = title2zd_dict[most_similar_title]
             plog('Matched zd_no (match attempted using title2zd_dict): ', zd_number)
@@ -854,6 +842,7 @@ def match_prepayment_deal_to_zd(doi, title, publisher, doi2zd_dict, doi2apollo,
         :param doi: DOI to lookup
         :return: zd_number or None
         '''
+        doi = normalise_doi(doi)
         try:
             zd_list = doi2zd_dict[doi]
         except KeyError:
@@ -949,7 +938,7 @@ def import_prepayment_data_and_link_to_zd(inputfile, output_dict, rejection_dict
     '''
     This function reads an input CSV file containing one publication per row. For each row,
     it attempts to match the publication to zendesk data based on doi (preferred) or
-    similarity of publication title.
+    similarity of publication title. All rows are matched at once by PrepaymentLinker.
 
     This function also filters prepayment data so that only papers matching zd tickets with
     funder policy or payment flags set to 'yes' are included in output_dict (and ultimately in
@@ -976,121 +965,142 @@ def import_prepayment_data_and_link_to_zd(inputfile, output_dict, rejection_dict
     '''
 
     with open(inputfile) as csvfile:
-        publisher_id = 1
         reader = csv.DictReader(csvfile, delimiter=delim)
-        for row in reader:
+        filtered_rows = []
+        records = {}
+        for row_number, row in enumerate(reader):
             # calculate and add discount data to row
             if publisher == 'Wiley':
                 row['Prepayment discount'] = '£{}'.format(row['Discount'])
             elif publisher == 'OUP':
                 discount = '{0:.2f}'.format((float(row['Charge Amount'])/0.95) - float(row['Charge Amount']))
                 row['Prepayment discount'] = '£{}'.format(discount)
-            warning = 0
-            manual_rejection = 'BUG: unknown reason for manual rejection'
             t = filter_prepayment_records(row, publisher, filter_date_field, request_status_field, dateutil_options)
-            if t[0] == 1: ## first parameter returned by filter_prepayment_records is either 1 for include or 0 for exclude
-                doi = row[doi_field]
-                # print('Publisher:', publisher)
-                # print('DOI:', doi)
-                title = row[title_field]
+            filtered_rows.append((row_number, row, t))
+            if t[0] == 1:
                 if institution_field:
                     institution = row[institution_field]
                 else:
                     institution = 'University of Cambridge'
-                if not title.strip() in exclude_titles:
-                    a = match_prepayment_deal_to_zd(doi, title, publisher, doi2zd_dict, doi2apollo,
-                                                    apollo2zd_dict, title2zd_dict, institution,
-#                                                    restrict_to_funder_policy=reporttype # default is None, so comment this line for a comprehensive search
-                                                    ) ##global reporttype is either 'COAF' or 'RCUK'
-                    zd_number = a
-                    manual_rejection = 'Not found in zd (function match_prepayment_deal_to_zd returned an empty string)'
-                else:
+                if (institution == 'University of Cambridge') and (row[title_field].strip() not in exclude_titles):
+                    records[row_number] = (row[doi_field], row[title_field])
+
+    # link all records to zd at once, one matching method at a time (see PrepaymentLinker);
+    # this replaces calling match_prepayment_deal_to_zd for each record
+    linker = PrepaymentLinker(zd_dict, doi2zd_dict, title2zd_dict, doi2apollo, apollo2zd_dict,
+                              manual_title2zd_dict, manual_doi2title, title_index=get_title_index(title2zd_dict),
+                              processes=prepayment_link_processes, link_cache=link_cache, source=publisher)
+    links = linker.link(records)
+
+    publisher_id = 1
+    for row_number, row, t in filtered_rows:
+        warning = 0
+        manual_rejection = 'BUG: unknown reason for manual rejection'
+        if t[0] == 1: ## first parameter returned by filter_prepayment_records is either 1 for include or 0 for exclude
+            doi = row[doi_field]
+            # print('Publisher:', publisher)
+            # print('DOI:', doi)
+            title = row[title_field]
+            if not title.strip() in exclude_titles:
+                link = links.get(row_number)
+                if link is None:
+                    # institution is not University of Cambridge
                     zd_number = ''
-                    manual_rejection = 'Title included in exclude_titles list; Not found in zd (match by title attempted only on tickets included in ' + reporttype + ' policy) during a previous run'
-                    logger.warning('The following record could not be matched to a Zendesk ticket. '
-                                   'If this is a Wiley or OUP record, please map it manually to a Zendesk by adding '
-                                   'it to manual_title2zd_dict.')
-                #~ output_dict[publisher_id] = row
-                for a in field_renaming_list:
-                    #~ output_dict[publisher_id][a[1]] = output_dict[publisher_id][a[0]]
-                    row[a[1]] = row[a[0]]
-                    #~ del output_dict[publisher_id][a[0]]
-                    del row[a[0]]
-                if (type(zd_number) == type('string')) and zd_number.strip():
-                    #~ for fn in output_dict[publisher_id].keys():
-                    for fn in row.keys():
-                        try:
-                            if fn in zd_dict[zd_number].keys():
-                                logger.warning('{} in output_dict will be overwritten by data in zd_dict'.format(fn))
-                        except KeyError:
-                            warning = 1
-                if warning == 1:
-                    logger.warning('{} not in zd_dict. This is probably because the zd number for this article was '
-                                   'obtained from manual_title2zd_dict rather than from zd_dict and either (1) '
-                                   'the zd ticket is newer than the zd export used here (using a new export should '
-                                   'solve the problem); or (2) this zd_number is a '
-                                   'typo in manual_title2zd_dict'.format(zd_number))
-                    zd_number = ''
-                if zd_number:
-                    if reporttype == 'RCUK':
-                        policy_flag = "RCUK policy [flag]"
-                        payment_flag = "RCUK payment [flag]"
-                    elif reporttype == 'COAF':
-                        policy_flag = "COAF policy [flag]"
-                        payment_flag = "COAF payment [flag]"
-                    elif reporttype == 'ALL':
-                        row[rejection_reason_field] = 'Included in output_dict by function import_prepayment_data; ' \
-                                                      'report type is ALL)'
+                elif link.stage in [STAGE_SIMILAR_TITLE, None]:
+                    # matches by similarity are logged for review rather than used
+                    zd_number = heuristic_match_by_title(link.title, publisher, title2zd_dict,
+                                                         similar_titles=link.similar_titles)
+                else:
+                    logger.debug('Record %s linked to zd by %s', row_number, link.stage)
+                    zd_number = link.zd_number
+                manual_rejection = 'Not found in zd (PrepaymentLinker did not link this record)'
+            else:
+                zd_number = ''
+                manual_rejection = 'Title included in exclude_titles list; Not found in zd (match by title attempted only on tickets included in ' + reporttype + ' policy) during a previous run'
+                logger.warning('The following record could not be matched to a Zendesk ticket. '
+                               'If this is a Wiley or OUP record, please map it manually to a Zendesk by adding '
+                               'it to manual_title2zd_dict.')
+            #~ output_dict[publisher_id] = row
+            for a in field_renaming_list:
+                #~ output_dict[publisher_id][a[1]] = output_dict[publisher_id][a[0]]
+                row[a[1]] = row[a[0]]
+                #~ del output_dict[publisher_id][a[0]]
+                del row[a[0]]
+            if (type(zd_number) == type('string')) and zd_number.strip():
+                #~ for fn in output_dict[publisher_id].keys():
+                for fn in row.keys():
+                    try:
+                        if fn in zd_dict[zd_number].keys():
+                            logger.warning('{} in output_dict will be overwritten by data in zd_dict'.format(fn))
+                    except KeyError:
+                        warning = 1
+            if warning == 1:
+                logger.warning('{} not in zd_dict. This is probably because the zd number for this article was '
+                               'obtained from manual_title2zd_dict rather than from zd_dict and either (1) '
+                               'the zd ticket is newer than the zd export used here (using a new export should '
+                               'solve the problem); or (2) this zd_number is a '
+                               'typo in manual_title2zd_dict'.format(zd_number))
+                zd_number = ''
+            if zd_number:
+                if reporttype == 'RCUK':
+                    policy_flag = "RCUK policy [flag]"
+                    payment_flag = "RCUK payment [flag]"
+                elif reporttype == 'COAF':
+                    policy_flag = "COAF policy [flag]"
+                    payment_flag = "COAF payment [flag]"
+                elif reporttype == 'ALL':
+                    row[rejection_reason_field] = 'Included in output_dict by function import_prepayment_data; ' \
+                                                  'report type is ALL)'
+                    output_dict[publisher_id] = row
+                    rejection_dict[publisher_id] = row  # this can be removed from the if statement as it also appears in else; leaving it here for now as still in active development
+                    continue
+
+                if type(zd_number) == type('string'):
+                    row.update(zd_dict[zd_number])
+                    if zd_number in included_in_report.keys():
+                        print('WARNING: A report entry already exists for zd number:', zd_number)
+                        print('TITLE:', title)
+                        print('Please merge this duplicate in the exported report', '\n')
+                    if (zd_dict[zd_number][policy_flag] == 'yes') or (zd_dict[zd_number][payment_flag] == 'yes'):
+                        #row.update(zd_dict[zd_number])
+                        row[rejection_reason_field] = 'Included in output_dict by function import_prepayment_data_and_link_to_zd (zd_number is string)'
                         output_dict[publisher_id] = row
-                        rejection_dict[publisher_id] = row  # this can be removed from the if statement as it also appears in else; leaving it here for now as still in active development
-                        continue
-
-                    if type(zd_number) == type('string'):
-                        row.update(zd_dict[zd_number])
-                        if zd_number in included_in_report.keys():
-                            print('WARNING: A report entry already exists for zd number:', zd_number)
-                            print('TITLE:', title)
-                            print('Please merge this duplicate in the exported report', '\n')
-                        if (zd_dict[zd_number][policy_flag] == 'yes') or (zd_dict[zd_number][payment_flag] == 'yes'):
-                            #row.update(zd_dict[zd_number])
-                            row[rejection_reason_field] = 'Included in output_dict by function import_prepayment_data_and_link_to_zd (zd_number is string)'
-                            output_dict[publisher_id] = row
-                            rejection_dict[publisher_id] = row # this can be removed from the if statement as it also appears in else; leaving it here for now as still in active development
-                        else:
-                            row[rejection_reason_field] = 'Not included in ' + reporttype + ' policy (zd_number is string)'
-                            rejection_dict[publisher_id] = row
-                    elif type(zd_number) == type(['list']): ## zd_number may be a tuple because doi2zd_dict now resolves all tickets with a given DOI that are not explicitly marked as duplicates in zd
-                        included_row_flag = False
-                        for zd in zd_number:
-                            if included_row_flag == False:
-                                row.update(zd_dict[zd])
-                                if zd in included_in_report.keys():
-                                    print('WARNING: A report entry already exists for zd number:', zd)
-                                    print('TITLE:', title)
-                                    print('Please merge this duplicate in the exported report', '\n')
-                                if (zd_dict[zd][policy_flag] == 'yes') or (zd_dict[zd][payment_flag] == 'yes'):
-                                    row[rejection_reason_field] = 'Included in output_dict by function import_prepayment_data_and_link_to_zd (zd_number is list)'
-                                    output_dict[publisher_id] = row
-                                    rejection_dict[publisher_id] = row  # this can be removed from the if statement as it also appears in else; leaving it here for now as still in active development
-                                    included_row_flag = True
-                            else:
-                                print('INFO: This row has already been included in output_dict based on another zendesk ticket:')
-                                print('INFO: Current zendesk ticket:', zd)
-                                print('INFO: List of zendesk tickets being evaluated for this input row:', zd_number)
-                                print('INFO: This input row:', row, '\n')
+                        rejection_dict[publisher_id] = row # this can be removed from the if statement as it also appears in else; leaving it here for now as still in active development
+                    else:
+                        row[rejection_reason_field] = 'Not included in ' + reporttype + ' policy (zd_number is string)'
+                        rejection_dict[publisher_id] = row
+                elif type(zd_number) == type(['list']): ## zd_number may be a tuple because doi2zd_dict now resolves all tickets with a given DOI that are not explicitly marked as duplicates in zd
+                    included_row_flag = False
+                    for zd in zd_number:
                         if included_row_flag == False:
-                            row[rejection_reason_field] = 'Not included in ' + reporttype + ' policy (zd_number is list)'
-                            rejection_dict[publisher_id] = row
-                else:
-                    row[rejection_reason_field] = t[1] + '; ' + manual_rejection
-                    # print(t[0])
-                    # print(row)
-                    # print(row[rejection_reason_field])
-                    rejection_dict[publisher_id] = row
+                            row.update(zd_dict[zd])
+                            if zd in included_in_report.keys():
+                                print('WARNING: A report entry already exists for zd number:', zd)
+                                print('TITLE:', title)
+                                print('Please merge this duplicate in the exported report', '\n')
+                            if (zd_dict[zd][policy_flag] == 'yes') or (zd_dict[zd][payment_flag] == 'yes'):
+                                row[rejection_reason_field] = 'Included in output_dict by function import_prepayment_data_and_link_to_zd (zd_number is list)'
+                                output_dict[publisher_id] = row
+                                rejection_dict[publisher_id] = row  # this can be removed from the if statement as it also appears in else; leaving it here for now as still in active development
+                                included_row_flag = True
+                        else:
+                            print('INFO: This row has already been included in output_dict based on another zendesk ticket:')
+                            print('INFO: Current zendesk ticket:', zd)
+                            print('INFO: List of zendesk tickets being evaluated for this input row:', zd_number)
+                            print('INFO: This input row:', row, '\n')
+                    if included_row_flag == False:
+                        row[rejection_reason_field] = 'Not included in ' + reporttype + ' policy (zd_number is list)'
+                        rejection_dict[publisher_id] = row
             else:
-                row[rejection_reason_field] = t[1]
+                row[rejection_reason_field] = t[1] + '; ' + manual_rejection
+                # print(t[0])
+                # print(row)
+                # print(row[rejection_reason_field])
                 rejection_dict[publisher_id] = row
-            publisher_id += 1
+        else:
+            row[rejection_reason_field] = t[1]
+            rejection_dict[publisher_id] = row
+        publisher_id += 1
 
 
 def filter_prepayment_records(row, publisher, filter_date_field, request_status_field='', dateutil_options=''):
@@ -1232,7 +1242,7 @@ def action_index_zendesk_data_general(zenexport, zd_dict={}, title2zd_dict={}, d
     #        embargo = 'Embargo duration [list]'
     #        green_licence = 'Green licence [list]',
             apollo_handle = row['#Repository link [txt]'].replace('https://www.repository.cam.ac.uk/handle/' , '')
-            doi = prune_and_cleanup_string(row['#DOI (like 10.123/abc456) [txt]'], DOI_CLEANUP, DOI_FIX)
+            doi = clean_doi(row['#DOI (like 10.123/abc456) [txt]'])
             row['#DOI (like 10.123/abc456) [txt]'] = doi
             try:
                 dateutil_options = dateutil.parser.parserinfo(dayfirst=True)
@@ -1242,7 +1252,7 @@ def action_index_zendesk_data_general(zenexport, zd_dict={}, title2zd_dict={}, d
                 # dateutil module could not be imported (not installed)
                 pass
             title2zd_dict[article_title.upper()] = zd_number
-            doi2zd_dict[doi] = zd_number
+            doi2zd_dict[normalise_doi(doi)] = zd_number
             oa2zd_dict[oa_number] = zd_number
             apollo2zd_dict[apollo_handle] = zd_number
             zd2zd_dict[zd_number] = zd_number
@@ -1429,8 +1439,8 @@ def action_index_zendesk_data():
         #        embargo = 'Embargo duration [list]'
         #        green_licence = 'Green licence [list]',
                 apollo_handle = row['#Repository link [txt]'].replace('https://www.repository.cam.ac.uk/handle/' , '')
-                doi = prune_and_cleanup_string(row['#DOI (like 10.123/abc456) [txt]'], DOI_CLEANUP, DOI_FIX)
-                row['#DOI (like 10.123/abc456) [txt]'] = doi
+                row['#DOI (like 10.123/abc456) [txt]'] = clean_doi(row['#DOI (like 10.123/abc456) [txt]'])
+                doi = normalise_doi(row['#DOI (like 10.123/abc456) [txt]'])
                 dateutil_options = dateutil.parser.parserinfo(dayfirst=True)
                 publication_date = convert_date_str_to_yyyy_mm_dd(row['#Publication date (YYYY-MM-DD) [txt]'], dateutil_options)
                 row['#Publication date (YYYY-MM-DD) [txt]'] = publication_date
@@ -1477,9 +1487,9 @@ def action_populate_doi2apollo(apolloexport, enc='utf-8'):
         for row in reader:
             apollo_handle = row['handle']
             if len(row['rioxxterms.versionofrecord'].strip()) > 5:
-                doi = prune_and_cleanup_string(row['rioxxterms.versionofrecord'], DOI_CLEANUP, DOI_FIX)
+                doi = normalise_doi(row['rioxxterms.versionofrecord'])
             else:
-                doi = prune_and_cleanup_string(row['dc.identifier.uri'].split(',')[0], DOI_CLEANUP, DOI_FIX)
+                doi = normalise_doi(row['dc.identifier.uri'].split(',')[0])
             doi2apollo[doi] = apollo_handle
     return(doi2apollo)
 
@@ -1727,6 +1737,9 @@ coaf_paydate_field = 'GL Posting Date' #Name of field in coaf_last_year and coaf
 coaf_payamount_field = 'Burdened Cost' #Name of field in coaf_last_year and coaf_this_year containing the payment date
 total_coaf_payamount_field = 'COAF APC Amount' #Name of field we want the calculated total COAF APC to be stored in
 total_apc_field = 'Total APC amount'
+prepayment_link_processes = None #Maximum number of processes used to match titles of prepayment records by similarity; defaults to the number of CPUs
+use_link_cache = True #Reuse links of prepayment records to zd tickets found in previous runs, unless the tickets or the data they were matched with changed since (see common.prepaymentlink)
+link_cache = None
 
 if reporttype in ["RCUK", "ALL"]:
     paydate_field = rcuk_paydate_field
@@ -1934,6 +1947,9 @@ if __name__ == '__main__':
     ###INDEX INFO FROM ZENDESK ON ZD NUMBER
     logger.info('Indexing zendesk info on zd number')
     action_index_zendesk_data()
+    if use_link_cache:
+        # digests of tickets as exported, before payments and other metadata are plugged into zd_dict
+        link_cache = LinkCache(ticket_digests(zd_dict))
 
     ### POPULATE doi2apollo DICTIONARY
     logger.info('Populating doi2apollo dictionary')
@@ -1965,7 +1981,7 @@ if __name__ == '__main__':
     #### PLUGGING IN DATA FROM EUROPE PMC
     if resolve_pmc_id:
         logger.info('Plugging in data from Europe PMC into zd_dict')
-        plug_in_metadata(europepmc_map, 'DOI', doi2zd_dict)
+        plug_in_europepmc_index(europepmc_map, doi2zd_dict)
 
     # #### PLUGGING IN DATA FROM COTTAGELABS
     # ## For some reason not all PMIDs are appearing in the final COAF 2017 report, so this is something that needs to be fixed.
@@ -0,0 +1,249 @@
+import argparse
+import csv
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import common.midas_constants as mc
+import common.zendesk as zendesk
+import midas
+from benchmarks.synthetic import PREPAYMENT_LAYOUTS, SyntheticData
+from common.oatsutils import close_debug_csvs
+
+# create logger
+logger = logging.getLogger(__name__)
+
+# Synthetic data and the history of results are saved here
+BENCHMARK_FOLDER = os.path.join(os.path.expanduser("~"), ".OATs", "benchmarks")
+HISTORY_FILENAME = 'history.json'
+
+# A benchmark is reported as a regression if it is this much slower than in the previous run at the same scale
+# on the same machine (0.25 = 25% slower)
+REGRESSION_THRESHOLD = 0.25
+# Differences shorter than this (in seconds) are ignored, as they are mostly noise
+MINIMUM_DIFFERENCE = 0.05
+
+
+def indexed_parser(data):
+    parser = zendesk.Parser(data['zenexport'])
+    parser.index_zd_data(use_snapshot=False)
+    return parser
+
+
+def setup_index_zd_data(data):
+    parser = zendesk.Parser(data['zenexport'])
+    return lambda: parser.index_zd_data(use_snapshot=False)
+
+
+def setup_filter_zendesk_export(data):
+    output_filename = os.path.join(data['workdir'], 'zendesk_export_filtered.csv')
+    return lambda: zendesk.filter_zendesk_export(data['zenexport'], output_filename, **{'Group': 'Open Access'})
+
+
+def setup_plug_in_payment_data(data, use_payment_ledger=False):
+    parser = indexed_parser(data)
+    parser.use_payment_ledger = use_payment_ledger
+
+    def run():
+        for paymentsfile, cufs_export_type, funder in data['paymentfiles']:
+            parser.plug_in_payment_data(paymentsfile, cufs_export_type, funder)
+        close_debug_csvs()
+    return run
+
+
+def setup_plug_in_metadata(data):
+    parser = indexed_parser(data)
+    fields = mc.ReportTemplate().source_fields()
+    return lambda: parser.plug_in_metadata(data['apollo_export'], 'handle', parser.apollo2zd_dict, fields=fields)
+
+
+def setup_heuristic_match_by_title(data):
+    parser = indexed_parser(data)
+    titles = []
+    for publisher, report in data['prepayment_reports'].items():
+        title_field = [column for column, kind in PREPAYMENT_LAYOUTS[publisher] if kind == 'title'][0]
+        with open(report, encoding='utf-8') as f:
+            titles.extend(row[title_field] for row in csv.DictReader(f))
+
+    def run():
+        # like ART heuristic_match_by_title, which cannot be imported as it runs a report when loaded
+        parser.title_indexes = {}
+        index = parser.get_title_index()
+        for t in titles:
+            index.matches(t.upper())
+    return run
+
+
+def setup_output_csv(data):
+    midas.working_folder = data['workdir']
+    report = midas.Report(data['zenexport'])
+    report.zd_parser.index_zd_data(use_snapshot=False)
+    report_template = mc.ReportTemplate()
+    report.plugin_apollo([data['apollo_export']], fields=report_template.source_fields())
+    report.parse_cufs_data(data['paymentfiles'], processes=1)
+    report.populate_invoiced_articles()
+    report.populate_report_fields(report_template)
+    close_debug_csvs()
+    return report.output_csv
+
+
+# Name of each benchmark, and a function that prepares it, given the dictionary of synthetic data, and returns
+# the function to time
+BENCHMARKS = [
+    ('index_zd_data', setup_index_zd_data),
+    ('filter_zendesk_export', setup_filter_zendesk_export),
+    ('plug_in_payment_data', setup_plug_in_payment_data),
+    ('plug_in_payment_data (ledger)', lambda data: setup_plug_in_payment_data(data, use_payment_ledger=True)),
+    ('plug_in_metadata', setup_plug_in_metadata),
+    ('heuristic_match_by_title', setup_heuristic_match_by_title),
+    ('Report.output_csv', setup_output_csv),
+]
+
+
+def run_benchmarks(data, names=None, repeat=3):
+    '''
+    Times each benchmark repeat times, preparing it again before each run
+    :param data: manifest of synthetic data (see SyntheticData.generate) and 'workdir', a folder for output files
+    :param names: names of the benchmarks to run; all if None
+    :param repeat: number of runs of each benchmark
+    :return: dictionary of the shortest time (in seconds) of each benchmark
+    '''
+    results = {}
+    cwd = os.getcwd()
+    # debug CSVs and reports are written to the current folder
+    os.chdir(data['workdir'])
+    try:
+        for name, setup in BENCHMARKS:
+            if (names is not None) and (name not in names):
+                continue
+            timings = []
+            for i in range(repeat):
+                function = setup(data)
+                start = time.perf_counter()
+                function()
+                timings.append(time.perf_counter() - start)
+            results[name] = min(timings)
+            logger.info('{}: {:.3f}s (best of {})'.format(name, results[name], repeat))
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def git_revision():
+    '''
+    :return: the git commit of the working tree, or '' if it cannot be found
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def load_history(history_path):
+    '''
+    :param history_path: path of the JSON file of results
+    :return: list of results of previous runs, oldest first
+    '''
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_history(history_path, history):
+    os.makedirs(os.path.dirname(os.path.abspath(history_path)), exist_ok=True)
+    temp_path = history_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(history, f, indent=4)
+    os.replace(temp_path, history_path)
+
+
+def find_regressions(entry, history, threshold=REGRESSION_THRESHOLD):
+    '''
+    Compares the results of a run with the latest previous run at the same scale on the same machine
+    :param entry: results of the run (see main)
+    :param history: list of results of previous runs, oldest first
+    :param threshold: see REGRESSION_THRESHOLD
+    :return: list of tuples (name of benchmark, previous time, time) of benchmarks that became slower
+    '''
+    for previous in reversed(history):
+        if (previous['scale'], previous['machine']) == (entry['scale'], entry['machine']):
+            break
+    else:
+        return []
+    regressions = []
+    for name, seconds in entry['results'].items():
+        before = previous['results'].get(name)
+        if (before is not None) and (seconds - before > max(before * threshold, MINIMUM_DIFFERENCE)):
+            regressions.append((name, before, seconds))
+    return regressions
+
+
+def main(arguments):
+    data_folder = os.path.join(arguments.folder, 'data', 'scale{}-seed{}'.format(arguments.scale, arguments.seed))
+    data = SyntheticData(data_folder, arguments.scale, arguments.seed).generate()
+    history_path = os.path.join(arguments.folder, HISTORY_FILENAME)
+    history = load_history(history_path)
+
+    with tempfile.TemporaryDirectory(dir=arguments.folder) as workdir:
+        data['workdir'] = workdir
+        results = run_benchmarks(data, arguments.benchmarks, arguments.repeat)
+
+    entry = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'machine': platform.node(),
+        'python': platform.python_version(),
+        'scale': arguments.scale,
+        'seed': arguments.seed,
+        'repeat': arguments.repeat,
+        'results': results,
+    }
+    regressions = find_regressions(entry, history, arguments.threshold)
+    for name, before, seconds in regressions:
+        logger.warning('Regression in {}: {:.3f}s, was {:.3f}s'.format(name, seconds, before))
+    if not arguments.dry_run:
+        history.append(entry)
+        save_history(history_path, history)
+        logger.info('Results saved to {}'.format(history_path))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times the main stages of Midas on synthetic data and compares '
+                                                 'the results with previous runs', prog='benchmarks')
+    parser.add_argument('-s', '--scale', type=int, default=1,
+                        help='Size of the synthetic data, as a multiple of a small export (e.g. 1, 10 or 100; '
+                             'default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator of synthetic data (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of runs of each benchmark; the shortest is recorded (default: %(default)s)')
+    parser.add_argument('-b', '--benchmark', dest='benchmarks', action='append',
+                        choices=[name for name, setup in BENCHMARKS],
+                        help='Run only this benchmark; repeat to run several (default: all)')
+    parser.add_argument('--folder', default=BENCHMARK_FOLDER, metavar='<path>',
+                        help='Folder for synthetic data and the history of results (default: %(default)s)')
+    parser.add_argument('-t', '--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='Report benchmarks slower than the previous run by more than this fraction '
+                             '(default: %(default)s)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Do not save the results to the history')
+    arguments = parser.parse_args()
+
+    # modules log every row at DEBUG level, as in a real run, but only INFO messages are shown
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logging.getLogger().addHandler(ch)
+    logging.getLogger().setLevel(logging.INFO)
+    os.makedirs(arguments.folder, exist_ok=True)
+    if main(arguments):
+        sys.exit(1)
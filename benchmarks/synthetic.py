@@ -0,0 +1,384 @@
+import collections
+import csv
+import json
+import logging
+import os
+import random
+
+import common.cufs as cufs
+import common.midas_constants as mc
+from common.apollo import MetadataMap
+from common.zendesk import ZdFieldsMapping
+
+# create logger
+logger = logging.getLogger(__name__)
+
+# Number of records of each data source at scale 1; scale 100 is roughly the size of the real exports
+ZENDESK_TICKETS = 1000
+CUFS_ROWS = 250  # per CUFS report
+APOLLO_ITEMS = 1500
+PREPAYMENT_ROWS = 100  # per publisher
+
+# The manifest lists the files generated in a folder, so that they are only generated once for each scale and seed
+MANIFEST_FILENAME = 'manifest.json'
+
+# Ticket groups, with their weight in the export
+ZENDESK_GROUPS = [('Open Access', 60), ('Repository', 15)] + [(g, 5) for g in mc.ZENDESK_EXCLUDED_GROUPS]
+
+# Column layouts of prepayment reports, as (column, kind of value); these are the columns used by
+# common.prepayments, which cannot be imported without zenpy and local Zendesk credentials
+PREPAYMENT_LAYOUTS = collections.OrderedDict([
+    ('springer', [('article title', 'title'), ('DOI', 'doi'), ('DOI URL', 'doi_url'), ('journal title', 'journal'),
+                  ('ISSN', 'issn'), ('eISSN', 'issn'), ('article type', 'type'), ('license type', 'licence'),
+                  ('acceptance date', 'date'), ('approval requested date', 'date'), ('approval date', 'date'),
+                  ('online first publication date', 'date'), ('online issue publication date', 'date'),
+                  ('APC', 'amount'), ('currency', 'currency')]),
+    ('wiley', [('Date', 'date'), ('Request Status', 'status'), ('Article Title', 'title'), ('DOI', 'doi'),
+               ('Article URL', 'doi_url'), ('Journal', 'journal'), ('Journal Print ISSN', 'issn'),
+               ('Journal Electronic ISSN', 'issn'), ('Article Type', 'type'), ('License Type', 'licence'),
+               ('Article Accepted Date', 'date'), ('EV Published Date', 'date'), ('Published in Issue Date', 'date'),
+               ('Full APC', 'amount'), ('Discount', 'amount'), ('Deposits', 'amount'), ('Withdrawals', 'amount')]),
+    ('oup', [('Referral Date', 'date'), ('Order Date', 'date'), ('Status', 'status'), ('Type', 'type'),
+             ('Manuscript Title', 'title'), ('Doi', 'doi'), ('Journal Name', 'journal'), ('Licence', 'licence'),
+             ('Editorial Decision Date', 'date'), ('Issue Publication', 'date'), ('Charge Amount', 'amount'),
+             ('Currency', 'currency')]),
+])
+
+PUBLISHERS = ['Springer', 'Wiley', 'Oxford University Press', 'Elsevier', 'Nature Publishing Group', 'IOP Publishing',
+              'Royal Society of Chemistry', 'American Chemical Society', 'PLOS', 'BMJ', 'Frontiers', 'MDPI']
+
+TITLE_WORDS = '''analysis of the in and for a with on by from effects role novel structure function dynamics
+    protein cell cells gene expression regulation mechanism model models human mouse cancer tumour brain neural
+    network networks quantum magnetic thin films graphene surface interface catalysis synthesis molecular
+    evidence climate ocean carbon soil plant growth development evolution population genetic genomic variation
+    signalling pathway receptor response immune infection bacterial viral clinical trial patients risk disease
+    cardiovascular metabolic imaging resolution high low temperature pressure phase transition spin electron
+    optical properties dependent independent control learning memory behaviour social economic policy health
+    children adults cohort study review systematic early late stage long term short new approach method
+    framework theory data large scale single molecule measurement observation galaxy star formation dark matter
+    energy storage battery solar water flow turbulence fluid mechanics stress strain material materials
+    design optimisation algorithm inference bayesian statistical estimation'''.split()
+
+JOURNAL_WORDS = ['Journal', 'Letters', 'Reviews', 'Communications', 'Proceedings', 'Annals', 'Advances']
+JOURNAL_SUBJECTS = ['Physics', 'Chemistry', 'Biology', 'Medicine', 'Neuroscience', 'Economics', 'Geology',
+                    'Materials', 'Ecology', 'Immunology', 'Astronomy', 'Engineering', 'Mathematics']
+
+DEPARTMENTS = ['Department of Physics', 'Department of Chemistry', 'Department of Genetics', 'Department of Zoology',
+               'Department of Engineering', 'Department of Medicine', 'Department of Psychiatry',
+               'Department of Earth Sciences', 'Faculty of Economics', 'MRC Cancer Unit']
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+# An article submitted to the Open Access team; records of all data sources are derived from these
+SyntheticArticle = collections.namedtuple('SyntheticArticle', ['zd_number', 'oa_number', 'doi', 'title', 'journal',
+                                                               'publisher', 'handle', 'apc_invoice', 'rcuk', 'coaf',
+                                                               'date'])
+
+
+class SyntheticData():
+    '''
+    Generator of realistic synthetic data for benchmarks: a Zendesk export with the columns of
+    zendesk.ZdFieldsMapping, CUFS reports in the rcuk, coaf and rge layouts, an Apollo export and Springer,
+    Wiley and OUP prepayment reports.
+
+    All files are derived from the same set of articles, so CUFS payments, Apollo items and prepayment
+    records refer to Zendesk tickets in the proportions seen in real reports (some by ZD number, some by OA
+    number or invoice number, some not at all). The same scale and seed always produce the same files.
+    '''
+    def __init__(self, folder, scale=1, seed=0):
+        '''
+        :param folder: folder where the files are written
+        :param scale: multiplier of the number of records of each data source (e.g. 1, 10 or 100)
+        :param seed: seed of the random number generator
+        '''
+        self.folder = folder
+        self.scale = scale
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.articles = []
+
+    def title(self):
+        words = self.random.sample(TITLE_WORDS, self.random.randint(5, 14))
+        return ' '.join(words).capitalize()
+
+    def journal(self):
+        return '{} of {}'.format(self.random.choice(JOURNAL_WORDS), self.random.choice(JOURNAL_SUBJECTS))
+
+    def date(self):
+        return '{}-{:02}-{:02}'.format(self.random.randint(2014, 2019), self.random.randint(1, 12),
+                                       self.random.randint(1, 28))
+
+    def cufs_date(self, year_digits=4):
+        year = self.random.randint(2014, 2019)
+        if year_digits == 2:
+            year = year % 100
+        return '{:02}-{}-{}'.format(self.random.randint(1, 28), self.random.choice(MONTHS), year)
+
+    def amount(self):
+        pounds = self.random.choice([self.random.randint(500, 3500), self.random.randint(10, 400)])
+        return '{:,}.{:02}'.format(pounds, self.random.randint(0, 99))
+
+    def make_articles(self):
+        '''
+        Populates self.articles with ZENDESK_TICKETS * scale articles
+        '''
+        r = self.random
+        zd_number = 10000
+        self.articles = []
+        for i in range(ZENDESK_TICKETS * self.scale):
+            zd_number += r.randint(1, 3)
+            self.articles.append(SyntheticArticle(
+                zd_number=str(zd_number),
+                oa_number='OA-{:06}'.format(i + 1) if r.random() < 0.8 else '',
+                doi='10.{}/{}.{}'.format(r.randint(1000, 9999), r.choice(['j', 'nature', 'journal', 's']),
+                                         r.randint(10000, 9999999)) if r.random() < 0.7 else '',
+                title=self.title(),
+                journal=self.journal(),
+                publisher=r.choice(PUBLISHERS),
+                handle='1810/{}'.format(240000 + i) if r.random() < 0.6 else '',
+                apc_invoice='INV{:07}'.format(r.randint(0, 9999999)) if r.random() < 0.4 else '',
+                rcuk=r.random() < 0.5,
+                coaf=r.random() < 0.4,
+                date=self.date(),
+            ))
+
+    def generate(self):
+        '''
+        Writes all files to self.folder, unless they were already generated with the same scale and seed
+        :return: the manifest, i.e. a dictionary of the paths of the files generated
+        '''
+        manifest_path = os.path.join(self.folder, MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if (manifest.get('scale'), manifest.get('seed')) == (self.scale, self.seed):
+                return manifest
+        os.makedirs(self.folder, exist_ok=True)
+        logger.info('Generating synthetic data at scale {} in {}'.format(self.scale, self.folder))
+        self.make_articles()
+        manifest = {
+            'scale': self.scale,
+            'seed': self.seed,
+            'zenexport': self.write_zendesk_export(),
+            'paymentfiles': [
+                [self.write_cufs_report('rcuk'), 'rcuk', 'rcuk'],
+                [self.write_cufs_report('rge', suffix='rcuk'), 'rge', 'rcuk'],
+                [self.write_cufs_report('coaf'), 'coaf', 'coaf'],
+                [self.write_cufs_report('rge', suffix='coaf'), 'rge', 'coaf'],
+            ],
+            'apollo_export': self.write_apollo_export(),
+            'prepayment_reports': {p: self.write_prepayment_report(p) for p in PREPAYMENT_LAYOUTS},
+        }
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        return manifest
+
+    def write_zendesk_export(self, filename='zendesk_export.csv'):
+        '''
+        Writes a Zendesk export with one ticket per article, plus duplicate tickets and tickets of other groups
+        :return: path of the export
+        '''
+        r = self.random
+        f = ZdFieldsMapping()
+        fieldnames = list(collections.OrderedDict.fromkeys(vars(f).values()))
+        defaults = {}
+        for name in fieldnames:
+            if name.endswith('[flag]'):
+                defaults[name] = 'no'
+            elif name.endswith(('[list]', '[txt]', '[dec]')):
+                defaults[name] = '-'
+            else:
+                defaults[name] = ''
+        groups, weights = zip(*ZENDESK_GROUPS)
+        path = os.path.join(self.folder, filename)
+        with open(path, 'w', encoding='utf-8', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            for a in self.articles:
+                row = dict(defaults)
+                row[f.id] = a.zd_number
+                row[f.group] = r.choices(groups, weights)[0]
+                row[f.status] = r.choice(['Closed', 'Solved', 'Open', 'Pending'])
+                row[f.requester] = 'Author {}'.format(r.randint(1, 5000))
+                row[f.requester_email] = 'author{}@cam.ac.uk'.format(r.randint(1, 5000))
+                row[f.created_at] = '{} {:02}:{:02}'.format(a.date, r.randint(0, 23), r.randint(0, 59))
+                row[f.updated_at] = row[f.created_at]
+                if a.oa_number and (r.random() < 0.1):
+                    # old tickets only have the OA number in the subject line
+                    row[f.subject] = 'Open Access enquiry {}'.format(a.oa_number)
+                else:
+                    row[f.subject] = 'Open Access enquiry: {}'.format(a.title[:60])
+                    if a.oa_number:
+                        row[f.external_id] = a.oa_number
+                row[f.manuscript_title] = a.title
+                row[f.journal_title] = a.journal
+                row[f.publisher] = a.publisher
+                row[f.department] = r.choice(DEPARTMENTS)
+                if a.doi:
+                    row[f.doi] = r.choice(['', '', '', 'https://doi.org/', 'http://dx.doi.org/']) + a.doi
+                if r.random() < 0.7:
+                    # Zendesk dates are free text, so they come in a variety of formats
+                    year, month, day = a.date.split('-')
+                    row[f.publication_date] = r.choice([a.date, '{}/{}/{}'.format(day, month, year)])
+                if a.handle:
+                    row[f.repository_link] = 'https://www.repository.cam.ac.uk/handle/' + a.handle
+                if a.apc_invoice:
+                    row[f.apc_invoice_number] = a.apc_invoice
+                    row[f.apc_payment] = 'Yes'
+                if r.random() < 0.05:
+                    row[f.pagecolour_invoice_number] = 'PC{:06}'.format(r.randint(0, 999999))
+                if r.random() < 0.02:
+                    row[f.membership_invoice_number] = 'MEM{:05}'.format(r.randint(0, 99999))
+                if a.rcuk:
+                    row[f.rcuk_payment] = 'yes'
+                    row[f.rcuk_policy] = 'yes'
+                if a.coaf:
+                    row[f.coaf_payment] = 'yes'
+                    row[f.coaf_policy] = 'yes'
+                row[f.apc_charged_to_rcuk_ebdu] = self.amount() if a.rcuk else '-'
+                writer.writerow(row)
+                if r.random() < 0.03:
+                    # duplicate ticket of the same article
+                    row[f.id] = str(int(a.zd_number) + 100000000)
+                    row[f.duplicate] = 'yes'
+                    row[f.duplicate_of] = 'ZD-{}'.format(a.zd_number)
+                    writer.writerow(row)
+        return path
+
+    def description(self, a):
+        '''
+        :param a: SyntheticArticle
+        :return: description of a CUFS payment of article a, referring to it as a real one might
+        '''
+        r = self.random
+        k = r.random()
+        if (k < 0.35) or not a.oa_number:
+            return r.choice(['ZD-{}', 'ZD {}', 'Open Access ZD-{} APC', 'zd{}']).format(a.zd_number)
+        elif k < 0.75:
+            return r.choice(['{}', '{} APC', 'APC {} Smith', '{}/BANK CHARGE']).format(a.oa_number)
+        elif a.apc_invoice and (k < 0.85):
+            return 'APC payment, inv:{}'.format(a.apc_invoice)
+        return 'Open access charge {} {}'.format(a.journal, r.randint(1, 999))
+
+    def write_cufs_report(self, cufs_export_type, suffix=''):
+        '''
+        Writes a CUFS report of CUFS_ROWS * scale payments
+        :param cufs_export_type: 'rcuk', 'coaf' or 'rge' (see zendesk.get_cufs_map)
+        :param suffix: added to the filename, to tell apart reports of the same type
+        :return: path of the report
+        '''
+        r = self.random
+        if cufs_export_type == 'rcuk':
+            cufs_map = cufs.RcukFieldsMapping()
+        elif cufs_export_type == 'coaf':
+            cufs_map = cufs.CoafFieldsMapping()
+        else:
+            cufs_map = cufs.RgeFieldsMapping()
+        fieldnames = [v for v in vars(cufs_map).values() if v is not None]
+        combos = [(c.cost_centre, c.sof) for c in mc.RCUK_FORMAT_COST_CENTRE_SOF_COMBOS]
+        filename = '{}_{}.csv'.format(cufs_export_type, suffix) if suffix else '{}.csv'.format(cufs_export_type)
+        path = os.path.join(self.folder, filename)
+        with open(path, 'w', encoding='utf-8', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            for i in range(CUFS_ROWS * self.scale):
+                a = r.choice(self.articles)
+                row = {
+                    cufs_map.amount_field: self.amount(),
+                    cufs_map.oa_number: self.description(a) if r.random() < 0.9 else 'Unrelated charge {}'.format(i),
+                    cufs_map.paydate_field: self.cufs_date(year_digits=2 if cufs_export_type == 'coaf' else 4),
+                    cufs_map.supplier: a.publisher,
+                    cufs_map.invoice_field: a.apc_invoice if a.apc_invoice and (r.random() < 0.8)
+                                            else 'X{:06}'.format(r.randint(0, 999999)),
+                }
+                if cufs_export_type == 'rcuk':
+                    if r.random() < 0.85:
+                        row[cufs_map.cost_centre], row[cufs_map.source_of_funds] = r.choice(combos)
+                    else:
+                        row[cufs_map.cost_centre], row[cufs_map.source_of_funds] = 'VEXX', 'ZZZZ'
+                    k = r.random()
+                    if k < 0.8:
+                        row[cufs_map.transaction_code] = r.choice(mc.APC_TRANSACTION_CODES)
+                    elif k < 0.95:
+                        row[cufs_map.transaction_code] = r.choice(mc.OTHER_PUB_CHARGES_TRANSACTION_CODES)
+                    else:
+                        row[cufs_map.transaction_code] = 'EZZZ'
+                writer.writerow(row)
+        return path
+
+    def write_apollo_export(self, filename='apollo_export.csv'):
+        '''
+        Writes an Apollo export with an item for each article deposited in Apollo, plus items not in Zendesk
+        :return: path of the export
+        '''
+        r = self.random
+        m = MetadataMap()
+        fieldnames = list(vars(m).values())
+        path = os.path.join(self.folder, filename)
+        deposited = [a for a in self.articles if a.handle]
+        with open(path, 'w', encoding='utf-8', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            for i in range(APOLLO_ITEMS * self.scale):
+                if deposited and (i < len(deposited)):
+                    a = deposited[i]
+                    handle, doi, title, journal, publisher = a.handle, a.doi, a.title, a.journal, a.publisher
+                else:
+                    handle = '1810/{}'.format(100000 + i)
+                    doi, title, journal, publisher = '', self.title(), self.journal(), r.choice(PUBLISHERS)
+                writer.writerow({
+                    m.handle: handle,
+                    m.url: 'https://www.repository.cam.ac.uk/handle/' + handle,
+                    m.doi: 'https://doi.org/' + doi if doi else '',
+                    m.publisher: publisher,
+                    m.acceptance_date: self.date(),
+                    m.publication_date: self.date(),
+                    m.provenance: 'Submitted by Author {} on {}'.format(r.randint(1, 5000), self.date()),
+                    m.title: title,
+                    m.elements_id: str(r.randint(100000, 999999)),
+                    m.journal: journal,
+                    m.publication_type: r.choice(['Article', 'Article', 'Conference Object', 'Book chapter']),
+                })
+        return path
+
+    def prepayment_title(self, a):
+        '''
+        :return: the title of article a as a publisher might report it (sometimes with a typo or in upper case)
+        '''
+        r = self.random
+        title = a.title
+        k = r.random()
+        if k < 0.2:
+            position = r.randrange(len(title))
+            title = title[:position] + title[position + 1:]
+        elif k < 0.3:
+            title = title.upper()
+        return title
+
+    def write_prepayment_report(self, publisher):
+        '''
+        Writes a prepayment report of PREPAYMENT_ROWS * scale articles, most of them in Zendesk
+        :param publisher: 'springer', 'wiley' or 'oup' (see PREPAYMENT_LAYOUTS)
+        :return: path of the report
+        '''
+        r = self.random
+        layout = PREPAYMENT_LAYOUTS[publisher]
+        path = os.path.join(self.folder, '{}_prepayments.csv'.format(publisher))
+        with open(path, 'w', encoding='utf-8', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow([column for column, kind in layout])
+            for i in range(PREPAYMENT_ROWS * self.scale):
+                if r.random() < 0.8:
+                    a = r.choice(self.articles)
+                    title, doi, journal = self.prepayment_title(a), a.doi, a.journal
+                else:
+                    title, doi, journal = self.title(), '10.{}/{}'.format(r.randint(1000, 9999), i), self.journal()
+                values = {
+                    'title': title, 'doi': doi, 'doi_url': 'https://doi.org/' + doi, 'journal': journal,
+                    'issn': '{:04}-{:04}'.format(r.randint(0, 9999), r.randint(0, 9999)), 'type': 'OriginalPaper',
+                    'licence': r.choice(['CC BY', 'CC BY-NC']), 'status': r.choice(['Approved', 'Approved', 'Rejected']),
+                    'currency': r.choice(['GBP', 'USD', 'EUR']), 'amount': self.amount(),
+                }
+                writer.writerow([values[kind] if kind != 'date' else self.date() for column, kind in layout])
+        return path
+
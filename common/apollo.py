@@ -1,4 +1,6 @@
-from common.oatsutils import DOI_CLEANUP, DOI_FIX, prune_and_cleanup_string
+import csv
+
+from common.doi import normalise_doi
 
 class MetadataMap():
     '''
@@ -25,7 +27,7 @@ class Parser():
     def populate_doi2handle(self, apolloexport, enc='utf-8'):
         '''
         This function takes a CSV file exported by Apollo and builds a dictionary
-        translating DOIs to Apollo handles
+        translating DOIs (normalised, see doi.normalise_doi) to Apollo handles
         :param apolloexport: input CSV file
         :return: doi2apollo dictionary
         '''
@@ -35,9 +37,9 @@ class Parser():
             for row in reader:
                 apollo_handle = row['handle']
                 if len(row['rioxxterms.versionofrecord'].strip()) > 5:
-                    doi = prune_and_cleanup_string(row['rioxxterms.versionofrecord'], DOI_CLEANUP, DOI_FIX)
+                    doi = normalise_doi(row['rioxxterms.versionofrecord'])
                 else:
-                    doi = prune_and_cleanup_string(row['dc.identifier.uri'].split(',')[0], DOI_CLEANUP, DOI_FIX)
+                    doi = normalise_doi(row['dc.identifier.uri'].split(',')[0])
                 self.doi2handle[doi] = apollo_handle
 
         return self.doi2handle
\ No newline at end of file
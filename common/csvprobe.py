@@ -0,0 +1,99 @@
+import codecs
+import csv
+import os
+
+# Byte order marks and the encodings that consume them
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+class CsvProbe():
+    '''
+    Header, delimiter and encoding of a CSV file, worked out from its first record only (see probe_csv)
+    '''
+    def __init__(self, inputfile, header, delimiter, encoding):
+        '''
+        :param inputfile: path of CSV file
+        :param header: list of the fields in the header (first row)
+        :param delimiter: field delimiter
+        :param encoding: encoding to read the file with; if the file starts with a byte order mark, this is an
+                encoding that skips it (e.g. utf-8-sig)
+        '''
+        self.inputfile = inputfile
+        self.header = header
+        self.delimiter = delimiter
+        self.encoding = encoding
+
+    def open(self):
+        '''
+        :return: the CSV file, opened for reading with the detected encoding
+        '''
+        return open(self.inputfile, encoding=self.encoding, newline='')
+
+    def dict_reader(self, csvfile):
+        '''
+        :param csvfile: file returned by CsvProbe.open
+        :return: csv.DictReader using the detected delimiter
+        '''
+        return csv.DictReader(csvfile, delimiter=self.delimiter)
+
+csv_probes = {}
+
+def probe_csv(inputfile, enc='utf-8', delim=None):
+    '''
+    Reads the first record of a CSV file to find its header, delimiter and encoding. Results are cached
+    until the file is modified, so the file is only probed once per run however many readers need it.
+    :param inputfile: path of CSV file
+    :param enc: encoding of CSV file, if it does not start with a byte order mark
+    :param delim: delimiter of CSV file; if None, it is detected from the header (e.g. ';' in Springer reports)
+    :return: CsvProbe
+    '''
+    stat = os.stat(inputfile)
+    key = (os.path.abspath(inputfile), stat.st_size, stat.st_mtime_ns, enc, delim)
+    if key in csv_probes:
+        return csv_probes[key]
+
+    with open(inputfile, 'rb') as f:
+        start = f.read(4)
+    encoding = enc
+    for bom, bom_encoding in BOMS:
+        if start.startswith(bom):
+            encoding = bom_encoding
+            break
+
+    with open(inputfile, encoding=encoding, newline='') as csvfile:
+        if delim is None:
+            first_line = csvfile.readline()
+            try:
+                delim = csv.Sniffer().sniff(first_line, delimiters=',;\t|').delimiter
+            except csv.Error:
+                delim = ','
+            csvfile.seek(0)
+        header = next(csv.reader(csvfile, delimiter=delim), [])
+
+    probe = CsvProbe(inputfile, header, delim, encoding)
+    csv_probes[key] = probe
+    return probe
+
+csv_headers = {}
+
+def extract_csv_header(inputfile, enc = 'utf-8', delim = ','):
+    '''
+    This function returns a list of the fields contained in the header (first row) of
+    a CSV file. Only the first row is read, and the result is cached until the file is modified.
+    Unlike probe_csv, enc and delim are used as given
+    :param inputfile: path of CSV file
+    :param enc: encoding of CSV file
+    :param delim: delimiter of CSV file
+    '''
+    stat = os.stat(inputfile)
+    key = (os.path.abspath(inputfile), stat.st_size, stat.st_mtime_ns, enc, delim)
+    if key not in csv_headers:
+        with open(inputfile, encoding = enc) as csvfile:
+            headerreader = csv.reader(csvfile, delimiter=delim)
+            csv_headers[key] = next(headerreader, [])
+    return(list(csv_headers[key]))
@@ -1899,6 +1899,205 @@ AGGREGATED_PAYMENTS = {
     # ],
 }
 
+# Rules used by ReferenceResolver to find the zd ticket of a payment, in the order they are tried
+AGGREGATED_PAYMENT_RULE = 'aggregated payment'
+ZD_NUMBER_RULE = 'zd number in description'
+OA_NUMBER_RULE = 'oa number in description'
+MANUAL_INVOICE_RULE = 'invoice number in INVOICE2ZD_NUMBER'
+MANUAL_DESCRIPTION_RULE = 'description in DESCRIPTION2ZD_NUMBER'
+INVOICE_RULE = 'invoice number in invoice2zd_dict'
+INVOICE_IN_DESCRIPTION_RULE = 'invoice number in description'
+
+# Separators accepted between "ZD" and the number of a ticket in a payment description: up to three spaces or
+# hyphens by plug_in_payment_data, and at most one by invoice-fetcher
+ZD_SEPARATOR_PATTERN = r'[ \-]{0,3}'
+SINGLE_ZD_SEPARATOR_PATTERN = r'[ \-]?'
+# Finds ZD numbers, OA numbers (both in any case) and invoice numbers (after ", inv:") in a payment description in
+# a single pass. The lookahead makes each match zero-width, so that a reference inside another one (e.g. a ZD
+# number inside an invoice number) is also found. Format it with the separator accepted after "ZD"
+REFERENCE_PATTERN = (r'(?=(?P<zd>(?i:ZD){}[0-9]{{4,8}})|(?P<oa>(?i:OA)[ \-]?[0-9]{{4,8}})|'
+                     r', inv:(?P<invoice>[a-zA-Z0-9\-]{{4,}}))')
+REFERENCE_REGEX = re.compile(REFERENCE_PATTERN.format(ZD_SEPARATOR_PATTERN))
+
+class Resolution():
+    '''
+    The zd ticket matched to a payment by ReferenceResolver, and how it was matched
+    '''
+    def __init__(self, description):
+        '''
+        :param description: description of the payment, after correcting typos (see OA_NUMBER_TYPOS)
+        :param self.zd_number: zd number matched to the payment, or None if no match was found
+        :param self.rule: the rule that matched the payment (e.g. ZD_NUMBER_RULE), or None
+        :param self.aggregated_breakdowns: list of Aggregated_breakdown if rule is AGGREGATED_PAYMENT_RULE
+        :param self.unmatched_oa_number: OA number found in description but not linked to any zd ticket
+        :param self.messages: list of tuples (logging level, message, args) describing how the payment was matched
+        '''
+        self.description = description
+        self.zd_number = None
+        self.rule = None
+        self.aggregated_breakdowns = []
+        self.unmatched_oa_number = None
+        self.messages = []
+
+    def log(self, level, message, *args):
+        self.messages.append((level, message, args))
+
+class ReferenceResolver():
+    '''
+    Resolves payments in CUFS reports to zd numbers by trying, in order: AGGREGATED_PAYMENTS, OA_NUMBER_TYPOS,
+    a ZD number in the description, an OA number in the description (manual_oa2zd_dict, then oa2zd_dict),
+    INVOICE2ZD_NUMBER, DESCRIPTION2ZD_NUMBER, invoice2zd_dict and an invoice number in the description.
+
+    Results are memoised by (description, invoice number), and references found in descriptions by description,
+    because the same descriptions (e.g. bank charges, recurring suppliers) appear in many payments.
+    '''
+    def __init__(self, oa2zd_dict={}, invoice2zd_dict={}, manual_oa2zd_dict={}, zd_separator=ZD_SEPARATOR_PATTERN):
+        '''
+        :param oa2zd_dict: dictionary of lists of zd numbers indexed by OA number (zendesk.Parser.oa2zd_dict)
+        :param invoice2zd_dict: dictionary of lists of zd numbers indexed by lower case invoice number
+                (zendesk.Parser.invoice2zd_dict)
+        :param manual_oa2zd_dict: dictionary of zd numbers indexed by OA number, overriding oa2zd_dict
+        :param zd_separator: pattern of the separators accepted between "ZD" and a ZD number (e.g.
+                SINGLE_ZD_SEPARATOR_PATTERN)
+        '''
+        self.oa2zd_dict = oa2zd_dict
+        self.invoice2zd_dict = invoice2zd_dict
+        self.manual_oa2zd_dict = manual_oa2zd_dict
+        if zd_separator == ZD_SEPARATOR_PATTERN:
+            self.reference_regex = REFERENCE_REGEX
+        else:
+            self.reference_regex = re.compile(REFERENCE_PATTERN.format(zd_separator))
+        self.memo = {}
+        self.references = {}
+
+    def resolve(self, description, invoice_number):
+        '''
+        :param description: description of the payment (field cufs_map.oa_number of the report)
+        :param invoice_number: invoice number of the payment (field cufs_map.invoice_field of the report)
+        :return: Resolution; the same object is returned for repeated (description, invoice_number) pairs, so
+                do not modify it
+        '''
+        key = (description, invoice_number)
+        resolution = self.memo.get(key)
+        if resolution is None:
+            resolution = self._resolve(description, invoice_number)
+            self.memo[key] = resolution
+        return resolution
+
+    def find_references(self, description):
+        '''
+        :param description: description of the payment
+        :return: tuple (first ZD number, first OA number, first invoice number) found in description, with ZD and
+                OA in upper case; each is None if not found
+        '''
+        references = self.references.get(description)
+        if references is None:
+            references = self.references[description] = self._find_references(description)
+        return references
+
+    def _find_references(self, description):
+        zd = oa = invoice = None
+        for m in self.reference_regex.finditer(description):
+            kind = m.lastgroup
+            if (kind == 'zd') and (zd is None):
+                zd = m.group('zd').upper()
+            elif (kind == 'oa') and (oa is None):
+                oa = m.group('oa').upper()
+            elif (kind == 'invoice') and (invoice is None):
+                invoice = m.group('invoice')
+            if zd and oa and invoice:
+                break
+        return zd, oa, invoice
+
+    def _resolve(self, description, invoice_number):
+        if description in AGGREGATED_PAYMENTS.keys():
+            # Transaction aggregating more than one article (e.g. invoice for several articles)
+            # Requires manual break down of charges
+            r = Resolution(description)
+            r.rule = AGGREGATED_PAYMENT_RULE
+            r.aggregated_breakdowns = AGGREGATED_PAYMENTS[description]
+            r.log(logging.DEBUG, 'Aggregated transaction detected ({}). Processing it manually', description)
+            return r
+
+        if description in OA_NUMBER_TYPOS.keys():
+            corrected = OA_NUMBER_TYPOS[description]
+            r = Resolution(corrected)
+            r.log(logging.DEBUG, 'Corrected typo in OA number; from {} to {}', description, corrected)
+            description = corrected
+        else:
+            r = Resolution(description)
+
+        zd_reference, oa_reference, invoice_in_description = self.find_references(description)
+        raw_invoice_number = invoice_number
+        invoice_number = invoice_number.strip()
+
+        if zd_reference:
+            r.zd_number = zd_reference.replace(" ","-").strip('ZDzd -')
+            r.rule = ZD_NUMBER_RULE
+            r.log(logging.DEBUG, 'Matched row to ZD number {}', r.zd_number)
+
+        elif oa_reference:
+            oa_number = oa_reference.replace("OA" , "OA-").replace(" ","").replace('--', '-')
+            r.log(logging.DEBUG, 'Matched row to OA number {}', oa_number)
+            if oa_number in self.manual_oa2zd_dict.keys():
+                r.zd_number = self.manual_oa2zd_dict[oa_number]
+            elif oa_number in self.oa2zd_dict.keys():
+                zd_number_list = self.oa2zd_dict[oa_number]
+                if len(zd_number_list) > 1:
+                    r.log(logging.ERROR, 'More than one ZD number is linked to OA number {} {}. Using '
+                                         'earliest ZD ticket as match to avoid "TypeError: unhashable type: '
+                                         'list". Map OA number manually to ZD number using '
+                                         'MANUAL_OA2ZD_DICT to solve this error', oa_number, zd_number_list)
+                    r.zd_number = str(sorted([ int(x) for x in zd_number_list ])[0])
+                else:
+                    r.zd_number = zd_number_list[0]
+            else:
+                r.unmatched_oa_number = oa_number
+            if r.zd_number:
+                r.rule = OA_NUMBER_RULE
+                r.log(logging.DEBUG, 'Matched row to ZD number {} via OA number {}', r.zd_number, oa_number)
+
+        elif invoice_number in INVOICE2ZD_NUMBER.keys():
+            r.zd_number = INVOICE2ZD_NUMBER[invoice_number]
+            r.rule = MANUAL_INVOICE_RULE
+            r.log(logging.DEBUG, 'Matched row to ZD number {} via invoice number {}', r.zd_number,
+                  raw_invoice_number)
+
+        elif description.strip() in DESCRIPTION2ZD_NUMBER.keys():
+            r.zd_number = DESCRIPTION2ZD_NUMBER[description.strip()]
+            r.rule = MANUAL_DESCRIPTION_RULE
+            r.log(logging.DEBUG, 'Matched row to ZD number {} via description: {}', r.zd_number, description)
+
+        elif invoice_number.lower() in self.invoice2zd_dict.keys():
+            zd_number_list = self.invoice2zd_dict[invoice_number.lower()]
+            if len(zd_number_list) > 1:
+                r.log(logging.WARNING, 'More than one ZD ticket ({}) matched invoice number {}. Arbitrarily '
+                                       'using the first match', zd_number_list, invoice_number)
+            r.zd_number = zd_number_list[0]
+            r.rule = INVOICE_RULE
+            r.log(logging.DEBUG, 'Matched row to ZD number {} via invoice number {} resolved with '
+                                 'invoice2zd_dict', r.zd_number, raw_invoice_number)
+
+        elif invoice_in_description:
+            inv_n = invoice_in_description
+            r.log(logging.DEBUG, 'Invoice number found in description field: {}', inv_n)
+            if inv_n in INVOICE2ZD_NUMBER.keys():
+                r.zd_number = INVOICE2ZD_NUMBER[inv_n]
+                r.rule = INVOICE_IN_DESCRIPTION_RULE
+                r.log(logging.DEBUG, 'Matched row to ZD number {} via invoice number {} '
+                                     'found in description {}', r.zd_number, inv_n, description)
+            elif inv_n.lower() in self.invoice2zd_dict.keys():
+                zd_number_list = self.invoice2zd_dict[inv_n.lower()]
+                if len(zd_number_list) > 1:
+                    r.log(logging.WARNING, 'More than one ZD ticket ({}) matched invoice number {}. '
+                                           'Arbitrarily using the first match', zd_number_list, inv_n)
+                r.zd_number = zd_number_list[0]
+                r.rule = INVOICE_IN_DESCRIPTION_RULE
+                r.log(logging.DEBUG, 'Matched row to ZD number {} via invoice number {} found in '
+                                     'description {} resolved with invoice2zd_dict', r.zd_number, inv_n,
+                      description)
+        return r
+
 TOTAL_APC_FIELD = 'Total APC amount'
 
 class CoafFieldsMapping():
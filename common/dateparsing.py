@@ -0,0 +1,161 @@
+import datetime
+import logging
+import re
+
+import dateutil.parser
+
+# create logger
+logger = logging.getLogger(__name__)
+
+# Upper limit for the number of distinct strings memoised by each DateNormaliser
+MEMO_SIZE = 100000
+
+TIME_REGEX = r'(?:[T ](?:[01]?\d|2[0-3]):[0-5]\d(?::[0-5]\d(?:\.\d{1,6})?)?Z?)?'
+
+# Date formats that can be converted without dateutil. Each regex captures three parts, in the order they appear
+# in the string; strings that match none of them are passed on to dateutil
+YEAR_FIRST = 'year first'  # e.g. 2016-04-21, 2016/04/21, 2016-04-21T10:11:12Z
+YEAR_LAST = 'year last'  # e.g. 21/04/2016, 04/21/2016, 21.04.2016
+MONTH_NAME = 'month name'  # e.g. 21-APR-2016 (CUFS), 21 April 2016
+FAST_FORMATS = [
+    (YEAR_FIRST, re.compile(r'\s*(\d{4})([-/])(\d{1,2})\2(\d{1,2})' + TIME_REGEX + r'\s*$')),
+    (YEAR_LAST, re.compile(r'\s*(\d{1,2})([-/.])(\d{1,2})\2(\d{4})\s*$')),
+    (MONTH_NAME, re.compile(r'\s*(\d{1,2})([- ])([A-Za-z]{3,9})\2(\d{4})\s*$')),
+]
+
+
+class DateNormaliser():
+    '''
+    Converts date strings to format YYYY-MM-DD, giving exactly the same results as dateutil.parser.parse
+    with the same dayfirst option.
+
+    Use one instance per column of dates. The format of the column is inferred from the first values
+    converted, and tried first for the following values. Values in the common formats listed in FAST_FORMATS
+    are converted by applying dateutil's own rules for ambiguous day and month numbers, so that dateutil is
+    only called for the remaining outliers. All results are memoised, because the same dates are repeated
+    across many tickets and payments.
+    '''
+    def __init__(self, dayfirst=False):
+        '''
+        :param dayfirst: as dateutil.parser.parserinfo(dayfirst): whether to interpret the first value
+                in an ambiguous date (e.g. 01/05/09) as the day (True) or month (False)
+        '''
+        self.dayfirst = dayfirst
+        self.parserinfo = dateutil.parser.parserinfo(dayfirst=dayfirst)
+        self.formats = list(FAST_FORMATS)
+        self.inferred_format = None
+        self.memo = {}
+        self.dateutil_calls = 0
+
+    def __call__(self, string):
+        '''
+        :param string: original date string
+        :return: converted date or empty string if failed to convert
+        '''
+        try:
+            return self.memo[string]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable; let dateutil deal with it
+            return self.convert_with_dateutil(string)
+        d = self.convert(string)
+        if len(self.memo) >= MEMO_SIZE:
+            self.memo.clear()
+        self.memo[string] = d
+        return d
+
+    def convert(self, string):
+        '''
+        Converts a date string without memoisation
+        :param string: original date string
+        :return: converted date or empty string if failed to convert
+        '''
+        if isinstance(string, str):
+            for position, (name, regex) in enumerate(self.formats):
+                m = regex.match(string)
+                if m:
+                    parts = self.resolve(name, m.group(1), m.group(3), m.group(4))
+                    if parts is None:
+                        break
+                    if position:
+                        # the format of this column changed (or was inferred); try it first from now on
+                        self.formats.insert(0, self.formats.pop(position))
+                    if name != self.inferred_format:
+                        logger.debug('Inferred date format: {} (from {})'.format(name, string))
+                        self.inferred_format = name
+                    return self.format_date(*parts)
+        return self.convert_with_dateutil(string)
+
+    def resolve(self, name, first, second, third):
+        '''
+        Works out which part of a date is the year, month and day as dateutil would
+        (see dateutil.parser._ymd.resolve_ymd)
+        :param name: name of the matching format in FAST_FORMATS
+        :param first: first part of the date string
+        :param second: second part of the date string
+        :param third: third part of the date string
+        :return: tuple (year, month, day) of integers, or None if the string must be left to dateutil
+        '''
+        if name == YEAR_FIRST:
+            year, a, b = int(first), int(second), int(third)
+            if self.dayfirst and b <= 12:
+                return year, b, a
+            return year, a, b
+        elif name == YEAR_LAST:
+            a, b, year = int(first), int(second), int(third)
+            if a > 31:
+                return None
+            if a > 12 or (self.dayfirst and b <= 12):
+                return year, b, a
+            return year, a, b
+        elif name == MONTH_NAME:
+            month = self.parserinfo.month(second)
+            if month is None:
+                return None
+            return int(third), month, int(first)
+
+    @staticmethod
+    def format_date(year, month, day):
+        try:
+            return datetime.date(year, month, day).strftime('%Y-%m-%d')
+        except ValueError:
+            return ''
+
+    def convert_with_dateutil(self, string):
+        '''
+        Function to convert dates to format YYYY-MM-DD using dateutil
+        :param string: original date string
+        :return: converted date or empty string if failed to convert
+        '''
+        self.dateutil_calls += 1
+        try:
+            d = dateutil.parser.parse(string, self.parserinfo)
+        except ValueError:
+            d = datetime.datetime(1, 1, 1)
+        d = d.strftime('%Y-%m-%d')
+        if d == '1-01-01':
+            return('')
+        else:
+            return(d)
+
+
+normalisers = {}
+
+def get_normaliser(dateutil_options=None, column=None):
+    '''
+    Returns a shared DateNormaliser
+    :param dateutil_options: None or a dateutil.parser.parserinfo; only its dayfirst option is used
+    :param column: name of the column of dates to be converted, so that each column gets its own inferred format
+    :return: DateNormaliser, or None if dateutil_options cannot be reproduced by DateNormaliser
+    '''
+    if dateutil_options is None:
+        dayfirst = False
+    elif (type(dateutil_options) is dateutil.parser.parserinfo) and not dateutil_options.yearfirst:
+        dayfirst = dateutil_options.dayfirst
+    else:
+        return None
+    key = (dayfirst, column)
+    if key not in normalisers:
+        normalisers[key] = DateNormaliser(dayfirst=dayfirst)
+    return normalisers[key]
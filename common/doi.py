@@ -0,0 +1,51 @@
+'''
+Normalisation of DOIs, so that the same DOI written in different ways (as a resolver URL, with a "doi:" prefix, in
+upper or lower case) is indexed and looked up under a single key
+'''
+
+import functools
+import re
+
+# Prefixes found before DOIs in Zendesk, Apollo and publishers' reports; removed wherever they appear
+DOI_CLEANUP = ['http://dx.doi.org/', 'https://doi.org/', 'http://dev.biologists.org/lookup/doi/', 'http://www.hindawi.com/journals/jdr/aip/2848759/']
+# DOIs mistyped in Zendesk, mapped to the correct DOI
+DOI_FIX = {'0.1136/jmedgenet-2016-104295':'10.1136/jmedgenet-2016-104295'}
+
+# Number of DOIs whose cleaned up and normalised forms are remembered (see clean_doi and normalise_doi)
+DOI_CACHE_SIZE = 200000
+
+# Anything written before a DOI: "doi:", "info:doi/" and similar prefixes, DOI resolvers (doi.org, dx.doi.org) and
+# any other URL ending right before a DOI (e.g. https://onlinelibrary.wiley.com/doi/full/10.1002/...), as well as
+# the entries of DOI_CLEANUP. Matched without regard to case; only contains ASCII, so that it can be compiled for
+# bytes too (see zendesk.Parser._semi_join_metadata_rows)
+DOI_PREFIX_PATTERN = '|'.join([
+    r'^\s*(?:urn:|info:)?doi\s*[:/]\s*',
+    r'(?:https?://)?(?:dx\.|www\.)?doi\.org/',
+    r'https?://\S*?/(?=10\.\d)',
+] + [re.escape(c) for c in DOI_CLEANUP])
+DOI_PREFIX_REGEX = re.compile(DOI_PREFIX_PATTERN, re.I)
+
+
+@functools.lru_cache(maxsize=DOI_CACHE_SIZE)
+def clean_doi(doi):
+    '''
+    Removes prefixes and resolver URLs (see DOI_PREFIX_PATTERN) and surrounding whitespace from a DOI, and
+    corrects known typos (see DOI_FIX). The case of the DOI is kept, so the result is fit for display
+    :param doi: DOI as written in a source file
+    :return: cleaned up DOI
+    '''
+    doi = DOI_PREFIX_REGEX.sub('', doi).strip()
+    return DOI_FIX.get(doi, doi)
+
+
+@functools.lru_cache(maxsize=DOI_CACHE_SIZE)
+def normalise_doi(doi):
+    '''
+    DOIs are case insensitive, so the key of a DOI is its cleaned up form (see clean_doi), case folded. Every
+    dictionary indexed by DOI (e.g. zendesk.Parser.doi2zd_dict, apollo.Parser.doi2handle, Europe PMC indexes) uses
+    these keys, and DOIs are normalised the same way before being looked up
+    :param doi: DOI as written in a source file
+    :return: the key of the DOI
+    '''
+    key = clean_doi(doi).casefold()
+    return DOI_FIX.get(key, key)
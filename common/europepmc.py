@@ -0,0 +1,271 @@
+import array
+import csv
+import hashlib
+import heapq
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from common.doi import normalise_doi
+
+# create logger
+logger = logging.getLogger(__name__)
+
+# Indexes of Europe PMC PMID_PMCID_DOI maps (https://europepmc.org/downloads) are saved here (see EuropePmcIndex)
+EUROPEPMC_INDEX_FOLDER = os.path.join(os.path.expanduser("~"), ".OATs", "cache", "europepmc")
+
+# Identifies index files; increase the version if the format or the normalisation of DOIs (see doi.normalise_doi)
+# changes, so that old indexes are rebuilt
+INDEX_MAGIC = b'OATSPMC3'
+# The index starts with INDEX_MAGIC followed by the number of records and the length of the metadata (JSON)
+INDEX_PRELUDE = struct.Struct('<8sQQ')
+OFFSET_TYPECODE = 'Q'
+OFFSET_SIZE = 8
+
+# Number of rows sorted in memory at a time while building an index; larger maps are merged from sorted runs
+SORT_RUN_ROWS = 1000000
+# Rows whose DOI is one of these are not indexed (Zendesk DOIs are never indexed with these values either)
+EMPTY_DOIS = ['', '-']
+
+RUN_RECORD = struct.Struct('<IIQ')
+# Position of a row in the map, stored after the DOI of each record
+POSITION = struct.Struct('<Q')
+
+
+def source_signature(csv_path):
+    '''
+    :param csv_path: path of a Europe PMC map
+    :return: dictionary identifying the version of the map; an index is rebuilt when this changes
+    '''
+    stat = os.stat(csv_path)
+    return {'path': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class EuropePmcIndex():
+    '''
+    Sorted index of the rows of a Europe PMC PMID_PMCID_DOI map by DOI, saved to disk and memory-mapped, so that
+    looking up a DOI reads only the few pages visited by a binary search instead of scanning the whole map.
+
+    The index file contains INDEX_PRELUDE, the metadata of the index (JSON), a table of fixed-size offsets
+    of records sorted by DOI and the records themselves. Each record is the normalised DOI, a NUL byte, the
+    position of the row in the map (POSITION) and the values of the row (JSON). Rows sharing a DOI are kept in
+    the order of the map.
+    '''
+    def __init__(self, index_path):
+        '''
+        :param index_path: path of an index file written by build
+        '''
+        self.index_path = index_path
+        self.file = open(index_path, 'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            self.file.close()
+            raise ValueError('{} is not a Europe PMC index'.format(index_path))
+        magic, self.count, meta_length = INDEX_PRELUDE.unpack_from(self.mm, 0)
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise ValueError('{} is not a Europe PMC index'.format(index_path))
+        self.meta = json.loads(self.mm[INDEX_PRELUDE.size:INDEX_PRELUDE.size + meta_length].decode('utf-8'))
+        self.header = self.meta['header']
+        self.offsets_start = INDEX_PRELUDE.size + meta_length
+        self.data_start = self.offsets_start + OFFSET_SIZE * self.count
+        self.offsets = memoryview(self.mm)[self.offsets_start:self.data_start].cast(OFFSET_TYPECODE)
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if getattr(self, 'offsets', None) is not None:
+            self.offsets.release()
+            self.offsets = None
+        self.mm.close()
+        self.file.close()
+
+    def _key(self, i):
+        position = self.data_start + self.offsets[i]
+        return self.mm[position:self.mm.find(b'\0', position)]
+
+    def _row(self, i):
+        '''
+        :return: tuple (position of the row in the map, row)
+        '''
+        position = self.data_start + self.offsets[i]
+        end = self.data_start + self.offsets[i + 1] if i + 1 < self.count else len(self.mm)
+        start = self.mm.find(b'\0', position) + 1
+        map_position = POSITION.unpack_from(self.mm, start)[0]
+        values = json.loads(self.mm[start + POSITION.size:end].decode('utf-8'))
+        if len(values) < len(self.header):
+            values = values + [None] * (len(self.header) - len(values))
+        row = dict(zip(self.header, values))
+        if len(values) > len(self.header):
+            # like csv.DictReader
+            row[None] = values[len(self.header):]
+        return map_position, row
+
+    def lookup(self, doi):
+        '''
+        :param doi: the DOI to look up; it is normalised like the DOIs in the map
+        :return: list of rows of the map with this DOI, as csv.DictReader would return them, in the order of the map
+        '''
+        return [row for position, row in self.lookup_with_positions(doi)]
+
+    def lookup_with_positions(self, doi):
+        '''
+        :param doi: the DOI to look up; it is normalised like the DOIs in the map
+        :return: list of tuples (position of the row in the map, counting from 0, row) of the rows of the map with
+                this DOI (see lookup); rows found for several DOIs can be sorted by position to merge them in the
+                order of the map
+        '''
+        key = normalise_doi(doi).encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        rows = []
+        while (low < self.count) and (self._key(low) == key):
+            rows.append(self._row(low))
+            low += 1
+        return rows
+
+    @staticmethod
+    def build(csv_path, index_path, matching_field='DOI', file_encoding='utf-8', run_rows=SORT_RUN_ROWS):
+        '''
+        Writes an index of a Europe PMC map. Rows are sorted in runs of run_rows rows, saved to temporary
+        files and merged, so the map does not need to fit in memory
+        :param csv_path: path of the Europe PMC map (CSV)
+        :param index_path: path of the index file to write
+        :param matching_field: column of the map containing DOIs
+        :param file_encoding: encoding of the map
+        :param run_rows: number of rows sorted in memory at a time
+        '''
+        signature = source_signature(csv_path)
+        index_folder = os.path.dirname(os.path.abspath(index_path))
+        os.makedirs(index_folder, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=index_folder) as temp_folder:
+            runs = []
+            with open(csv_path, encoding=file_encoding) as csvfile:
+                reader = csv.reader(csvfile)
+                header = next(reader, [])
+                match_position = {name: i for i, name in enumerate(header)}[matching_field]
+                run = []
+                # position of the next row in the map, counting rows as csv.DictReader would (i.e. not blank lines)
+                sequence = 0
+                for values in reader:
+                    if not values:
+                        continue
+                    sequence += 1
+                    if len(values) <= match_position:
+                        continue
+                    key = normalise_doi(values[match_position])
+                    if key in EMPTY_DOIS:
+                        continue
+                    # the sequence number keeps rows sharing a DOI in the order of the map
+                    run.append((key.encode('utf-8'), sequence - 1,
+                                json.dumps(values, ensure_ascii=False).encode('utf-8')))
+                    if len(run) >= run_rows:
+                        runs.append(EuropePmcIndex._write_run(run, temp_folder, len(runs)))
+                        run = []
+                if run or not runs:
+                    runs.append(EuropePmcIndex._write_run(run, temp_folder, len(runs)))
+
+            data_path = os.path.join(temp_folder, 'data')
+            offsets = array.array(OFFSET_TYPECODE)
+            with open(data_path, 'wb') as data:
+                run_files = [open(r, 'rb') for r in runs]
+                try:
+                    position = 0
+                    for (key, sequence), record in heapq.merge(*[EuropePmcIndex._read_run(f)
+                                                                  for f in run_files]):
+                        offsets.append(position)
+                        data.write(key)
+                        data.write(b'\0')
+                        data.write(POSITION.pack(sequence))
+                        data.write(record)
+                        position += len(key) + 1 + POSITION.size + len(record)
+                finally:
+                    for f in run_files:
+                        f.close()
+
+            meta = dict(signature, header=header, matching_field=matching_field)
+            meta = json.dumps(meta).encode('utf-8')
+            temp_index_path = os.path.join(temp_folder, 'index')
+            with open(temp_index_path, 'wb') as f:
+                f.write(INDEX_PRELUDE.pack(INDEX_MAGIC, len(offsets), len(meta)))
+                f.write(meta)
+                if offsets.itemsize != OFFSET_SIZE:
+                    raise ValueError('Unsupported platform: array typecode {} is not {} bytes'.format(
+                        OFFSET_TYPECODE, OFFSET_SIZE))
+                offsets.tofile(f)
+                with open(data_path, 'rb') as data:
+                    shutil.copyfileobj(data, f, 1024 * 1024)
+            os.replace(temp_index_path, index_path)
+        logger.info('Indexed {} rows of {} in {}'.format(len(offsets), csv_path, index_path))
+
+    @staticmethod
+    def _write_run(run, temp_folder, number):
+        run.sort()
+        path = os.path.join(temp_folder, 'run{}'.format(number))
+        with open(path, 'wb') as f:
+            for key, sequence, record in run:
+                f.write(RUN_RECORD.pack(len(key), len(record), sequence))
+                f.write(key)
+                f.write(record)
+        return path
+
+    @staticmethod
+    def _read_run(f):
+        '''
+        :param f: run file written by _write_run, opened in binary mode
+        :return: generator of tuples ((key, sequence number), record), in sorted order
+        '''
+        while True:
+            prefix = f.read(RUN_RECORD.size)
+            if not prefix:
+                return
+            key_length, record_length, sequence = RUN_RECORD.unpack(prefix)
+            key = f.read(key_length)
+            yield (key, sequence), f.read(record_length)
+
+
+def get_europepmc_index(csv_path, index_folder=EUROPEPMC_INDEX_FOLDER, matching_field='DOI', file_encoding='utf-8'):
+    '''
+    Returns an EuropePmcIndex of csv_path, building it first if there is no index of this version of the map
+    (i.e. if the map was replaced by a newer dump since the index was built)
+    :param csv_path: path of the Europe PMC map (CSV)
+    :param index_folder: folder where indexes are saved
+    :param matching_field: see EuropePmcIndex.build
+    :param file_encoding: see EuropePmcIndex.build
+    :return: EuropePmcIndex; close it when done
+    '''
+    index_path = os.path.join(index_folder, '{}.idx'.format(
+        hashlib.sha1(os.path.abspath(csv_path).encode('utf-8')).hexdigest()))
+    if os.path.exists(index_path):
+        try:
+            index = EuropePmcIndex(index_path)
+        except (OSError, ValueError) as e:
+            logger.warning('Could not open index {}: {}'.format(index_path, e))
+        else:
+            meta = index.meta
+            if (all(meta.get(k) == v for k, v in source_signature(csv_path).items())
+                    and meta.get('matching_field') == matching_field):
+                return index
+            index.close()
+            logger.info('{} changed since it was indexed'.format(csv_path))
+    logger.info('Indexing {}; this is only done once for each version of the file'.format(csv_path))
+    EuropePmcIndex.build(csv_path, index_path, matching_field, file_encoding)
+    return EuropePmcIndex(index_path)
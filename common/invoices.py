@@ -0,0 +1,260 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+
+# create logger
+logger = logging.getLogger(__name__)
+
+# Manifests of invoice folders are cached here (see InvoiceFileIndex)
+INVOICE_MANIFEST_FOLDER = os.path.join(os.path.expanduser("~"), ".OATs", "cache", "invoices")
+
+# Quality of a match between an invoice file and a ticket (see InvoiceFileIndex.find)
+GOOD_MATCH = 10  # filename contains the invoice number and the OA or ZD number
+SATISFACTORY_MATCH = 5  # filename contains the invoice number alone
+
+# Below this number of invoice numbers, filenames are searched for each of them separately rather than with a
+# PatternMatcher
+MATCHER_MIN_PATTERNS = 20
+
+
+class PatternMatcher():
+    '''
+    Aho-Corasick automaton finding all occurrences of a set of patterns in a text in a single pass, however
+    many patterns there are.
+    '''
+    def __init__(self, patterns):
+        '''
+        :param patterns: iterable of non-empty strings to search for
+        '''
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for p in patterns:
+            self._add(p)
+        self._link()
+
+    def _add(self, pattern):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(set())
+            state = next_state
+        self.output[state].add(pattern)
+
+    def _link(self):
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                f = self.fail[state]
+                while f and (char not in self.goto[f]):
+                    f = self.fail[f]
+                self.fail[next_state] = self.goto[f].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def search(self, text):
+        '''
+        :param text: the text to scan
+        :return: set of patterns found in text
+        '''
+        found = set()
+        state = 0
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        for char in text:
+            while state and (char not in goto[state]):
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+class InvoiceFileIndex():
+    '''
+    Index of the files in a folder of invoices (e.g. PaymentsAndCommitments/Invoices), so that invoice
+    files can be found by invoice, OA- and ZD numbers without walking the folder for every invoice.
+
+    The list of files is saved in a JSON manifest. When the index is loaded again, only folders whose
+    modification time changed are listed again.
+    '''
+    def __init__(self, invoicefolder, manifest_folder=INVOICE_MANIFEST_FOLDER):
+        '''
+        :param invoicefolder: the path to the folder where invoices are filed
+        :param manifest_folder: folder where manifests are saved; if None, no manifest is used
+        '''
+        self.invoicefolder = invoicefolder
+        self.manifest_filename = None
+        if manifest_folder is not None:
+            self.manifest_filename = os.path.join(manifest_folder, '{}.json'.format(
+                hashlib.sha1(os.path.abspath(invoicefolder).encode('utf-8')).hexdigest()))
+        self.folders = {}
+        self.files = []
+        self.names = {}
+        self.invoice_matches = {}
+
+    def load(self):
+        '''
+        Lists the files in self.invoicefolder, reusing the manifest for unchanged folders, and saves the
+        updated manifest
+        '''
+        previous = {}
+        if self.manifest_filename and os.path.exists(self.manifest_filename):
+            try:
+                with open(self.manifest_filename, encoding='utf-8') as f:
+                    previous = json.load(f)['folders']
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning('Could not load manifest {}: {}'.format(self.manifest_filename, e))
+        self.folders = {}
+        self.files = []
+        self._walk(self.invoicefolder, previous)
+        self.names = {}
+        self.invoice_matches = {}
+        logger.info('Indexed {} files in {}'.format(len(self.files), self.invoicefolder))
+        if self.manifest_filename:
+            try:
+                os.makedirs(os.path.dirname(self.manifest_filename), exist_ok=True)
+                temp_filename = self.manifest_filename + '.tmp'
+                with open(temp_filename, 'w', encoding='utf-8') as f:
+                    json.dump({'invoicefolder': self.invoicefolder, 'folders': self.folders}, f)
+                os.replace(temp_filename, self.manifest_filename)
+            except OSError as e:
+                logger.warning('Could not save manifest {}: {}'.format(self.manifest_filename, e))
+
+    def _walk(self, folder, previous):
+        '''
+        Adds the files in folder and its subfolders to self.files, in the same order as
+        os.walk(folder, topdown=False)
+        :param folder: path of the folder
+        :param previous: dictionary of folders in the previous manifest
+        '''
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            return
+        entry = previous.get(folder)
+        if (entry is None) or (entry['mtime'] != mtime):
+            files = []
+            walk_dirs = []
+            try:
+                with os.scandir(folder) as it:
+                    for e in it:
+                        try:
+                            is_dir = e.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            # like os.walk, do not follow symbolic links to folders
+                            if not e.is_symlink():
+                                walk_dirs.append(e.name)
+                        else:
+                            files.append(e.name)
+            except OSError:
+                return
+            entry = {'mtime': mtime, 'dirs': walk_dirs, 'files': files}
+        self.folders[folder] = entry
+        for d in entry['dirs']:
+            self._walk(os.path.join(folder, d), previous)
+        self.files.extend((folder, f) for f in entry['files'])
+
+    def _names(self, case_sensitive):
+        '''
+        :return: list of filenames in self.files, upper cased unless case_sensitive
+        '''
+        if case_sensitive not in self.names:
+            if case_sensitive:
+                self.names[case_sensitive] = [f for _, f in self.files]
+            else:
+                self.names[case_sensitive] = [f.upper() for _, f in self.files]
+        return self.names[case_sensitive]
+
+    def prepare(self, invoice_numbers, case_sensitive=False):
+        '''
+        Finds the files containing each of invoice_numbers in a single scan of all filenames. Call this before
+        calling find for many invoice numbers
+        :param invoice_numbers: iterable of invoice numbers
+        :param case_sensitive: as in find
+        '''
+        matches = self.invoice_matches.setdefault(case_sensitive, {})
+        patterns = set()
+        for i in invoice_numbers:
+            i = i.strip()
+            if not case_sensitive:
+                i = i.upper()
+            if i and (i not in matches):
+                patterns.add(i)
+        if not patterns:
+            return
+        names = self._names(case_sensitive)
+        if len(patterns) < MATCHER_MIN_PATTERNS:
+            for p in patterns:
+                matches[p] = [position for position, name in enumerate(names) if p in name]
+            return
+        for p in patterns:
+            matches[p] = []
+        matcher = PatternMatcher(patterns)
+        for position, name in enumerate(names):
+            for p in matcher.search(name):
+                matches[p].append(position)
+
+    def find(self, invoice_number, oa_number='', zd_number='', case_sensitive=False):
+        '''
+        Finds invoice files whose filename contains invoice_number
+        :param invoice_number: the invoice number recorded in zendesk
+        :param oa_number: the OA-number recorded in zendesk
+        :param zd_number: the zendesk id of the ticket
+        :param case_sensitive: if False, numbers and filenames are compared in upper case
+        :return: list of tuples (path of file, match quality) in the order os.walk(topdown=False) lists them;
+                quality is GOOD_MATCH if the filename also contains oa_number or zd_number (an empty number
+                counts as contained if the other one is not empty), SATISFACTORY_MATCH otherwise
+        '''
+        invoice_number = invoice_number.strip()
+        oa_number = oa_number.strip()
+        zd_number = zd_number.strip()
+        if not case_sensitive:
+            invoice_number = invoice_number.upper()
+            oa_number = oa_number.upper()
+            zd_number = zd_number.upper()
+        names = self._names(case_sensitive)
+        if not invoice_number:
+            # contained in every filename
+            positions = range(len(names))
+        else:
+            self.prepare([invoice_number], case_sensitive)
+            positions = self.invoice_matches[case_sensitive][invoice_number]
+        results = []
+        for position in positions:
+            name = names[position]
+            if ((oa_number != '') or (zd_number != '')) and ((oa_number in name) or (zd_number in name)):
+                quality = GOOD_MATCH
+            else:
+                quality = SATISFACTORY_MATCH
+            folder, filename = self.files[position]
+            results.append((os.path.join(folder, filename), quality))
+        return results
+
+
+invoice_indexes = {}
+
+def get_invoice_index(invoicefolder, manifest_folder=INVOICE_MANIFEST_FOLDER):
+    '''
+    Returns a shared InvoiceFileIndex of invoicefolder, loading it on first use
+    :param invoicefolder: the path to the folder where invoices are filed
+    :param manifest_folder: see InvoiceFileIndex
+    :return: InvoiceFileIndex
+    '''
+    key = os.path.abspath(invoicefolder)
+    if key not in invoice_indexes:
+        index = InvoiceFileIndex(invoicefolder, manifest_folder)
+        index.load()
+        invoice_indexes[key] = index
+    return invoice_indexes[key]
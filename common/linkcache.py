@@ -0,0 +1,206 @@
+'''
+Cache of links between records of other datasets (e.g. rows of prepayment reports) and Zendesk tickets
+'''
+
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+from common.doi import normalise_doi
+from common.titlematch import canonical_title
+
+# create logger
+logger = logging.getLogger(__name__)
+
+LINK_CACHE_FILENAME = os.path.join(os.path.expanduser("~"), ".OATs", "cache", "links.sqlite3")
+
+# Increment this if the table of links or the way keys are normalised change; the cache is then emptied
+LINK_CACHE_VERSION = 5
+
+# A cached link: zd_number is a zendesk number (or a list of them), or '' if the record was not linked to any
+# ticket; method is the way the link was found (e.g. a stage of PrepaymentLinker) or None
+CachedLink = collections.namedtuple('CachedLink', ['zd_number', 'method', 'score', 'matched_title'])
+
+
+def row_digest(row):
+    '''
+    :param row: a row of the Zendesk export, as read by csv.DictReader
+    :return: digest of the values in row, used to detect tickets that changed between exports
+    '''
+    try:
+        values = '\x1f'.join(row.values())
+    except TypeError:
+        # short or long rows contain None or a list
+        values = '\x1f'.join(str(v) for v in row.values())
+    return hashlib.sha1(values.encode('utf-8')).digest()
+
+
+def ticket_digests(zd_dict):
+    '''
+    :param zd_dict: a dictionary of rows of the Zendesk export, indexed by zendesk number (e.g. ART zd_dict)
+    :return: dictionary of the digests of the rows (see row_digest), indexed by zendesk number
+    '''
+    return {zd_number: row_digest(row) for zd_number, row in zd_dict.items()}
+
+
+def normalise_key(source, doi, title):
+    '''
+    :return: the key of a record in the cache; DOIs with the same normalise_doi, and titles with the same
+            canonical_title, share a key. Titles whose canonical title is empty (e.g. punctuation only) are kept
+            as written
+    '''
+    return source, normalise_doi(doi), canonical_title(title) or title.strip()
+
+
+class LinkCache():
+    '''
+    SQLite cache of links of records to Zendesk tickets, indexed by the source of the record (e.g. 'Wiley'), its
+    DOI and its canonical title. Rerunning a report for the same period then only needs to match records that are
+    new.
+
+    Each entry holds a digest of the tickets it links to (see row_digest) and of its context, i.e. anything else
+    the link depends on (e.g. the tickets sharing the DOI of the record). An entry is ignored as soon as one of
+    these tickets changed or disappeared in the Zendesk export, or its context changed. Links that depend on the
+    whole export (e.g. titles matched by similarity, which any new ticket could match better) and records that
+    could not be linked are cached only for the Zendesk export in which they were found.
+    '''
+    def __init__(self, ticket_digests, filename=LINK_CACHE_FILENAME):
+        '''
+        :param ticket_digests: dictionary of the digests of the tickets in the current Zendesk export, indexed by
+                zendesk number (e.g. zendesk.Parser.zd_row_digests or the output of ticket_digests)
+        :param filename: path of the SQLite database; ':memory:' for a cache lasting as long as this object
+        '''
+        self.ticket_digests = ticket_digests
+        self.filename = filename
+        sha1 = hashlib.sha1()
+        for zd_number in sorted(ticket_digests.keys()):
+            sha1.update(zd_number.encode('utf-8'))
+            sha1.update(ticket_digests[zd_number])
+        # identifies the Zendesk export as a whole
+        self.zendesk_digest = sha1.digest()
+        if filename != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self._create_table()
+
+    def _create_table(self):
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != LINK_CACHE_VERSION:
+            logger.info('Emptying link cache {} (version {}, expected {})'.format(self.filename, version,
+                                                                                LINK_CACHE_VERSION))
+            self.connection.execute('DROP TABLE IF EXISTS links')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS links (
+                source TEXT NOT NULL,
+                doi TEXT NOT NULL,
+                title TEXT NOT NULL,
+                zd_number TEXT NOT NULL,
+                method TEXT,
+                score REAL,
+                matched_title TEXT,
+                tickets_digest BLOB NOT NULL,
+                updated TEXT NOT NULL,
+                PRIMARY KEY (source, doi, title)
+            )''')
+        self.connection.execute('PRAGMA user_version = {}'.format(LINK_CACHE_VERSION))
+        self.connection.commit()
+
+    def tickets_digest(self, zd_number, context=None):
+        '''
+        :param zd_number: a zendesk number, a list of them, or ''
+        :param context: anything else the link depends on, as a value that can be serialised to JSON; None if
+                nothing
+        :return: digest of the current version of the tickets, or of the whole Zendesk export if zd_number is
+                empty, and of context; None if a ticket is not in the export
+        '''
+        zd_numbers = [zd_number] if isinstance(zd_number, str) else list(zd_number)
+        zd_numbers = [z for z in zd_numbers if z]
+        sha1 = hashlib.sha1()
+        if not zd_numbers:
+            sha1.update(self.zendesk_digest)
+        for z in sorted(zd_numbers):
+            digest = self.ticket_digests.get(z)
+            if digest is None:
+                return None
+            sha1.update(z.encode('utf-8'))
+            sha1.update(digest)
+        if context is not None:
+            sha1.update(json.dumps(context, sort_keys=True).encode('utf-8'))
+        return sha1.digest()
+
+    def get(self, source, doi, title, context=None):
+        '''
+        :param source: name of the dataset of the record (e.g. the publisher of a prepayment report)
+        :param doi: DOI of the record
+        :param title: title of the record
+        :param context: context of the record (see put)
+        :return: CachedLink, or None if the record is not in the cache or its tickets or context changed since it
+                was cached
+        '''
+        row = self.connection.execute(
+            'SELECT zd_number, method, score, matched_title, tickets_digest FROM links '
+            'WHERE source = ? AND doi = ? AND title = ?', normalise_key(source, doi, title)).fetchone()
+        if row is None:
+            return None
+        zd_number = json.loads(row[0])
+        # links cached with whole_export (see put) are valid for as long as the Zendesk export does not change
+        if row[4] not in [self.tickets_digest(zd_number, context), self.tickets_digest('', context)]:
+            logger.debug('Cached link of %s (%s) to %s is out of date', title, doi, zd_number)
+            return None
+        return CachedLink(zd_number, row[1], row[2], row[3])
+
+    def get_many(self, records):
+        '''
+        :param records: a dictionary of tuples (source, doi, title) or (source, doi, title, context), indexed by any
+                key (e.g. row number)
+        :return: a dictionary of CachedLinks of the records in the cache (see get), with the same keys as records
+        '''
+        cached = {}
+        for k, record in records.items():
+            link = self.get(*record)
+            if link is not None:
+                cached[k] = link
+        return cached
+
+    def put(self, source, doi, title, zd_number, method, score=None, matched_title=None, context=None,
+            whole_export=False):
+        '''
+        Adds a link to the cache, or replaces the link of the same record. Call commit to save it
+        :param source: name of the dataset of the record (e.g. the publisher of a prepayment report)
+        :param doi: DOI of the record
+        :param title: title of the record
+        :param zd_number: zendesk number (or list of them) linked to the record, or '' if it was not linked
+        :param method: the way the link was found (e.g. a stage of PrepaymentLinker)
+        :param score: ratio of similarity of titles matched by similarity
+        :param matched_title: title of the ticket matched by similarity
+        :param context: anything else the link depends on (e.g. the tickets sharing the DOI of the record), as a
+                value that can be serialised to JSON; the link is only valid while get is given the same context
+        :param whole_export: if True, the link is only valid for the current Zendesk export, rather than for as
+                long as the tickets it links to do not change. Links to '' are always cached this way
+        '''
+        if self.tickets_digest(zd_number) is None:
+            logger.debug('Not caching link of %s (%s) to %s, which is not in the Zendesk export', title, doi,
+                         zd_number)
+            return
+        digest = self.tickets_digest('' if whole_export else zd_number, context)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            normalise_key(source, doi, title) + (json.dumps(zd_number), method, score, matched_title, digest,
+                                                 datetime.datetime.now().isoformat(timespec='seconds')))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -225,6 +225,22 @@ class ReportTemplate():
         self.zd_grantfields = [
             'COAF Grant Numbers [txt]']  # ZD funders field could also be used, but it does not seem to be included in the default export; this could be because it is a "multi-line text field"
 
+    def source_fields(self):
+        '''
+        :return: set of the fields of data sources (Zendesk, Apollo, Europe PMC, etc) that may end up in a report
+                made with this template: the report columns themselves, the fields mapped to them in
+                self.metadata_mapping and the fields used to populate repeated fields (funds, funders, grants).
+                Pass it to zendesk.Parser.plug_in_metadata to store only these fields in tickets
+        '''
+        fields = set(self.columns)
+        for source_fields in self.metadata_mapping.values():
+            fields.update(source_fields)
+        fields.update(self.zd_fund_field_list)
+        fields.update(self.zd_allfunders)
+        fields.update(self.zd_grantfields)
+        fields.add('Prepayment discount')  # added to report notes (see midas.Report.populate_report_fields)
+        return fields
+
 
 
 
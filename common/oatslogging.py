@@ -0,0 +1,200 @@
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import os
+import queue
+import time
+
+# Maximum number of seconds records written by a BufferedFileHandler may stay in memory before being flushed to disk
+FLUSH_INTERVAL = 1
+
+# Listeners started by enqueue_handlers; they are stopped at exit, after writing all queued records
+listeners = []
+# Handlers of each logger before enqueue_handlers replaced them, restored in child processes (see restore_handlers)
+original_handlers = {}
+# Logs opened by get_plain_log, indexed by absolute path
+plain_logs = {}
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that only merges the arguments of a record into its message before queuing it. Formatting
+    the line (time, logger name, etc.) and writing it are left to the QueueListener thread.
+    '''
+    def prepare(self, record):
+        # arguments are merged now, because callers may change them after logging (e.g. rows of CUFS reports)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class BufferedFileHandler(logging.FileHandler):
+    '''
+    FileHandler that flushes the log file at most once every FLUSH_INTERVAL seconds, rather than after every
+    record. Use it in logging.conf (class=common.oatslogging.BufferedFileHandler) for DEBUG logs
+    '''
+    def __init__(self, *args, **kwargs):
+        self.last_flush = time.monotonic()
+        super().__init__(*args, **kwargs)
+
+    def flush(self):
+        # called by emit after every record
+        now = time.monotonic()
+        if now - self.last_flush >= FLUSH_INTERVAL:
+            super().flush()
+            self.last_flush = now
+
+    def close(self):
+        super().flush()
+        super().close()
+
+
+def enqueue_handlers():
+    '''
+    Replaces the handlers of every logger (e.g. those configured by logging.config.fileConfig) with a
+    DeferredQueueHandler feeding a QueueListener, which passes records to the original handlers on a
+    background thread. Loggers sharing the same handlers share a queue. Records below the level of all
+    handlers of a logger are discarded before their message is formatted.
+    :return: list of the QueueListeners started
+    '''
+    loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(l, logging.Logger)]
+    queue_handlers = {}
+    started = []
+    for l in loggers:
+        handlers = tuple(h for h in l.handlers if not isinstance(h, logging.handlers.QueueHandler))
+        if not handlers:
+            continue
+        if handlers not in queue_handlers:
+            q = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+            listener.start()
+            started.append(listener)
+            queue_handler = DeferredQueueHandler(q)
+            queue_handler.setLevel(min(h.level for h in handlers))
+            queue_handlers[handlers] = queue_handler
+        original_handlers[l] = list(l.handlers)
+        l.handlers = [queue_handlers[handlers]]
+    if started and not listeners:
+        atexit.register(stop_listeners)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=restore_handlers)
+    listeners.extend(started)
+    return started
+
+
+def stop_listeners():
+    '''
+    Writes all queued records and stops the threads started by enqueue_handlers
+    '''
+    while listeners:
+        listeners.pop().stop()
+
+
+def restore_handlers():
+    '''
+    Puts back the handlers replaced by enqueue_handlers. Called in child processes started with fork, which do not
+    inherit the listener threads
+    '''
+    for l, handlers in original_handlers.items():
+        l.handlers = handlers
+    original_handlers.clear()
+    listeners.clear()
+
+
+def configure_logging(config_file, logfilename):
+    '''
+    Configures logging from a configuration file like logging.conf, with records written by a background thread
+    (see enqueue_handlers)
+    :param config_file: path of the configuration file (see logging.config.fileConfig)
+    :param logfilename: path of the log file, used as %(logfilename)s in config_file
+    '''
+    logging.config.fileConfig(config_file, defaults={'logfilename': logfilename})
+    enqueue_handlers()
+
+
+def lowest_enabled_level(logger):
+    '''
+    :param logger: a logging.Logger
+    :return: the lowest level of the messages of logger that a handler will output; messages below this level
+            do not need to be formatted
+    '''
+    levels = []
+    l = logger
+    while l:
+        levels.extend(h.level for h in l.handlers)
+        if not l.propagate:
+            break
+        l = l.parent
+    if not levels:
+        # logging.lastResort
+        levels.append(logging.WARNING)
+    return max(logger.getEffectiveLevel(), min(levels))
+
+
+class PlainLog():
+    '''
+    A log of messages printed to the terminal and appended to a text file as they are (see plog). The file is
+    opened once and kept open until the end of the run, instead of being opened for every message.
+    '''
+    def __init__(self, logfilename):
+        '''
+        :param logfilename: path of the log file
+        '''
+        self.logfilename = logfilename
+        self.file = open(logfilename, 'a')
+
+    def plog(self, *args, terminal=True):
+        '''
+        A function to print arguments to a log file
+        :param args: the arguments to output
+        :param terminal: if set to false, suppresses terminal output
+        '''
+        if terminal == True:
+            print(' '.join(map(str, args)))
+        for a in args:
+            try:
+                self.file.write(str(a))
+                self.file.write(' ')
+            except UnicodeEncodeError:
+                self.file.write('UnicodeEncodeError')
+                self.file.write(' ')
+        self.file.write('\n')
+
+    def close(self):
+        self.file.close()
+
+
+def get_plain_log(logfilename):
+    '''
+    Returns the PlainLog writing to logfilename, opening it on first use. Logs are closed at exit
+    :param logfilename: path of the log file
+    :return: PlainLog
+    '''
+    key = os.path.abspath(logfilename)
+    log = plain_logs.get(key)
+    if (log is None) or log.file.closed:
+        if not plain_logs:
+            atexit.register(close_plain_logs)
+        log = PlainLog(logfilename)
+        plain_logs[key] = log
+    return log
+
+
+def close_plain_logs():
+    while plain_logs:
+        plain_logs.popitem()[1].close()
+
+
+def plog(*args, logfilename, terminal=True):
+    '''
+    Prints arguments to the terminal and appends them to a log file (see PlainLog.plog)
+    :param args: the arguments to output
+    :param logfilename: path of the log file
+    :param terminal: if set to false, suppresses terminal output
+    '''
+    get_plain_log(logfilename).plog(*args, terminal=terminal)
@@ -1,10 +1,16 @@
+import atexit
+import collections.abc
 import datetime
 import dateutil.parser
 import os
 import csv
+import time
 
-DOI_CLEANUP = ['http://dx.doi.org/', 'https://doi.org/', 'http://dev.biologists.org/lookup/doi/', 'http://www.hindawi.com/journals/jdr/aip/2848759/']
-DOI_FIX = {'0.1136/jmedgenet-2016-104295':'10.1136/jmedgenet-2016-104295'}
+from common.csvprobe import extract_csv_header, probe_csv
+from common.oatslogging import get_plain_log
+from common.dateparsing import get_normaliser
+# DOI_CLEANUP and DOI_FIX are still used with prune_and_cleanup_string by older scripts
+from common.doi import DOI_CLEANUP, DOI_FIX, clean_doi, normalise_doi
 
 class oatslogger:
 
@@ -17,17 +23,7 @@ class oatslogger:
         :param args: the arguments to output
         :param terminal: if set to false, suppresses terminal output
         '''
-        with open(self.logfile, 'a') as f:
-            if terminal == True:
-                print(' '.join(map(str, args)))
-            for a in args:
-                try:
-                    f.write(str(a))
-                    f.write(' ')
-                except UnicodeEncodeError:
-                    f.write('UnicodeEncodeError')
-                    f.write(' ')
-            f.write('\n')
+        get_plain_log(self.logfile).plog(*args, terminal=terminal)
 
 def convert_date_str_to_yyyy_mm_dd(string, dateutil_options=None):
     '''
@@ -36,6 +32,9 @@ def convert_date_str_to_yyyy_mm_dd(string, dateutil_options=None):
     :param dateutil_options: options to be passed to dateutil
     :return: converted date or empty string if failed to convert
     '''
+    normaliser = get_normaliser(dateutil_options)
+    if normaliser is not None:
+        return normaliser(string)
     try:
         d = dateutil.parser.parse(string, dateutil_options)
     except ValueError:
@@ -122,7 +121,7 @@ def action_index_zendesk_data_general(zenexport, zd_dict={}, title2zd_dict={}, d
     #        embargo = 'Embargo duration [list]'
     #        green_licence = 'Green licence [list]',
             apollo_handle = row['Repository link [txt]'].replace('https://www.repository.cam.ac.uk/handle/' , '')
-            doi = prune_and_cleanup_string(row['DOI (like 10.123/abc456) [txt]'], DOI_CLEANUP, DOI_FIX)
+            doi = clean_doi(row['DOI (like 10.123/abc456) [txt]'])
             row['DOI (like 10.123/abc456) [txt]'] = doi
             try:
                 dateutil_options = dateutil.parser.parserinfo(dayfirst=True)
@@ -132,7 +131,7 @@ def action_index_zendesk_data_general(zenexport, zd_dict={}, title2zd_dict={}, d
                 # dateutil module could not be imported (not installed)
                 pass
             title2zd_dict[article_title.upper()] = zd_number
-            doi2zd_dict[doi] = zd_number
+            doi2zd_dict[normalise_doi(doi)] = zd_number
             oa2zd_dict[oa_number] = zd_number
             apollo2zd_dict[apollo_handle] = zd_number
             zd2zd_dict[zd_number] = zd_number
@@ -142,32 +141,101 @@ def action_index_zendesk_data_general(zenexport, zd_dict={}, title2zd_dict={}, d
     #            title2zd_dict_RCUK[article_title.upper()] = zd_number
         return(zd_dict, title2zd_dict, doi2zd_dict, oa2zd_dict, apollo2zd_dict, zd2zd_dict)
 
-def extract_csv_header(inputfile, enc = 'utf-8', delim = ','):
+class DebugCsvSink():
     '''
-    This function returns a list of the fields contained in the header (first row) of
-    a CSV file
-    :param inputfile: path of CSV file
-    :param enc: encoding of CSV file
+    A debug CSV file that stays open for the duration of a run. Rows are buffered in memory and
+    written in batches, rather than opening and closing the file for each row.
+    Use get_debug_csv to obtain the sink of a file, so that there is only one per file.
     '''
-    outputlist = []
-    with open(inputfile, encoding = enc) as csvfile:
-        headerreader = csv.reader(csvfile, delimiter=delim)
-        #~ print(type(headerreader))
-        for row in headerreader:
-            outputlist.append(row)
-    return(outputlist[0])
+    def __init__(self, outcsv, csvheader, flush_rows=500, flush_seconds=5):
+        '''
+        :param outcsv: path of output CSV file; rows are appended if it already exists
+        :param csvheader: the header of the CSV file; written only if the file does not exist yet
+        :param flush_rows: number of buffered rows that triggers a write to disk
+        :param flush_seconds: buffered rows are also written if this many seconds passed since the last write
+        '''
+        self.outcsv = outcsv
+        self.csvheader = list(csvheader)
+        self.fieldnames = set(self.csvheader)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        write_header = not os.path.exists(outcsv)
+        self.csvfile = open(outcsv, 'a')
+        self.dict_writer = csv.DictWriter(self.csvfile, fieldnames=self.csvheader)
+        self.list_writer = csv.writer(self.csvfile)
+        if write_header:
+            self.dict_writer.writeheader()
+
+    def writerow(self, row):
+        '''
+        Adds a copy of a row to the buffer, so that later changes to row are not written. Like csv.DictWriter,
+        raises ValueError if a dictionary has keys that are not in the header
+        :param row: dictionary keyed by header fields, or list of values in header order
+        '''
+        if isinstance(row, collections.abc.Mapping):
+            row = dict(row)
+            wrong_fields = row.keys() - self.fieldnames
+            if wrong_fields:
+                raise ValueError('dict contains fields not in fieldnames: ' +
+                                 ', '.join([repr(x) for x in wrong_fields]))
+        else:
+            row = list(row)
+        self.buffer.append(row)
+        if (len(self.buffer) >= self.flush_rows) or (time.monotonic() - self.last_flush > self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes buffered rows to disk
+        '''
+        for row in self.buffer:
+            if isinstance(row, dict):
+                self.dict_writer.writerow(row)
+            else:
+                self.list_writer.writerow(row)
+        self.buffer = []
+        self.csvfile.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.csvfile.close()
+
+debug_csv_sinks = {}
+
+def get_debug_csv(outcsv, csvheader=[]):
+    '''
+    Returns the open DebugCsvSink of outcsv, opening it if needed
+    :param outcsv: path of output CSV file
+    :param csvheader: the header of the CSV file; ignored if outcsv is already open
+    :return: DebugCsvSink
+    '''
+    key = os.path.abspath(outcsv)
+    sink = debug_csv_sinks.get(key)
+    if sink is None:
+        sink = DebugCsvSink(outcsv, csvheader)
+        debug_csv_sinks[key] = sink
+    return sink
+
+def close_debug_csvs():
+    '''
+    Writes any buffered rows and closes all debug CSV files. Called automatically on exit, but call it
+    before reading or removing debug files in the same run
+    '''
+    while debug_csv_sinks:
+        _, sink = debug_csv_sinks.popitem()
+        sink.close()
+
+atexit.register(close_debug_csvs)
 
 def output_debug_csv(outcsv, row_dict, csvheader = []):
     '''
-    This function appends a row to an output CSV file
+    This function appends a row to an output CSV file. The file is kept open and rows are
+    buffered (see DebugCsvSink), so call close_debug_csvs before reading it
     :param outcsv: path of output CSV file
     :param row_dict: dictionary containing the row to be output
     :param csvheader: the header of the CSV file
     '''
-    if not os.path.exists(outcsv):
-        with open(outcsv, 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=csvheader)
-            writer.writeheader()
-    with open(outcsv, 'a') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=csvheader)
-        writer.writerow(row_dict)
\ No newline at end of file
+    get_debug_csv(outcsv, csvheader).writerow(row_dict)
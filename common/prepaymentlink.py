@@ -0,0 +1,291 @@
+'''
+Batch linking of prepayment deal records (Springer, Wiley, OUP reports) to Zendesk tickets
+'''
+
+import collections
+import logging
+
+from common.doi import normalise_doi
+from common.titlematch import TitleMatcher, canonical_index, get_by_canonical_title
+
+# create logger
+logger = logging.getLogger(__name__)
+
+# Stages of PrepaymentLinker.link, in the order they are tried
+STAGE_MANUAL_TITLE = 'manual title'
+STAGE_DOI = 'DOI'
+STAGE_APOLLO = 'Apollo handle'
+STAGE_TITLE = 'title'
+STAGE_SIMILAR_TITLE = 'similar title'
+STAGES = [STAGE_MANUAL_TITLE, STAGE_DOI, STAGE_APOLLO, STAGE_TITLE, STAGE_SIMILAR_TITLE]
+# Looking up records in the LinkCache, between STAGE_MANUAL_TITLE and STAGE_DOI; cached links keep the stage that
+# first found them
+STAGE_LINK_CACHE = 'link cache'
+# Stages whose links stay valid in the LinkCache for as long as the linked tickets and the context of the record
+# (see PrepaymentLinker.link_context) do not change; links found by later stages depend on the titles of all
+# tickets, so they are only valid for the same Zendesk export
+TICKET_STAGES = [STAGE_DOI, STAGE_APOLLO]
+
+# Zendesk fields of tickets included in a funder's policy or payments; DOI and Apollo matches are only accepted for
+# these tickets
+POLICY_FLAGS = ["RCUK policy [flag]", "COAF policy [flag]", "RCUK payment [flag]", "COAF payment [flag]"]
+
+# Result of linking a prepayment record:
+#   zd_number: zendesk number (a string, or a list of strings for titles shared by several tickets), or '' if the
+#       record was not linked
+#   stage: the stage that linked the record (see STAGES), or None if no stage did
+#   title: the title used for matching (taken from manual_doi2title if the record had none)
+#   similar_titles: list containing a tuple (similarity, title in title2zd_dict) of the most similar title, found in
+#       stage STAGE_SIMILAR_TITLE
+#   cached: True if the link was found in a previous run and taken from the LinkCache
+Link = collections.namedtuple('Link', ['zd_number', 'stage', 'title', 'similar_titles', 'cached'])
+
+
+def ticket_in_policy(zd_ticket):
+    '''
+    Check if ZD ticket is marked as included in funder policies
+    :param zd_ticket: Zendesk ticket to evaluate
+    :return: True if included in at least one policy; False if not included
+    '''
+    for field in POLICY_FLAGS:
+        if zd_ticket[field] == 'yes':
+            return True
+    return False
+
+
+class PrepaymentLinker():
+    '''
+    Links all records of a prepayment report to Zendesk tickets at once, one stage at a time:
+
+    1. titles in manual_title2zd_dict, as written or once canonicalised (see canonical_title)
+    2. DOIs in doi2zd_dict
+    3. DOIs not in doi2zd_dict, via their Apollo handle (doi2apollo and apollo2zd_dict)
+    4. titles in title2zd_dict, in upper case or once canonicalised
+    5. titles similar to a title in title2zd_dict, in a pool of worker processes (see TitleMatcher)
+
+    Each stage only looks at the records left unlinked by the previous stages, so each record is linked exactly as
+    ART match_prepayment_deal_to_zd would link it, but the expensive similarity search is only run on the records
+    that need it, in parallel. DOI and Apollo matches are only accepted for tickets included in a funder's policy or
+    payments; a DOI matching only other tickets goes straight to title matching.
+
+    If a LinkCache is given, records linked in a previous run are taken from it after stage 1, and the links of
+    all other records found by stages 2 to 5 are saved to it. Links found by stages 2 and 3 are taken from the
+    cache unless their tickets or what those stages see for the record (see link_context) changed since; all
+    other links, and records no stage could link, only if the Zendesk export and link_context did not change.
+    '''
+    def __init__(self, zd_dict, doi2zd_dict, title2zd_dict, doi2apollo=None, apollo2zd_dict=None,
+                 manual_title2zd_dict=None, manual_doi2title=None, title_index=None, processes=None,
+                 link_cache=None, source=''):
+        '''
+        :param zd_dict: a dictionary of zendesk tickets, indexed by zendesk number
+        :param doi2zd_dict: a dictionary translating normalised DOIs (see doi.normalise_doi) to lists of zendesk
+                numbers
+        :param title2zd_dict: a dictionary translating upper case titles to zendesk numbers (or lists of them)
+        :param doi2apollo: a dictionary translating normalised DOIs to apollo handles
+        :param apollo2zd_dict: a dictionary translating apollo handles to zendesk numbers (or lists of them)
+        :param manual_title2zd_dict: a dictionary translating titles of records to zendesk numbers, or to '' for
+                records known not to be in zendesk
+        :param manual_doi2title: a dictionary of titles of records with an empty title, indexed by DOI
+        :param title_index: TitleIndex of the keys of title2zd_dict, if one was already built; if None, one is built
+                when titles are first matched by similarity
+        :param processes: maximum number of worker processes for stage STAGE_SIMILAR_TITLE; defaults to the number
+                of CPUs. If 1, titles are matched in this process
+        :param link_cache: LinkCache of links found in previous runs, or None
+        :param source: name of the dataset of the records in link_cache (e.g. the publisher of the report)
+        '''
+        self.zd_dict = zd_dict
+        self.doi2zd_dict = doi2zd_dict
+        self.title2zd_dict = title2zd_dict
+        self.doi2apollo = doi2apollo or {}
+        self.apollo2zd_dict = apollo2zd_dict or {}
+        self.manual_title2zd_dict = manual_title2zd_dict or {}
+        self.manual_doi2title = manual_doi2title or {}
+        self.title_index = title_index
+        self.processes = processes
+        self.link_cache = link_cache
+        self.source = source
+        # canonical_index of title2zd_dict and manual_title2zd_dict, built on first use
+        self.canonical_titles = None
+        self.manual_canonical_titles = None
+
+    def link(self, records):
+        '''
+        :param records: a dictionary of tuples (doi, title), indexed by any key (e.g. row number)
+        :return: a dictionary of Links, with the same keys as records
+        '''
+        links = {}
+        remaining = list(records.keys())
+        original_records = records
+        stages = [
+            (STAGE_MANUAL_TITLE, self.link_manual_titles),
+            (STAGE_LINK_CACHE, self.link_cached),
+            (STAGE_DOI, self.link_dois),
+            (STAGE_APOLLO, self.link_apollo_handles),
+            (STAGE_TITLE, self.link_titles),
+            (STAGE_SIMILAR_TITLE, self.link_similar_titles),
+        ]
+        for stage, function in stages:
+            if not remaining:
+                break
+            if stage == STAGE_TITLE:
+                # records without a title are matched by their title in manual_doi2title from here on
+                records = {k: (records[k][0], self.title_of(*records[k])) for k in remaining}
+            if (stage == STAGE_LINK_CACHE) and (self.link_cache is None):
+                continue
+            linked = function({k: records[k] for k in remaining})
+            links.update(linked)
+            logger.info('{} of {} prepayment records linked by {}'.format(len(linked), len(remaining), stage))
+            remaining = [k for k in remaining if k not in linked]
+        for k in remaining:
+            links[k] = Link('', None, records[k][1], [], False)
+        if self.link_cache is not None:
+            self.cache_links(original_records, links)
+        return links
+
+    def cache_links(self, records, links):
+        '''
+        Saves the links found by stages STAGE_DOI to STAGE_SIMILAR_TITLE, and the records no stage could link, to
+        self.link_cache
+        :param records: a dictionary of tuples (doi, title), as given to link
+        :param links: a dictionary of Links, as returned by link
+        '''
+        for k, link in links.items():
+            if link.cached or (link.stage == STAGE_MANUAL_TITLE):
+                continue
+            score, matched_title = link.similar_titles[0] if link.similar_titles else (None, None)
+            doi, title = records[k]
+            self.link_cache.put(self.source, doi, title, link.zd_number, link.stage, score, matched_title,
+                                context=self.link_context(doi), whole_export=(link.stage not in TICKET_STAGES))
+        self.link_cache.commit()
+
+    def link_context(self, doi):
+        '''
+        :param doi: DOI of a record
+        :return: the tickets stages STAGE_DOI and STAGE_APOLLO consider for a record with this DOI, as lists of
+                [zendesk number, included in a policy]: those of the DOI in doi2zd_dict, and those of its Apollo
+                handle (also returned) in apollo2zd_dict. A cached link of the record is only valid while this
+                does not change
+        '''
+        def policy_status(zd_list):
+            if not zd_list:
+                return []
+            if isinstance(zd_list, str):
+                zd_list = [zd_list]
+            return [[zd_number, ticket_in_policy(self.zd_dict[zd_number])] for zd_number in zd_list]
+
+        doi = normalise_doi(doi)
+        handle = self.doi2apollo.get(doi)
+        return [policy_status(self.doi2zd_dict.get(doi)), handle,
+                policy_status(self.apollo2zd_dict.get(handle) if handle else None)]
+
+    def title_of(self, doi, title):
+        '''
+        :return: title, or its title in manual_doi2title if it is empty
+        '''
+        if title.strip() == '':
+            try:
+                title = self.manual_doi2title[doi]
+            except KeyError:
+                logger.warning('Empty title for prepayment record with DOI {} '
+                               'not found in manual_doi2title dictionary'.format(doi))
+        return title
+
+    def ticket_in_policy(self, zd_list):
+        '''
+        :param zd_list: a zendesk number or list of zendesk numbers
+        :return: the first zendesk number in zd_list of a ticket included in a funder's policy, or None
+        '''
+        if isinstance(zd_list, str):
+            zd_list = [zd_list]
+        for zd_number in zd_list:
+            if ticket_in_policy(self.zd_dict[zd_number]):
+                return zd_number
+        return None
+
+    def link_manual_titles(self, records):
+        '''
+        :param records: a dictionary of tuples (doi, title)
+        :return: a dictionary of Links of the records linked by this stage
+        '''
+        if self.manual_canonical_titles is None:
+            self.manual_canonical_titles = canonical_index(self.manual_title2zd_dict)
+        linked = {}
+        for k, (doi, title) in records.items():
+            zd_number = self.manual_title2zd_dict.get(title.strip())
+            if zd_number is None:
+                match = get_by_canonical_title(self.manual_title2zd_dict, self.manual_canonical_titles, title)
+                if match is not None:
+                    zd_number = match[1]
+            if zd_number is not None:
+                linked[k] = Link(zd_number, STAGE_MANUAL_TITLE, title, [], False)
+        return linked
+
+    def link_cached(self, records):
+        linked = {}
+        cached = self.link_cache.get_many({k: (self.source, doi, title, self.link_context(doi))
+                                           for k, (doi, title) in records.items()})
+        for k, c in cached.items():
+            doi, title = records[k]
+            if c.method not in [STAGE_DOI, STAGE_APOLLO]:
+                title = self.title_of(doi, title)
+            similar_titles = [(c.score, c.matched_title)] if c.matched_title is not None else []
+            linked[k] = Link(c.zd_number, c.method, title, similar_titles, True)
+        return linked
+
+    def link_dois(self, records):
+        linked = {}
+        for k, (doi, title) in records.items():
+            zd_list = self.doi2zd_dict.get(normalise_doi(doi))
+            if zd_list:
+                logger.debug('zd_list: %s', zd_list)
+                zd_number = self.ticket_in_policy(zd_list)
+                if zd_number:
+                    linked[k] = Link(zd_number, STAGE_DOI, title, [], False)
+        return linked
+
+    def link_apollo_handles(self, records):
+        linked = {}
+        for k, (doi, title) in records.items():
+            doi = normalise_doi(doi)
+            if self.doi2zd_dict.get(doi):
+                # matched tickets not included in a policy in stage STAGE_DOI
+                continue
+            try:
+                zd_list = self.apollo2zd_dict[self.doi2apollo[doi]]
+            except KeyError:
+                continue
+            if zd_list:
+                logger.debug('zd_list: %s', zd_list)
+                zd_number = self.ticket_in_policy(zd_list)
+                if zd_number:
+                    linked[k] = Link(zd_number, STAGE_APOLLO, title, [], False)
+        return linked
+
+    def link_titles(self, records):
+        if self.canonical_titles is None:
+            self.canonical_titles = canonical_index(self.title2zd_dict)
+        linked = {}
+        for k, (doi, title) in records.items():
+            zd_number = self.title2zd_dict.get(title.upper())
+            if zd_number is None:
+                match = get_by_canonical_title(self.title2zd_dict, self.canonical_titles, title)
+                if match is not None:
+                    zd_number = match[1]
+            if zd_number is not None:
+                linked[k] = Link(zd_number, STAGE_TITLE, title, [], False)
+        return linked
+
+    def link_similar_titles(self, records):
+        '''
+        Matches titles of records to titles in title2zd_dict by similarity (see TitleMatcher), and links each
+        record to the ticket of the most similar title
+        '''
+        keys = list(records.keys())
+        matcher = TitleMatcher(self.title2zd_dict, processes=self.processes, title_index=self.title_index,
+                               canonical_titles=self.canonical_titles)
+        linked = {}
+        for k, match in zip(keys, matcher.match(records[k][1] for k in keys)):
+            if match.matched_title is not None:
+                linked[k] = Link(match.zd_number, STAGE_SIMILAR_TITLE, match.title,
+                                 [(match.score, match.matched_title)], False)
+        return linked
@@ -0,0 +1,292 @@
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# create logger
+logger = logging.getLogger(__name__)
+
+# Number of source lines with the largest growth in allocated memory recorded for each stage
+TRACEMALLOC_TOP_LINES = 10
+# Number of frames of each allocation recorded by tracemalloc
+TRACEMALLOC_FRAMES = 1
+# Call stacks taking less than this (in seconds) are left out of collapsed-stack files
+COLLAPSED_STACK_MIN_TIME = 0.0001
+
+MEGABYTE = 1024 * 1024
+
+
+def peak_rss(who=None):
+    '''
+    :param who: resource.RUSAGE_SELF (default) or resource.RUSAGE_CHILDREN
+    :return: peak resident set size in bytes of this process (or of its largest child process), or None if it
+            cannot be measured (e.g. on Windows)
+    '''
+    if resource is None:
+        return None
+    if who is None:
+        who = resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # reported in bytes on macOS and in kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def children_cpu_time():
+    '''
+    :return: CPU time (user and system, in seconds) of child processes that have finished, e.g. the workers of
+            zendesk.Parser.plug_in_payment_files
+    '''
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+def function_label(func):
+    '''
+    :param func: tuple (filename, line number, function name) identifying a function in pstats
+    :return: readable name of the function, without the semicolons used as separators in collapsed stacks
+    '''
+    filename, lineno, name = func
+    if filename == '~':
+        label = name  # built-in function, e.g. "<method 'append' of 'list' objects>"
+    else:
+        label = '{} ({}:{})'.format(name, os.path.basename(filename), lineno)
+    return label.replace(';', ',')
+
+
+def write_collapsed_stacks(stats, path, min_time=COLLAPSED_STACK_MIN_TIME):
+    '''
+    Writes the calls recorded by cProfile in the "collapsed stack" format read by flamegraph.pl and speedscope:
+    one line per call stack, followed by the time spent in its last function in microseconds.
+
+    cProfile records the callers of each function rather than whole stacks, so the time of a function
+    called from several places is split between its callers in proportion to the time of the calls from each
+    :param stats: pstats.Stats
+    :param path: path of the file to write
+    :param min_time: stacks taking less than this (in seconds) are left out
+    '''
+    raw = stats.stats  # function -> (primitive calls, calls, own time, cumulative time, callers)
+    children = collections.defaultdict(list)
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in raw.items():
+        if not callers:
+            roots.append(func)
+        for caller, caller_stats in callers.items():
+            # cumulative time of the calls made by caller
+            children[caller].append((func, caller_stats[3]))
+    stacks = collections.Counter()
+
+    def visit(func, stack, on_stack, cumulative_time):
+        cc, nc, tt, ct, callers = raw[func]
+        fraction = min(cumulative_time / ct, 1) if ct else 0
+        stack = stack + (function_label(func),)
+        stacks[';'.join(stack)] += tt * fraction
+        on_stack = on_stack | {func}
+        for child, child_time in children[func]:
+            share = child_time * fraction
+            # recursive calls are already counted in the time of the outermost call
+            if (child not in on_stack) and (child in raw) and (share >= min_time):
+                visit(child, stack, on_stack, share)
+
+    for func in roots:
+        if raw[func][3] >= min_time:
+            visit(func, (), frozenset(), raw[func][3])
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, seconds in stacks.items():
+            microseconds = int(round(seconds * 1e6))
+            if microseconds:
+                f.write('{} {}\n'.format(stack, microseconds))
+
+
+class Stage():
+    '''
+    Measurements of a stage of a run (see StageProfiler.stage). Set rows to the number of rows, tickets or
+    records processed by the stage to get its throughput
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.wall_time = None
+        self.cpu_time = None
+        self.children_cpu_time = None
+        self.peak_rss = None
+        self.children_peak_rss = None
+        self.traced_memory_peak = None
+        self.traced_memory_growth = None
+        self.top_allocations = []
+        self.pstats_file = None
+        self.collapsed_stack_file = None
+
+    def rows_per_second(self):
+        if (self.rows is None) or not self.wall_time:
+            return None
+        return self.rows / self.wall_time
+
+    def as_dict(self):
+        d = dict(vars(self))
+        d['rows_per_second'] = self.rows_per_second()
+        return d
+
+
+class StageProfiler():
+    '''
+    Measures the wall and CPU time, throughput and memory use of each stage of a run, and optionally profiles
+    each stage with cProfile.
+
+    Memory is measured as the peak resident set size of the process (the high-water mark since the process
+    started, so it only grows from one stage to the next) and with tracemalloc, which reports the peak and
+    growth of memory allocated by Python during each stage and the lines of code that allocated the most.
+    tracemalloc and cProfile slow Python down, so times are only comparable between runs with the same options.
+    Work done in child processes is only reflected in children_cpu_time and children_peak_rss.
+
+    A disabled StageProfiler measures nothing, so stages can be wrapped unconditionally.
+    '''
+    def __init__(self, enabled=True, trace_memory=True, cprofile=False, output_folder='.', prefix='profile'):
+        '''
+        :param enabled: if False, stage does not measure anything
+        :param trace_memory: if True, measure memory allocated during each stage with tracemalloc
+        :param cprofile: if True, run cProfile during each stage and save its statistics (pstats) and
+                collapsed stacks to output_folder
+        :param output_folder: folder where cProfile files are saved
+        :param prefix: start of the names of cProfile files
+        '''
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.cprofile = cprofile
+        self.output_folder = output_folder
+        self.prefix = prefix
+        self.stages = []
+        if self.enabled and self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Measures the code run in a with block:
+
+            with profiler.stage('index_zd_data') as stage:
+                parser.index_zd_data()
+                stage.rows = len(parser.zd_dict)
+
+        :param name: name of the stage
+        :return: context manager yielding a Stage, which is added to self.stages at the end of the block
+        '''
+        stage = Stage(name)
+        if not self.enabled:
+            yield stage
+            return
+        start_snapshot = None
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            start_snapshot = tracemalloc.take_snapshot()
+            start_traced = tracemalloc.get_traced_memory()[0]
+        profile = cProfile.Profile() if self.cprofile else None
+        start_children_cpu = children_cpu_time()
+        start_cpu = time.process_time()
+        start_wall = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield stage
+        finally:
+            if profile is not None:
+                profile.disable()
+            stage.wall_time = time.perf_counter() - start_wall
+            stage.cpu_time = time.process_time() - start_cpu
+            stage.children_cpu_time = children_cpu_time() - start_children_cpu
+            stage.peak_rss = peak_rss()
+            if resource is not None:
+                stage.children_peak_rss = peak_rss(resource.RUSAGE_CHILDREN)
+            if start_snapshot is not None:
+                traced, stage.traced_memory_peak = tracemalloc.get_traced_memory()
+                stage.traced_memory_growth = traced - start_traced
+                stage.top_allocations = self.top_allocations(start_snapshot, tracemalloc.take_snapshot())
+            if profile is not None:
+                self.save_profile(stage, profile)
+            self.stages.append(stage)
+            logger.debug('Stage {} took {:.3f}s'.format(name, stage.wall_time))
+
+    @staticmethod
+    def top_allocations(start_snapshot, end_snapshot, limit=TRACEMALLOC_TOP_LINES):
+        '''
+        :return: list of dictionaries describing the lines of code whose allocated memory grew the most between
+                two tracemalloc snapshots
+        '''
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib*')]
+        differences = end_snapshot.filter_traces(filters).compare_to(start_snapshot.filter_traces(filters), 'lineno')
+        top = []
+        for d in differences[:limit]:
+            frame = d.traceback[0]
+            top.append({'file': frame.filename, 'line': frame.lineno, 'size': d.size, 'size_diff': d.size_diff,
+                        'count_diff': d.count_diff})
+        return top
+
+    def save_profile(self, stage, profile):
+        '''
+        Saves the statistics of profile to a pstats file and a collapsed-stack file in self.output_folder
+        :param stage: Stage profiled
+        :param profile: cProfile.Profile
+        '''
+        os.makedirs(self.output_folder, exist_ok=True)
+        basename = '{}_{:02}_{}'.format(self.prefix, len(self.stages) + 1, re.sub(r'\W+', '_', stage.name))
+        stage.pstats_file = os.path.join(self.output_folder, basename + '.pstats')
+        stage.collapsed_stack_file = os.path.join(self.output_folder, basename + '.collapsed')
+        stats = pstats.Stats(profile)
+        stats.dump_stats(stage.pstats_file)
+        write_collapsed_stacks(stats, stage.collapsed_stack_file)
+
+    def summary(self):
+        '''
+        :return: table of the measurements of all stages, as a string
+        '''
+        def fmt(value, scale=1, decimals=2):
+            return '-' if value is None else '{:,.{}f}'.format(value / scale, decimals)
+
+        header = ['Stage', 'Wall (s)', 'CPU (s)', 'Children CPU (s)', 'Rows', 'Rows/s', 'Peak RSS (MB)',
+                  'Traced peak (MB)', 'Traced growth (MB)']
+        table = [header]
+        for s in self.stages:
+            table.append([s.name, fmt(s.wall_time, decimals=3), fmt(s.cpu_time, decimals=3),
+                          fmt(s.children_cpu_time, decimals=3), fmt(s.rows, decimals=0),
+                          fmt(s.rows_per_second(), decimals=0), fmt(s.peak_rss, MEGABYTE, 1),
+                          fmt(s.traced_memory_peak, MEGABYTE, 1), fmt(s.traced_memory_growth, MEGABYTE, 1)])
+        table.append(['Total', fmt(sum(s.wall_time for s in self.stages), decimals=3),
+                      fmt(sum(s.cpu_time for s in self.stages), decimals=3),
+                      fmt(sum(s.children_cpu_time for s in self.stages), decimals=3)] + [''] * 5)
+        widths = [max(len(row[i]) for row in table) for i in range(len(header))]
+        lines = []
+        for row in table:
+            cells = [row[0].ljust(widths[0])] + [c.rjust(w) for c, w in zip(row[1:], widths[1:])]
+            lines.append('  '.join(cells))
+        lines.insert(1, '  '.join('-' * w for w in widths))
+        return '\n'.join(lines)
+
+    def log_summary(self, log=logger):
+        '''
+        Logs the table of measurements (see summary)
+        :param log: the logger to use
+        '''
+        log.info('Time and memory used by each stage:\n{}'.format(self.summary()))
+
+    def save_json(self, path):
+        '''
+        Saves the measurements of all stages to a JSON file
+        :param path: path of the file
+        '''
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'stages': [s.as_dict() for s in self.stages],
+                       'tracemalloc': self.trace_memory, 'cprofile': self.cprofile}, f, indent=4)
+        logger.info('Profile saved to {}'.format(path))
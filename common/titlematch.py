@@ -0,0 +1,419 @@
+import collections
+import concurrent.futures
+import functools
+import heapq
+import html
+import logging
+import multiprocessing
+import os
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+# create logger
+logger = logging.getLogger(__name__)
+
+# Minimum ratio of similarity for two titles to be considered a match (see ART heuristic_match_by_title)
+SIMILARITY_THRESHOLD = 0.8
+# Titles are only matched in worker processes if there are at least this many per process; fewer are matched
+# faster in this process than it takes to start the pool
+MIN_TITLES_PER_PROCESS = 25
+# Titles sent to worker processes are split in this many chunks per process, so that a process given slow titles
+# does not hold up the others
+CHUNKS_PER_PROCESS = 4
+
+# Number of titles shortlisted by TitleIndex.matches when none of the k most promising titles is similar enough
+WIDE_SHORTLIST = 150
+
+# Characters are counted in buckets by TitleIndex to bound the similarity of titles: one per letter (of either
+# case), one for digits, one for spaces and one for anything else
+CHARACTER_BUCKETS = 29
+CHARACTER_BUCKET = {c: i for i, letters in enumerate(zip('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz'))
+                    for c in letters}
+CHARACTER_BUCKET.update({c: 26 for c in '0123456789'})
+CHARACTER_BUCKET[' '] = 27
+
+# Number of titles whose canonical form is remembered (see canonical_title)
+CANONICAL_TITLE_CACHE_SIZE = 100000
+
+# HTML tags (e.g. <i>, </sub>) and LaTeX commands (e.g. \textit, \alpha), removed from titles by canonical_title;
+# a tag starts with a letter, so that text between comparison signs (e.g. "p<0.05 and q>1") is kept
+MARKUP_REGEX = re.compile(r'</?[A-Za-z][^<>]*>|\\[a-zA-Z]+\*?')
+# Anything but letters and digits (punctuation, quotes, dashes, symbols, braces of LaTeX, whitespace)
+SEPARATOR_REGEX = re.compile(r'[\W_]+')
+
+# Result of matching a title (see TitleMatcher):
+#   title: the title matched, as given
+#   zd_number: value of the most similar title in title2zd_dict (e.g. a list of zendesk numbers), or '' if no
+#       title is similar enough
+#   score: ratio of similarity of the most similar title (1.0 for titles with the same canonical_title), or None
+#   out_of_policy: True if a funder's policy dictionary was given, but only a title outside it was similar enough
+#   matched_title: the most similar title in title2zd_dict, or None
+TitleMatch = collections.namedtuple('TitleMatch', ['title', 'zd_number', 'score', 'out_of_policy', 'matched_title'])
+
+# TitleMatcher used by each worker process
+worker_matchers = {}
+
+
+def similar(a, b):
+    '''
+    This function returns the ratio of similarity between 2 strings
+    :param a: string 1
+    :param b: string 2
+    :return: ratio of similarity between strings
+    '''
+    return(SequenceMatcher(None, a, b).ratio())
+
+
+@functools.lru_cache(maxsize=CANONICAL_TITLE_CACHE_SIZE)
+def canonical_title(title):
+    '''
+    Reduces a title to the form used to compare titles exactly: HTML entities are decoded, HTML tags and LaTeX
+    commands removed, Unicode is normalised (NFKC) and case folded, and everything but letters and digits is
+    replaced by a single space. "The “Hot” &amp; <i>cold</i> stars." and "THE HOT & COLD STARS" are then equal.
+    :param title: a title
+    :return: the canonical title
+    '''
+    title = MARKUP_REGEX.sub(' ', html.unescape(title))
+    title = unicodedata.normalize('NFKC', title).casefold()
+    return SEPARATOR_REGEX.sub(' ', title).strip()
+
+
+def canonical_index(title_dict):
+    '''
+    Secondary index of a dictionary indexed by title (e.g. title2zd_dict or manual_title2zd_dict), to find its
+    entries by canonical title
+    :param title_dict: a dictionary indexed by title
+    :return: dictionary of the keys of title_dict, indexed by their canonical title (see canonical_title); if
+            several keys have the same canonical title, the first in title_dict is used. Keys whose canonical title
+            is empty (e.g. punctuation only) are left out, so that such titles never match each other
+    '''
+    index = {}
+    for t in title_dict.keys():
+        canonical = canonical_title(t)
+        if canonical:
+            index.setdefault(canonical, t)
+    return index
+
+
+def get_by_canonical_title(title_dict, canonical_titles, title):
+    '''
+    :param title_dict: a dictionary indexed by title
+    :param canonical_titles: canonical_index of title_dict
+    :param title: the title we are trying to find
+    :return: tuple (key of title_dict with the same canonical title as title, its value) or None
+    '''
+    key = canonical_titles.get(canonical_title(title))
+    if key is None:
+        return None
+    return key, title_dict[key]
+
+
+class TitleIndex():
+    '''
+    Character n-gram inverted index of publication titles.
+
+    Matching a title against every key of title2zd_dict with SequenceMatcher is quadratic in practice
+    (one full comparison per Zendesk ticket per unmatched record). This index shortlists the titles sharing
+    most n-grams with the query and rescores only those, using exactly the same similarity ratio and
+    threshold as a full scan, so lookups take time proportional to the postings of the query's n-grams rather
+    than to the number of titles. Sharing n-grams does not guarantee a high ratio, so a title may be found by a
+    full scan but not shortlisted; with exact=True, the other titles are also checked against upper bounds of the
+    ratio (length, counts of characters, SequenceMatcher.quick_ratio), and compared in full if they could beat
+    the best match found so far, at the cost of a linear scan per lookup.
+    '''
+    def __init__(self, titles=(), n=3, max_df=0.25):
+        '''
+        :param titles: iterable of titles to index (e.g. title2zd_dict.keys()); titles are indexed as given
+        :param n: length of the character n-grams
+        :param max_df: n-grams present in more than this fraction of titles (e.g. ' OF', 'THE') are
+                ignored when shortlisting, unless a query contains nothing else
+        '''
+        self.n = n
+        self.max_df = max_df
+        self.titles = []
+        self.gram_counts = []
+        self.character_counts = []
+        self.postings = collections.defaultdict(list)
+        for t in titles:
+            self.add(t)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def _grams(self, title):
+        if len(title) <= self.n:
+            return {title}
+        return {title[i:i + self.n] for i in range(len(title) - self.n + 1)}
+
+    @staticmethod
+    def _character_counts(title):
+        '''
+        :return: tuple of the number of characters of title in each of CHARACTER_BUCKETS buckets (letters of
+                either case, digits, spaces, anything else). Characters in common between two titles are at most
+                the sum of the smaller count of each bucket, which bounds their ratio of similarity
+        '''
+        counts = [0] * CHARACTER_BUCKETS
+        for c in title:
+            counts[CHARACTER_BUCKET.get(c, CHARACTER_BUCKETS - 1)] += 1
+        return tuple(counts)
+
+    def add(self, title):
+        '''
+        Adds a title to the index
+        :param title: the title to add
+        '''
+        position = len(self.titles)
+        grams = self._grams(title)
+        self.titles.append(title)
+        self.gram_counts.append(len(grams))
+        self.character_counts.append(self._character_counts(title))
+        for g in grams:
+            self.postings[g].append(position)
+
+    def candidates(self, title, k=50):
+        '''
+        Returns up to k indexed titles sharing the largest proportion of n-grams with title
+        :param title: the title we are trying to match
+        :param k: maximum number of candidates to return
+        :return: list of indexed titles, most promising first
+        '''
+        return [self.titles[position] for position in self._shortlist(title, k)]
+
+    def _shortlist(self, title, k):
+        '''
+        :return: list of the positions of the candidates (see candidates)
+        '''
+        grams = self._grams(title)
+        max_postings = max(1, int(self.max_df * len(self.titles)))
+        selective = [g for g in grams if len(self.postings.get(g, ())) <= max_postings]
+        if not selective:
+            selective = grams
+        counts = collections.Counter()
+        for g in selective:
+            counts.update(self.postings.get(g, ()))
+        n_grams = len(grams)
+        # Dice coefficient of the two sets of n-grams
+        best = heapq.nlargest(k, counts.items(),
+                              key=lambda item: 2 * item[1] / (n_grams + self.gram_counts[item[0]]))
+        return [position for position, _ in best]
+
+    def matches(self, title, threshold=SIMILARITY_THRESHOLD, k=50, exact=False):
+        '''
+        Returns shortlisted titles whose ratio of similarity to title is above threshold. The k most promising
+        titles are rescored first, and WIDE_SHORTLIST of them if none of those is similar enough
+        :param title: the title we are trying to match; it is compared as given, so upper case it
+                if the index holds upper case titles
+        :param threshold: minimum ratio of similarity
+        :param k: number of candidates to rescore
+        :param exact: if True, the most similar title of the whole index is put first if it was not shortlisted,
+                so the first match is always the one a scan of all indexed titles would find (the most similar
+                title, the greatest title among equally similar ones); this scans all indexed titles
+        :return: list of tuples (similarity, indexed title), most similar first
+        '''
+        candidates = self._shortlist(title, max(k, WIDE_SHORTLIST))
+        counts = self._character_counts(title)
+        possible_matches = self._rescore(title, counts, threshold, candidates[:k])
+        if not possible_matches:
+            possible_matches = self._rescore(title, counts, threshold, candidates[k:])
+        possible_matches.sort(reverse=True)
+        if exact:
+            better = self._scan(title, threshold, possible_matches[0] if possible_matches else None,
+                                {self.titles[position] for position in candidates})
+            if better is not None:
+                possible_matches.insert(0, better)
+        return possible_matches
+
+    def _rescore(self, title, counts, threshold, candidates):
+        '''
+        :param counts: character counts of title (see _character_counts)
+        :param candidates: list of positions of indexed titles
+        :return: list of tuples (similarity, indexed title) of the candidates whose ratio of similarity to title is
+                above threshold
+        '''
+        possible_matches = []
+        for position in candidates:
+            t = self.titles[position]
+            # Length alone bounds the ratio: 2 * min(len) / (len(a) + len(b)), and so do characters in common
+            if title and ((2 * min(len(title), len(t)) <= threshold * (len(title) + len(t))) or
+                          (2 * sum(map(min, counts, self.character_counts[position]))
+                           <= threshold * (len(title) + len(t)))):
+                continue
+            sm = SequenceMatcher(None, title, t)
+            if sm.real_quick_ratio() > threshold and sm.quick_ratio() > threshold:
+                similarity = sm.ratio()
+                if similarity > threshold:
+                    possible_matches.append((similarity, t))
+        return possible_matches
+
+    def _scan(self, title, threshold, best, shortlisted):
+        '''
+        Compares title to the indexed titles that were not shortlisted, computing the ratio of similarity only of
+        those whose upper bounds of the ratio could reach the similarity of the best match so far
+        :param title: the title we are trying to match
+        :param threshold: minimum ratio of similarity
+        :param best: tuple (similarity, indexed title) of the best shortlisted match, or None
+        :param shortlisted: set of the titles already compared
+        :return: tuple (similarity, indexed title) of a match better than best, or None
+        '''
+        better = None
+        counts = self._character_counts(title)
+        # title is the second sequence, whose characters quick_ratio counts only once
+        bound_matcher = SequenceMatcher(None, '', title)
+        for t, t_counts in zip(self.titles, self.character_counts):
+            if t in shortlisted:
+                continue
+            # a match must be more similar than threshold, and at least as similar as best (equally similar titles
+            # are ranked by title)
+            floor = best[0] if best is not None else threshold
+            length = len(title) + len(t)
+            if length:
+                # upper bounds of the ratio, computed like SequenceMatcher ratios so that they compare exactly
+                bound = 2.0 * min(len(title), len(t)) / length
+                if (bound <= threshold) or (bound < floor):
+                    continue
+                bound = 2.0 * sum(map(min, counts, t_counts)) / length
+                if (bound <= threshold) or (bound < floor):
+                    continue
+                bound_matcher.set_seq1(t)
+                bound = bound_matcher.quick_ratio()
+                if (bound <= threshold) or (bound < floor):
+                    continue
+            similarity = SequenceMatcher(None, title, t).ratio()
+            if (similarity > threshold) and ((best is None) or ((similarity, t) > best)):
+                best = better = (similarity, t)
+        return better
+
+    def best_match(self, title, threshold=SIMILARITY_THRESHOLD, k=50, exact=False):
+        '''
+        Returns the shortlisted title most similar to title (see matches)
+        :param title: the title we are trying to match
+        :param threshold: minimum ratio of similarity
+        :param k: number of candidates to rescore
+        :param exact: if True, return the indexed title a scan of all indexed titles would find (see matches)
+        :return: tuple (similarity, indexed title) or None if no title is similar enough
+        '''
+        possible_matches = self.matches(title, threshold, k, exact)
+        if possible_matches:
+            return possible_matches[0]
+        return None
+
+
+def init_matcher_worker(matcher):
+    '''
+    :param matcher: TitleMatcher, or None if the worker was forked and so already has the matcher of its parent
+    '''
+    if matcher is not None:
+        worker_matchers['matcher'] = matcher
+
+
+def match_titles_in_worker(titles):
+    '''
+    :param titles: list of titles
+    :return: list of TitleMatch
+    '''
+    matcher = worker_matchers['matcher']
+    return [matcher.best_match(t) for t in titles]
+
+
+class TitleMatcher():
+    '''
+    Matches titles (e.g. of records not found by DOI) to the most similar titles of Zendesk tickets, in a pool of
+    worker processes.
+
+    Titles with the same canonical_title as a candidate are matched without comparing them to any other.
+    The indexes of candidate titles are built once, in this process. Where processes can be forked, workers
+    inherit them from this process without copying; elsewhere they are sent once to each worker when it starts.
+    Titles are then sent to workers in chunks, and results are returned in the order of the titles.
+    '''
+    def __init__(self, title2zd_dict, policy_title2zd_dict=None, threshold=SIMILARITY_THRESHOLD, processes=None,
+                 title_index=None, policy_title_index=None, canonical_titles=None, policy_canonical_titles=None,
+                 exact=False):
+        '''
+        :param title2zd_dict: a dictionary of zendesk numbers (or lists of them), indexed by upper case title
+        :param policy_title2zd_dict: a dictionary like title2zd_dict of tickets covered by a funder's policy; if
+                given, titles are matched to these tickets first, and to the others only if none is similar enough
+        :param threshold: minimum ratio of similarity
+        :param processes: maximum number of worker processes; defaults to the number of CPUs. If 1, titles are
+                matched in this process
+        :param title_index: TitleIndex of the keys of title2zd_dict, if one was already built
+        :param policy_title_index: TitleIndex of the keys of policy_title2zd_dict, if one was already built
+        :param canonical_titles: canonical_index of title2zd_dict, if one was already built
+        :param policy_canonical_titles: canonical_index of policy_title2zd_dict, if one was already built
+        :param exact: if True, titles are matched as a scan of all candidate titles would match them, rather than
+                among the titles shortlisted by TitleIndex (see TitleIndex.matches)
+        '''
+        self.title2zd_dict = title2zd_dict
+        self.policy_title2zd_dict = policy_title2zd_dict
+        self.threshold = threshold
+        self.processes = processes
+        self.title_index = title_index
+        self.policy_title_index = policy_title_index
+        self.canonical_titles = canonical_titles
+        self.policy_canonical_titles = policy_canonical_titles
+        self.exact = exact
+
+    def build_indexes(self):
+        if self.title_index is None:
+            self.title_index = TitleIndex(self.title2zd_dict.keys())
+        if self.canonical_titles is None:
+            self.canonical_titles = canonical_index(self.title2zd_dict)
+        if self.policy_title2zd_dict is not None:
+            if self.policy_title_index is None:
+                self.policy_title_index = TitleIndex(self.policy_title2zd_dict.keys())
+            if self.policy_canonical_titles is None:
+                self.policy_canonical_titles = canonical_index(self.policy_title2zd_dict)
+
+    def best_match(self, title):
+        '''
+        :param title: the title we are trying to match
+        :return: TitleMatch
+        '''
+        upper_title = title.upper()
+        if self.policy_title2zd_dict is not None:
+            match = self.policy_canonical_titles.get(canonical_title(title))
+            if match is not None:
+                return TitleMatch(title, self.policy_title2zd_dict[match], 1.0, False, match)
+            match = self.policy_title_index.best_match(upper_title, self.threshold, exact=self.exact)
+            if match:
+                return TitleMatch(title, self.policy_title2zd_dict[match[1]], match[0], False, match[1])
+        match = self.canonical_titles.get(canonical_title(title))
+        if match is not None:
+            return TitleMatch(title, self.title2zd_dict[match], 1.0, self.policy_title2zd_dict is not None, match)
+        match = self.title_index.best_match(upper_title, self.threshold, exact=self.exact)
+        if match:
+            return TitleMatch(title, self.title2zd_dict[match[1]], match[0],
+                              self.policy_title2zd_dict is not None, match[1])
+        return TitleMatch(title, '', None, False, None)
+
+    def match(self, titles):
+        '''
+        :param titles: iterable of titles
+        :return: list of TitleMatch, in the order of titles
+        '''
+        titles = list(titles)
+        self.build_indexes()
+        processes = min(self.processes or os.cpu_count() or 1, len(titles) // MIN_TITLES_PER_PROCESS)
+        if processes < 2:
+            return [self.best_match(t) for t in titles]
+        chunksize = -(-len(titles) // (processes * CHUNKS_PER_PROCESS))
+        chunks = [titles[i:i + chunksize] for i in range(0, len(titles), chunksize)]
+        if 'fork' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('fork')
+            worker_matchers['matcher'] = self
+            initargs = (None,)
+        else:
+            mp_context = None
+            initargs = (self,)
+        logger.info('Matching {} titles by similarity using {} processes'.format(len(titles), processes))
+        results = []
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=mp_context,
+                                                        initializer=init_matcher_worker,
+                                                        initargs=initargs) as executor:
+                # map returns results in the order of chunks, whichever process finishes first
+                for chunk_results in executor.map(match_titles_in_worker, chunks):
+                    results.extend(chunk_results)
+        finally:
+            worker_matchers.pop('matcher', None)
+        return results
@@ -1,17 +1,32 @@
+import array
+import collections
+import collections.abc
+import concurrent.futures
 import csv
-import datetime
-import dateutil.parser
+import decimal
+import functools
+import gc
+import hashlib
+import io
+import itertools
 import logging
 import logging.config
+import operator
 import os
+import pickle
 import re
 import sys
 
 import common.cufs as cufs
+from common.dateparsing import DateNormaliser
 # from . import cufs
-from common.oatsutils import extract_csv_header, output_debug_csv, prune_and_cleanup_string, DOI_CLEANUP, DOI_FIX
-# from .oatsutils import extract_csv_header, output_debug_csv, prune_and_cleanup_string, DOI_CLEANUP, DOI_FIX
+from common.oatslogging import lowest_enabled_level
+from common.doi import DOI_FIX, DOI_PREFIX_PATTERN, clean_doi, normalise_doi
+from common.oatsutils import extract_csv_header, get_debug_csv, output_debug_csv
+# from .oatsutils import extract_csv_header, output_debug_csv
 from common.midas_constants import RCUK_FORMAT_COST_CENTRE_SOF_COMBOS, APC_TRANSACTION_CODES, OTHER_PUB_CHARGES_TRANSACTION_CODES
+from common.linkcache import row_digest
+from common.titlematch import TitleIndex, TitleMatcher, canonical_index, canonical_title
 
 # create logger
 logger = logging.getLogger(__name__)
@@ -51,72 +66,227 @@ unmatched_payment_file_prefix = 'Midas_debug_payments_not_matched_to_zd_numbers_
 nonJUDB_payment_file_prefix = 'Midas_debug_non_JUDB_payments__'
 nonEBDU_payment_file_prefix = 'Midas_debug_non_EBDU_EBDV_or_EBDW_payments__'
 
+# Indexed Zendesk exports are cached here (see ParserSnapshot)
+ZENDESK_SNAPSHOT_FOLDER = os.path.join(os.path.expanduser("~"), ".OATs", "cache", "zendesk")
+
+# Code 0 of a TicketStore column: the ticket has no value for that field
+MISSING = object()
+# Number of distinct values of a TicketStore column at which its codes need a wider array type
+CODE_LIMITS = {0x100: 'H', 0x10000: 'I'}
+# Number of rows appended to a TicketStore before their codes are added to the columns
+PENDING_ROWS = 1000
+
+class TicketQuery():
+    '''
+    A query over the fields of Zendesk tickets, such as
+    {'Publisher [txt]': ['Royal Society of Chemistry', 'RSC'], 'Requester id': '880600338'}. A ticket matches a
+    field if its value is equal to any of the values listed for that field, ignoring leading and trailing spaces
+    and, unless the query is case sensitive, case. It matches the query if it matches all fields (match_all) or
+    any of them.
+
+    Queries are answered by filtering the rows of an export as they are read (RowFilter) or from an index of
+    parsed tickets (TicketQueryIndex); both match tickets the same way.
+    '''
+    def __init__(self, query, match_all=True, case_sensitive=False):
+        '''
+        :param query: dictionary where k are Zendesk field names and v are a value or a list of values
+        :param match_all: if True, tickets must match all fields; if False, any field
+        :param case_sensitive: if False, values are compared in upper case
+        '''
+        self.match_all = match_all
+        self.case_sensitive = case_sensitive
+        # list of tuples (field, frozenset of normalised values)
+        self.conditions = []
+        for field, values in query.items():
+            if type(values) not in [type([1,2,3]), type((1,2,3))]:
+                values = [values]
+            self.conditions.append((field, frozenset(self.normalise(str(v)) for v in values)))
+
+    def normalise(self, value):
+        '''
+        :param value: value of a field of a ticket or of the query
+        :return: the value as compared by this query
+        '''
+        if self.case_sensitive:
+            return value.strip()
+        return value.upper().strip()
+
+
+class RowFilter():
+    '''
+    Predicate over the rows of a Zendesk export, compiled once from a query (see TicketQuery) so that each row can
+    be tested without looking up fields by name. Rows are lists of values in the order of the export's columns, as
+    read by csv.reader.
+    '''
+    def __init__(self, fieldnames, query, match_type='or', ignore_case=False):
+        '''
+        :param fieldnames: header of the Zendesk export
+        :param query: dictionary where k are Zendesk field names and v are a value or a list of values
+        :param match_type: if 'or' rows matching any field match the query; if 'and' rows matching all fields
+                match the query. A row matches a field if it is equal to any of its values
+        :param ignore_case: if True, values are compared regardless of case; leading and trailing spaces are
+                always ignored
+        '''
+        if match_type not in ['or', 'and']:
+            sys.exit('{} is not a supported match_type'.format(match_type))
+        self.query = TicketQuery(query, match_all=(match_type == 'and'), case_sensitive=not ignore_case)
+        self.test = all if self.query.match_all else any
+        self.conditions = []
+        for field, values in self.query.conditions:
+            if field not in fieldnames:
+                sys.exit('Field {} not found in Zendesk export'.format(field))
+            self.conditions.append((fieldnames.index(field), values))
+
+    def __call__(self, row):
+        '''
+        :param row: list of values of a ticket
+        :return: True if row matches the query
+        '''
+        normalise = self.query.normalise
+        return self.test(normalise(row[i]) in values for i, values in self.conditions)
+
+
+def filter_zendesk_rows(reader, row_filter, exclude=False):
+    '''
+    Generator of the rows of a Zendesk export that match a RowFilter
+    :param reader: csv.reader of the export, positioned after the header
+    :param row_filter: RowFilter
+    :param exclude: if True, yield the rows that do NOT match row_filter instead
+    '''
+    for row in reader:
+        if not row:
+            # blank line (skipped by csv.DictReader too)
+            continue
+        try:
+            matches = row_filter(row)
+        except IndexError:
+            # row has fewer columns than the header
+            matches = False
+        if matches != exclude:
+            yield row
+
+
+def write_filtered_zendesk_export(zenexport, output_filename, query, match_type='or', ignore_case=False,
+                                  exclude=False):
+    '''
+    Reads a CSV export from Zendesk once, writing the rows that match query to output_filename unchanged.
+    Memory use does not depend on the size of the export.
+    :param zenexport: the CSV file exported from Zendesk
+    :param output_filename: the name of the file we will save filtered data to
+    :param query: dictionary where k are Zendesk field names and v are a value or a list of values
+    :param match_type: see RowFilter
+    :param ignore_case: see RowFilter
+    :param exclude: if True, write the rows that do NOT match query instead
+    '''
+    with open(zenexport, encoding = "utf-8") as infile, open(output_filename, 'w') as outfile:
+        reader = csv.reader(infile)
+        fieldnames = next(reader, [])
+        row_filter = RowFilter(fieldnames, query, match_type, ignore_case)
+        writer = csv.writer(outfile)
+        writer.writerow(fieldnames)
+        row_counter = 0
+        for row in filter_zendesk_rows(reader, row_filter, exclude):
+            writer.writerow(row)
+            row_counter += 1
+    logger.info('{} tickets of {} written to {}'.format(row_counter, zenexport, output_filename))
+
+
 def output_pruned_zendesk_export(zenexport, output_filename, **kwargs):
     '''
     This function filters a CSV export from Zendesk, excluding any tickets matching kwargs
     :param zenexport: the CSV file exported from Zendesk
     :param output_filename: the name of the file we will save pruned data to
-    :param kwargs: a dictionary where k are Zendesk field names and v are lists of values to exclude
-    '''
-    p = Parser(zenexport)
-    p.index_zd_data()
-    fieldnames = p.zenexport_fieldnames
-    with open(output_filename, 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames)
-        writer.writeheader()
-        for _, ticket in p.zd_dict.items():
-            output_ticket = False
-            for field, values in kwargs.items():
-                for value in values:
-                    if ticket.metadata[field] != value:
-                        output_ticket = True
-            if output_ticket:
-                writer.writerow(ticket.metadata)
+    :param kwargs: a dictionary where k are Zendesk field names and v are lists of values to exclude. A ticket is
+            excluded if it is equal to any value of any field
+    '''
+    write_filtered_zendesk_export(zenexport, output_filename, kwargs, match_type='or', exclude=True)
 
 def filter_zendesk_export(zenexport, output_filename, match_type='or', **kwargs):
     '''
     This function filters a CSV export from Zendesk, outputing only tickets that match kwargs
     :param zenexport: the CSV file exported from Zendesk
     :param output_filename: the name of the file we will save pruned data to
-    :param match_type: if 'or' tickets matching any kwarg will be included in output;
-            if 'and' tickets matching all kwargs will be included in output
-    :param kwargs: a dictionary where k are Zendesk field names and v are values to include
-    '''
-    p = Parser(zenexport)
-    p.index_zd_data()
-    fieldnames = p.zenexport_fieldnames
-    with open(output_filename, 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames)
-        writer.writeheader()
-        ticket_counter = 0
-        for _, ticket in p.zd_dict.items():
-            ticket_counter += 1
-            logger.debug('Working on ticket {} of {}'.format(ticket_counter, zenexport))
-            if match_type == 'or':
-                output_ticket = False
-                for field, values in kwargs.items():
-                    logger.debug('kwargs fields and values: {}: {};'.format(field, values))
-                    logger.debug('ticket.metadata[{}]: {}'.format(field, ticket.metadata[field]))
-                    if type(values) not in [type([1,2,3]), type((1,2,3))]:
-                        values = [values]
-                    for value in values:
-                        if ticket.metadata[field].lower().strip() == str(value).lower().strip():
-                            output_ticket = True
-                            logger.debug("Value of ticket metadata ({}) "
-                                         "matches query ({})".format(ticket.metadata[field], value))
-                        else:
-                            logger.debug("Value of ticket metadata ({}) does not "
-                                         "match query ({})".format(ticket.metadata[field], value))
-            elif match_type == 'and':
-                output_ticket = True
-                for field, values in kwargs.items():
-                    if type(values) not in [type([1,2,3]), type((1,2,3))]:
-                        values = [values]
-                    for value in values:
-                        if ticket.metadata[field] != value:
-                            output_ticket = False
-            if output_ticket:
-                writer.writerow(ticket.metadata)
+    :param match_type: if 'or' tickets matching any kwarg will be included in output (ignoring case); if 'and'
+            tickets matching all kwargs will be included in output. Leading and trailing spaces are ignored
+            (see TicketQuery)
+    :param kwargs: a dictionary where k are Zendesk field names and v are a value or a list of values to include
+    '''
+    write_filtered_zendesk_export(zenexport, output_filename, kwargs, match_type=match_type,
+                                  ignore_case=(match_type == 'or'))
+
+class TicketQueryIndex():
+    '''
+    Inverted index of the values of ticket fields, for answering queries (see TicketQuery) without comparing the
+    query to every ticket. The values of a field are normalised and indexed the first time the field is queried;
+    queries are then answered by union (values listed for the same field, or match_all=False) and intersection
+    (match_all=True) of the sets of matching tickets.
+    '''
+    def __init__(self, tickets, case_sensitive=False):
+        '''
+        :param tickets: dictionary of ticket metadata (dictionaries or TicketMetadata) indexed by zendesk number
+        :param case_sensitive: see TicketQuery
+        '''
+        self.tickets = tickets
+        self.case_sensitive = case_sensitive
+        self.positions = {k: i for i, k in enumerate(tickets.keys())}
+        self.postings = {}
+        # normalises values like the queries answered by this index
+        self.normalise = TicketQuery({}, case_sensitive=case_sensitive).normalise
+
+    def field_postings(self, field):
+        '''
+        :param field: a Zendesk field name
+        :return: dictionary of sets of zendesk numbers indexed by normalised value of field
+        '''
+        postings = self.postings.get(field)
+        if postings is None:
+            postings = collections.defaultdict(set)
+            for k, ticket in self.tickets.items():
+                value = ticket[field]
+                if isinstance(value, str):
+                    postings[self.normalise(value)].add(k)
+            self.postings[field] = postings
+        return postings
+
+    def lookup(self, field, values):
+        '''
+        :param field: a Zendesk field name
+        :param values: set of normalised values (see TicketQuery.conditions)
+        :return: set of zendesk numbers of tickets whose value of field is equal to any of values
+        '''
+        postings = self.field_postings(field)
+        matches = set()
+        for v in values:
+            matches |= postings.get(v, set())
+        return matches
+
+    def query(self, match_all=True, **kwargs):
+        '''
+        This function returns a dictionary containing only zendesk tickets that match ANY or ALL
+        conditions specified in a query (depending on the value of parameter match_all);
+        if the query contains a list of possible values for a particular kwarg,
+        then this list will be evaluated on a OR match basis
+        :param match_all: if True, tickets must match all kwargs; if False, any kwarg
+        :param kwargs: the query; k are Zendesk field names and v are a value or a list of values
+        :return: dictionary of matching tickets indexed by zendesk number, in the order of self.tickets
+        '''
+        query = TicketQuery(kwargs, match_all, self.case_sensitive)
+        if match_all:
+            matches = None
+            for field, values in query.conditions:
+                field_matches = self.lookup(field, values)
+                matches = field_matches if matches is None else matches & field_matches
+                if not matches:
+                    break
+            if matches is None:
+                # empty query
+                return dict(self.tickets)
+        else:
+            matches = set()
+            for field, values in query.conditions:
+                matches |= self.lookup(field, values)
+        return {k: self.tickets[k] for k in sorted(matches, key=self.positions.__getitem__)}
+
 
 class ZdFieldsMapping():
     '''
@@ -385,13 +555,246 @@ class ZdFieldsMapping():
                     out.write(out_str)
 
 
+class TicketStore():
+    '''
+    Columnar storage for the metadata of all tickets in a Zendesk export.
+
+    Storing each row of the export as a dictionary repeats 200+ keys per ticket and keeps a separate copy of
+    every value, even though most values (empty fields, '-', 'yes', publisher names, etc) are shared by
+    thousands of tickets. Instead, each column holds the distinct values found in it, and an array with the
+    integer code of the value of every ticket; most columns have fewer than 256 distinct values, so their codes
+    take one byte per ticket. String values are interned, so equal values are shared by all columns.
+    Ticket.metadata is a TicketMetadata view of one row of the store.
+    '''
+    def __init__(self, fieldnames):
+        '''
+        :param fieldnames: names of the columns of the Zendesk export
+        '''
+        self.fieldnames = [sys.intern(f) for f in fieldnames]
+        self.field_index = {f: i for i, f in enumerate(self.fieldnames)}
+        self.columns = [array.array('B') for _ in self.fieldnames]
+        self.column_values = [[MISSING] for _ in self.fieldnames]
+        self.column_codes = [{} for _ in self.fieldnames]
+        self.pending = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        self.flush()
+        return {'fieldnames': self.fieldnames, 'columns': self.columns,
+                'column_values': [values[1:] for values in self.column_values], 'length': self.length}
+
+    def __setstate__(self, state):
+        self.fieldnames = [sys.intern(f) for f in state['fieldnames']]
+        self.field_index = {f: i for i, f in enumerate(self.fieldnames)}
+        self.columns = state['columns']
+        self.column_values = [[MISSING] + [self.intern(v) for v in values] for values in state['column_values']]
+        self.column_codes = [{v: code for code, v in enumerate(values) if code} for values in self.column_values]
+        self.pending = []
+        self.length = state['length']
+
+    @staticmethod
+    def intern(value):
+        '''
+        :param value: a value of a ticket
+        :return: value, or the interned copy of value if it is a string
+        '''
+        if type(value) is str:
+            return sys.intern(value)
+        return value
+
+    def code(self, i, value):
+        '''
+        :param i: index of a column
+        :param value: a hashable value
+        :return: integer code of value in column i, adding it to the column if needed
+        '''
+        codes = self.column_codes[i]
+        try:
+            return codes[value]
+        except KeyError:
+            values = self.column_values[i]
+            code = len(values)
+            value = self.intern(value)
+            values.append(value)
+            codes[value] = code
+            if code in CODE_LIMITS:
+                # the codes of this column no longer fit in their array; widen it
+                self.columns[i] = array.array(CODE_LIMITS[code], self.columns[i])
+            return code
+
+    def value(self, i, row):
+        '''
+        :param i: index of a column
+        :param row: index of a ticket
+        :return: value of column i for the ticket, or MISSING
+        '''
+        if self.pending:
+            self.flush()
+        return self.column_values[i][self.columns[i][row]]
+
+    def append(self, row):
+        '''
+        Adds the metadata of a ticket to the store
+        :param row: dictionary of the ticket's metadata (e.g. a row read by csv.DictReader)
+        :return: TicketMetadata view of the new row
+        '''
+        if list(row) == self.fieldnames:
+            # the usual case of a row read from the export: one value per column, in order
+            values = list(row.values())
+            try:
+                codes = list(map(dict.get, self.column_codes, values))
+            except TypeError:
+                codes = None
+            if codes is not None:
+                # values not seen before in their column
+                i = -1
+                try:
+                    while True:
+                        i = codes.index(None, i + 1)
+                        codes[i] = self.code(i, values[i])
+                except ValueError:
+                    pass
+                # codes are added to the columns in batches (see flush)
+                self.pending.append(codes)
+                if len(self.pending) >= PENDING_ROWS:
+                    self.flush()
+                self.length += 1
+                return TicketMetadata(self, self.length - 1)
+
+        self.flush()
+        extra = None
+        present = 0
+        for i, name in enumerate(self.fieldnames):
+            code = 0
+            if name in row:
+                present += 1
+                try:
+                    code = self.code(i, row[name])
+                except TypeError:
+                    # unhashable value (e.g. a list)
+                    if extra is None:
+                        extra = {}
+                    extra[name] = row[name]
+            self.columns[i].append(code)
+        if present != len(row):
+            # fields that are not columns of the store, such as the restkey of csv.DictReader
+            if extra is None:
+                extra = {}
+            for k, v in row.items():
+                if k not in self.field_index:
+                    extra[k] = v
+        self.length += 1
+        return TicketMetadata(self, self.length - 1, extra)
+
+    def flush(self):
+        '''
+        Adds the codes of rows appended since the last flush to the columns
+        '''
+        if self.pending:
+            for column, codes in zip(self.columns, zip(*self.pending)):
+                column.extend(codes)
+            self.pending = []
+
+
+class TicketMetadata(collections.abc.MutableMapping):
+    '''
+    Dictionary-like view of the metadata of a ticket held in a TicketStore. Fields that are not columns
+    of the store (e.g. fields added from other data sources) are kept in a small dictionary of the view.
+    '''
+    __slots__ = ['store', 'row', 'extra']
+
+    def __init__(self, store, row, extra=None):
+        '''
+        :param store: TicketStore
+        :param row: index of the ticket in store
+        :param extra: dictionary of fields that are not stored in store
+        '''
+        self.store = store
+        self.row = row
+        self.extra = extra
+
+    def __getitem__(self, key):
+        i = self.store.field_index.get(key)
+        if i is not None:
+            value = self.store.value(i, self.row)
+            if value is not MISSING:
+                return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        self.store.flush()
+        i = self.store.field_index.get(key)
+        if i is not None:
+            try:
+                code = self.store.code(i, value)
+                self.store.columns[i][self.row] = code
+                if self.extra:
+                    self.extra.pop(key, None)
+                return
+            except TypeError:
+                self.store.columns[i][self.row] = 0
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        self.store.flush()
+        i = self.store.field_index.get(key)
+        if (i is not None) and self.store.columns[i][self.row]:
+            self.store.columns[i][self.row] = 0
+            if self.extra:
+                self.extra.pop(key, None)
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key):
+        self.store.flush()
+        i = self.store.field_index.get(key)
+        if (i is not None) and self.store.columns[i][self.row]:
+            return True
+        return bool(self.extra) and (key in self.extra)
+
+    def __iter__(self):
+        self.store.flush()
+        row = self.row
+        for name, column in zip(self.store.fieldnames, self.store.columns):
+            if column[row]:
+                yield name
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        self.store.flush()
+        row = self.row
+        length = sum(1 for column in self.store.columns if column[row])
+        if self.extra:
+            length += len(self.extra)
+        return length
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class Ticket():
     '''
     A single Zendesk ticket
     '''
+    __slots__ = ['apc_grand_total', 'other_grand_total', 'apollo_handle', 'article_title', 'coaf_apc_total',
+                 'coaf_other_total', 'coaf_payment', 'coaf_policy', 'decision_score', 'doi', 'external_id',
+                 'dup_of', 'number', 'publication_date', 'rcuk_apc_total', 'rcuk_other_total', 'rcuk_payment',
+                 'rcuk_policy', 'invoice_apc', 'invoice_page', 'invoice_membership', 'metadata']
+
     def __init__(self):
         '''
-        :param self.metadata: data stored in Zendesk about this ticket
+        :param self.metadata: data stored in Zendesk about this ticket (a TicketMetadata view of
+                Parser.ticket_store for tickets created by Parser)
         :param self.rcuk_apc: APC amount charged to RCUK block grant
         :param self.rcuk_other: Amount of other publication fees charged to RCUK block grant
         :param self.decision_score: Integer indicating how likely this ticket is to contain a decision on policies
@@ -421,14 +824,7 @@ class Ticket():
         self.metadata = {}
 
     def output_metadata_as_csv(self, outcsv):
-        fieldnames = self.metadata.keys()
-        if not os.path.exists(outcsv):
-            with open(outcsv, 'w') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-        with open(outcsv, 'a') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writerow(self.metadata)
+        get_debug_csv(outcsv, self.metadata.keys()).writerow(self.metadata)
 
     def output_payment_summary_as_csv(self, outcsv):
         columns_mapping = [
@@ -443,13 +839,463 @@ class Ticket():
             ['RCUK other', self.rcuk_other_total],
             ['Zendesk data', '{}'.format(self.metadata)],
         ]
-        if not os.path.exists(outcsv):
-            with open(outcsv, 'w') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow([a[0] for a in columns_mapping])
-        with open(outcsv, 'a') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([a[1] for a in columns_mapping])
+        get_debug_csv(outcsv, [a[0] for a in columns_mapping]).writerow([a[1] for a in columns_mapping])
+
+class ParserSnapshot():
+    '''
+    On-disk copy of the dictionaries built by Parser.index_zd_data for a Zendesk export.
+    A snapshot is only used if the export it was built from has the same path, size, modification
+    time and SHA-1 hash as the export being indexed. Otherwise, the out of date snapshot of the same path
+    (e.g. an export downloaded again to the same file) or the latest snapshot of another export is used as a
+    starting point when indexing the export (see Parser.index_zd_data).
+
+    Ticket metadata (the TicketStore and the TicketMetadata view of each ticket) is saved separately from the
+    dictionaries, so that it does not need to be loaded when the tickets are only going to be compared with a
+    newer export.
+    '''
+    # Increment this if the pickled attributes, the Ticket class or the keys of the dictionaries change
+    version = 5
+
+    def __init__(self, zenexport, folder=ZENDESK_SNAPSHOT_FOLDER):
+        '''
+        :param zenexport: path of the csv file exported from zendesk
+        :param folder: folder where snapshots are saved
+        '''
+        self.zenexport = os.path.abspath(zenexport)
+        self.folder = folder
+        self.filename = os.path.join(folder, '{}.pickle'.format(
+            hashlib.sha1(self.zenexport.encode('utf-8')).hexdigest()))
+        # fingerprint of the export, computed on first use
+        self.export_fingerprint = None
+
+    def fingerprint(self):
+        '''
+        :return: dictionary identifying the contents of the export. It is computed once, when first needed (i.e.
+                before the export is indexed), so the snapshot saved after indexing it has the same fingerprint
+        '''
+        if self.export_fingerprint is None:
+            self.export_fingerprint = self._compute_fingerprint()
+        return self.export_fingerprint
+
+    def _compute_fingerprint(self):
+        stat = os.stat(self.zenexport)
+        sha1 = hashlib.sha1()
+        with open(self.zenexport, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        return {'path': self.zenexport,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'sha1': sha1.hexdigest(),
+                'version': self.version}
+
+    def load(self):
+        '''
+        :return: dictionary of Parser attributes, including ticket_store, or None if there is no valid snapshot
+                for the export
+        '''
+        if not os.path.exists(self.filename):
+            return None
+        return self._read(self.filename, self.fingerprint(), with_metadata=True)
+
+    def load_previous(self):
+        '''
+        Loads a snapshot to be updated with the changes in this export: the out of date snapshot of this export
+        (see load) if there is one, or else the most recently saved snapshot of any other export
+        :return: dictionary of Parser attributes, or an empty dictionary if there are no other snapshots. The
+                metadata of tickets is not loaded
+        '''
+        snapshots = self.list_snapshots(self.folder)
+        if self.filename in snapshots:
+            snapshots.remove(self.filename)
+            snapshots.insert(0, self.filename)
+        for filename in snapshots:
+            attributes = self._read(filename)
+            if attributes is not None:
+                return attributes
+        return {}
+
+    def _read(self, filename, expected_fingerprint=None, with_metadata=False):
+        '''
+        :param filename: snapshot file
+        :param expected_fingerprint: if given, only return data if the snapshot's fingerprint is equal to this
+        :param with_metadata: if True, also load the metadata of tickets
+        :return: dictionary of Parser attributes, or None if the snapshot is not valid
+        '''
+        # The garbage collector would otherwise repeatedly traverse the tickets as they are unpickled
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(filename, 'rb') as f:
+                fingerprint = pickle.load(f)
+                if fingerprint.get('version') != self.version:
+                    logger.debug('Snapshot {} was saved by a different version of Parser'.format(filename))
+                    return None
+                if (expected_fingerprint is not None) and (fingerprint != expected_fingerprint):
+                    logger.debug('Snapshot {} is out of date for {}'.format(filename, self.zenexport))
+                    return None
+                attributes = pickle.load(f)
+                if with_metadata:
+                    attributes['ticket_store'], metadata = pickle.load(f)
+                    for zd_number, t in attributes['zd_dict'].items():
+                        t.metadata = metadata[zd_number]
+                return attributes
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+            logger.warning('Could not load snapshot {}: {}'.format(filename, e))
+            return None
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    @staticmethod
+    def list_snapshots(folder=ZENDESK_SNAPSHOT_FOLDER):
+        '''
+        :param folder: folder where snapshots are saved
+        :return: list of snapshot files in folder, most recently saved first
+        '''
+        if not os.path.isdir(folder):
+            return []
+        snapshots = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('.pickle')]
+        return sorted(snapshots, key=os.path.getmtime, reverse=True)
+
+    @staticmethod
+    def prune(folder=ZENDESK_SNAPSHOT_FOLDER, keep=10):
+        '''
+        Deletes all but the most recently saved snapshots
+        :param folder: folder where snapshots are saved
+        :param keep: number of snapshots to keep
+        '''
+        for filename in ParserSnapshot.list_snapshots(folder)[keep:]:
+            os.remove(filename)
+
+    def save(self, attributes, ticket_store=None):
+        '''
+        :param attributes: dictionary of Parser attributes to save; it must include zd_dict
+        :param ticket_store: the TicketStore holding the metadata of the tickets in zd_dict
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        temp_filename = self.filename + '.tmp'
+        tickets = attributes['zd_dict'].values()
+        metadata = {t.number: t.metadata for t in tickets}
+        try:
+            for t in tickets:
+                t.metadata = None
+            with open(temp_filename, 'wb') as f:
+                pickle.dump(self.fingerprint(), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(attributes, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump((ticket_store, metadata), f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            for t in tickets:
+                t.metadata = metadata[t.number]
+        os.replace(temp_filename, self.filename)
+
+# Size of the blocks in which large metadata files are read (see Parser.plug_in_metadata)
+METADATA_BLOCK_SIZE = 1024 * 1024
+
+# Types of charge of a CUFS payment (see classify_payment)
+COAF_APC = 'coaf_apc'
+RCUK_APC = 'rcuk_apc'
+RCUK_OTHER = 'rcuk_other'
+UNSUPPORTED_TRANSACTION_CODE = 'unsupported_transaction_code'
+UNSUPPORTED_CC_SOF = 'unsupported_cc_sof'
+
+class PaymentMatch():
+    '''
+    A row of a CUFS report and the zd ticket(s) it was matched to
+    '''
+    def __init__(self, row_counter, row, charge, log_level=logging.DEBUG):
+        '''
+        :param row_counter: number of the row in the report (aggregated payments are not counted)
+        :param row: the row, as read by csv.DictReader
+        :param charge: type of charge (see classify_payment)
+        :param log_level: messages below this logging level are discarded
+        :param self.zd_number: zd number matched to this row, or None if no match was found
+        :param self.rule: the cufs.ReferenceResolver rule that matched this row (e.g. cufs.ZD_NUMBER_RULE), or None
+        :param self.aggregated_breakdowns: list of cufs.Aggregated_breakdown if this row aggregates several payments
+        :param self.messages: list of tuples (logging level, message) describing how the row was matched
+        '''
+        self.row_counter = row_counter
+        self.row = row
+        self.charge = charge
+        self.zd_number = None
+        self.rule = None
+        self.aggregated_breakdowns = []
+        self.log_level = log_level
+        self.messages = []
+
+    def log(self, level, message, *args):
+        '''
+        Records a message to be logged when the match is applied (see Parser.apply_payment_matches)
+        :param level: logging level
+        :param message: message, formatted with args using str.format
+        '''
+        if level >= self.log_level:
+            self.messages.append((level, message.format(*args)))
+
+class MatchedPaymentFile():
+    '''
+    The result of matching all rows of a CUFS report to zd tickets
+    '''
+    def __init__(self, paymentsfile, cufs_export_type, funder):
+        self.paymentsfile = paymentsfile
+        self.cufs_export_type = cufs_export_type
+        self.funder = funder
+        self.fileheader = []
+        self.matches = []
+        self.unmatched_oa_numbers = []
+
+def parse_pence(amounts):
+    '''
+    :param amounts: iterable of amounts as written in CUFS reports (e.g. '1,234.56')
+    :return: array of the amounts in integer pence, parsed as decimals so that no float rounding is involved
+    '''
+    return array.array('q', [int((decimal.Decimal(a.replace(',', '')) * 100).to_integral_value()) for a in amounts])
+
+class PaymentLedger():
+    '''
+    Columnar ledger of payments to be added to tickets in bulk, used by Parser.apply_payment_matches when
+    Parser.use_payment_ledger is True. Payments are recorded as three columns (ticket, type of charge, amount);
+    post() parses all amounts at once into integer pence and adds them to the totals of their tickets with a
+    single group-by over tickets.
+
+    Totals are kept in integer pence for as long as the ledger is used (across all CUFS reports parsed by a
+    Parser), and the totals of a ticket are set from them each time payments are posted, so they are exact to
+    the penny instead of accumulating float rounding errors.
+    '''
+    # Totals increased by each type of charge, in the order of the columns of a ticket's row in self.pence
+    charge_columns = {COAF_APC: 0, RCUK_APC: 1, RCUK_OTHER: 2}
+
+    def __init__(self):
+        self.tickets = []
+        self.charges = array.array('B')
+        self.amounts = []
+        # ticket -> [coaf apc, rcuk apc, rcuk other] in pence, posted since the totals of the ticket were last set
+        # outside the ledger; None for types of charge without payments
+        self.pence = {}
+        # ticket -> its totals (coaf apc, rcuk apc, apc grand, rcuk other, other grand) when it was added to self.pence
+        self.bases = {}
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def add(self, ticket, charge, amount):
+        '''
+        :param ticket: Ticket the payment was matched to
+        :param charge: COAF_APC, RCUK_APC or RCUK_OTHER
+        :param amount: amount of the payment, as written in the CUFS report
+        '''
+        self.tickets.append(ticket)
+        self.charges.append(self.charge_columns[charge])
+        self.amounts.append(amount)
+
+    def rebase(self, ticket):
+        '''
+        Forgets the payments posted to ticket, so that payments posted later are added to totals set outside the
+        ledger (e.g. breakdowns of aggregated payments). Payments recorded but not posted must be posted first
+        :param ticket: Ticket
+        '''
+        self.pence.pop(ticket, None)
+        self.bases.pop(ticket, None)
+
+    def post(self):
+        '''
+        Adds all recorded payments to the totals of their tickets and empties the ledger
+        '''
+        if not self.tickets:
+            return
+        posted = set()
+        for t, column, p in zip(self.tickets, self.charges, parse_pence(self.amounts)):
+            row = self.pence.get(t)
+            if row is None:
+                row = self.pence[t] = [None, None, None]
+                self.bases[t] = (t.coaf_apc_total, t.rcuk_apc_total, t.apc_grand_total, t.rcuk_other_total,
+                                 t.other_grand_total)
+            row[column] = (row[column] or 0) + p
+            posted.add(t)
+        for t in posted:
+            coaf_apc, rcuk_apc, rcuk_other = self.pence[t]
+            base_coaf_apc, base_rcuk_apc, base_apc_grand, base_rcuk_other, base_other_grand = self.bases[t]
+            if coaf_apc is not None:
+                t.coaf_apc_total = base_coaf_apc + coaf_apc / 100
+            if rcuk_apc is not None:
+                t.rcuk_apc_total = base_rcuk_apc + rcuk_apc / 100
+            if (coaf_apc is not None) or (rcuk_apc is not None):
+                t.apc_grand_total = base_apc_grand + ((coaf_apc or 0) + (rcuk_apc or 0)) / 100
+            if rcuk_other is not None:
+                t.rcuk_other_total = base_rcuk_other + rcuk_other / 100
+                t.other_grand_total = base_other_grand + rcuk_other / 100
+            logger.debug('Posted payments to ZD ticket %s; t.apc_grand_total = %s; t.other_grand_total = %s; '
+                         't.coaf_apc_total = %s; t.rcuk_apc_total = %s; t.rcuk_other_total = %s', t.number,
+                         t.apc_grand_total, t.other_grand_total, t.coaf_apc_total, t.rcuk_apc_total,
+                         t.rcuk_other_total)
+        logger.debug('Posted %s payments to %s ZD tickets', len(self.tickets), len(posted))
+        self.tickets = []
+        self.charges = array.array('B')
+        self.amounts = []
+
+def read_csv_blocks(binfile, block_size=METADATA_BLOCK_SIZE):
+    '''
+    Reads a CSV file in blocks of whole records, i.e. ending at the end of a line outside quotes
+    :param binfile: CSV file opened in binary mode
+    :param block_size: approximate size of blocks in bytes
+    :return: generator of blocks (bytes)
+    '''
+    while True:
+        block = binfile.read(block_size)
+        if not block:
+            return
+        block += binfile.readline()
+        while block.count(b'"') % 2:
+            line = binfile.readline()
+            if not line:
+                break
+            block += line
+        yield block
+
+def get_cufs_map(cufs_export_type):
+    '''
+    :param cufs_export_type: type of report exported by CUFS. Supported values are 'rcuk', 'coaf' and 'rge'
+    :return: the mapping of column names for cufs_export_type
+    '''
+    if cufs_export_type == 'rcuk':
+        return cufs.RcukFieldsMapping()
+    elif cufs_export_type == 'coaf':
+        return cufs.CoafFieldsMapping()
+    elif cufs_export_type == 'rge':
+        return cufs.RgeFieldsMapping()
+    else:
+        sys.exit('{} is not a supported type of financial report (cufs_export_type)'.format(cufs_export_type))
+
+@functools.lru_cache(maxsize=None)
+def valid_cc_sof_combos(funder):
+    '''
+    :param funder: 'rcuk' or 'coaf'
+    :return: set of tuples (cost centre, source of funds) used for publication charges to funder
+    '''
+    return frozenset((combo.cost_centre, combo.sof) for combo in RCUK_FORMAT_COST_CENTRE_SOF_COMBOS
+                     if combo.funder == funder)
+
+def classify_payment(row, cufs_map, cufs_export_type, funder):
+    '''
+    Works out the type of charge of a CUFS payment
+    :param row: the row of the CUFS report
+    :param cufs_map: mapping of column names for cufs_export_type
+    :param cufs_export_type: type of report exported by CUFS
+    :param funder: 'rcuk' or 'coaf'
+    :return: COAF_APC, RCUK_APC, RCUK_OTHER, UNSUPPORTED_TRANSACTION_CODE or UNSUPPORTED_CC_SOF
+    '''
+    if funder == 'coaf':
+        # Payments spreadsheet does not contain transaction field, so assume all payments are APCs
+        return COAF_APC
+    elif cufs_export_type == 'rcuk':
+        if (row[cufs_map.cost_centre], row[cufs_map.source_of_funds]) not in valid_cc_sof_combos(funder):
+            return UNSUPPORTED_CC_SOF
+        elif row[cufs_map.transaction_code] in APC_TRANSACTION_CODES:
+            return RCUK_APC
+        elif row[cufs_map.transaction_code] in OTHER_PUB_CHARGES_TRANSACTION_CODES:
+            return RCUK_OTHER
+        else:
+            return UNSUPPORTED_TRANSACTION_CODE
+    else:
+        # TODO: rge reports are treated as coaf reports; this should be fine for reports where funder is coaf; for rcuk reports, this might need refinement
+        return RCUK_APC
+
+def classify_payments(rows, cufs_map, cufs_export_type, funder):
+    '''
+    Works out the type of charge of all payments in a CUFS report at once, as classify_payment does for one.
+    Cost centre, source of funds and transaction code columns are each checked against the codes used for
+    publication charges in a single pass
+    :param rows: list of rows of the CUFS report
+    :param cufs_map: mapping of column names for cufs_export_type
+    :param cufs_export_type: type of report exported by CUFS
+    :param funder: 'rcuk' or 'coaf'
+    :return: list of types of charge, in the order of rows
+    '''
+    if funder == 'coaf':
+        # Payments spreadsheet does not contain transaction field, so assume all payments are APCs
+        return [COAF_APC] * len(rows)
+    elif cufs_export_type == 'rcuk':
+        valid_combos = valid_cc_sof_combos(funder)
+        valid = [c in valid_combos for c in zip(map(operator.itemgetter(cufs_map.cost_centre), rows),
+                                                map(operator.itemgetter(cufs_map.source_of_funds), rows))]
+        code_charges = dict.fromkeys(OTHER_PUB_CHARGES_TRANSACTION_CODES, RCUK_OTHER)
+        code_charges.update(dict.fromkeys(APC_TRANSACTION_CODES, RCUK_APC))
+        codes = map(operator.itemgetter(cufs_map.transaction_code), rows)
+        return [code_charges.get(code, UNSUPPORTED_TRANSACTION_CODE) if v else UNSUPPORTED_CC_SOF
+                for v, code in zip(valid, codes)]
+    else:
+        # rge reports are treated as coaf reports (see classify_payment)
+        return [RCUK_APC] * len(rows)
+
+def match_payment_file(paymentsfile, cufs_export_type='rcuk', funder='rcuk', file_encoding='utf-8',
+                       oa2zd_dict={}, invoice2zd_dict={}, log_level=None, resolver=None):
+    '''
+    Matches each payment in a CUFS report to a zd ticket, without modifying any ticket. This only reads
+    oa2zd_dict and invoice2zd_dict, so it can be run in parallel for several reports (see
+    Parser.plug_in_payment_files)
+
+    :param paymentsfile: path of input CSV file containing payment data
+    :param cufs_export_type: type of report exported by CUFS. Supported values are 'rcuk', 'coaf' and 'rge'
+    :param funder: 'rcuk' if paymentsfile is a report of a RCUK grant; 'coaf' if it is of a COAF grant
+    :param file_encoding: enconding of paymentsfile
+    :param oa2zd_dict: Parser.oa2zd_dict
+    :param invoice2zd_dict: Parser.invoice2zd_dict
+    :param log_level: messages below this logging level are not recorded; defaults to the lowest level output by
+            the handlers of this module's logger (see oatslogging.lowest_enabled_level)
+    :param resolver: cufs.ReferenceResolver used to match rows to zd numbers; pass the same resolver to reuse
+            its results across reports. If None, one is created from oa2zd_dict and invoice2zd_dict
+    :return: MatchedPaymentFile
+    '''
+    if log_level is None:
+        log_level = lowest_enabled_level(logger)
+    if resolver is None:
+        resolver = cufs.ReferenceResolver(oa2zd_dict, invoice2zd_dict, MANUAL_OA2ZD_DICT)
+    cufs_map = get_cufs_map(cufs_export_type)
+    matched_file = MatchedPaymentFile(paymentsfile, cufs_export_type, funder)
+    unmatched_oa_numbers = set()
+    with open(paymentsfile, encoding=file_encoding) as csvfile:
+        reader = csv.DictReader(csvfile)
+        matched_file.fileheader = reader.fieldnames
+        rows = list(reader)
+    charges = classify_payments(rows, cufs_map, cufs_export_type, funder)
+    row_counter = 0
+    for row, charge in zip(rows, charges):
+        m = PaymentMatch(row_counter, row, charge, log_level)
+        matched_file.matches.append(m)
+        m.log(logging.DEBUG, '-------------- {} Working on {} row: {}', row_counter, paymentsfile, row)
+        resolution = resolver.resolve(row[cufs_map.oa_number], row[cufs_map.invoice_field])
+        for level, message, args in resolution.messages:
+            m.log(level, message, *args)
+        m.rule = resolution.rule
+
+        if resolution.rule == cufs.AGGREGATED_PAYMENT_RULE:
+            m.aggregated_breakdowns = resolution.aggregated_breakdowns
+            continue    # Do not proceed with normal processing because ZD number of aggregated payment
+                        # should not be included in report
+
+        row[cufs_map.oa_number] = resolution.description
+        if resolution.unmatched_oa_number:
+            unmatched_oa_numbers.add(resolution.unmatched_oa_number)
+        m.zd_number = resolution.zd_number
+        row_counter += 1
+    matched_file.unmatched_oa_numbers = sorted(unmatched_oa_numbers)
+    return matched_file
+
+# Read-only indexes of the parser, set in each worker process by init_payment_worker
+worker_indexes = {}
+
+def init_payment_worker(oa2zd_dict, invoice2zd_dict, log_level):
+    worker_indexes['oa2zd_dict'] = oa2zd_dict
+    worker_indexes['invoice2zd_dict'] = invoice2zd_dict
+    worker_indexes['log_level'] = log_level
+    worker_indexes['resolver'] = cufs.ReferenceResolver(oa2zd_dict, invoice2zd_dict, MANUAL_OA2ZD_DICT)
+
+def match_payment_file_in_worker(job):
+    '''
+    :param job: tuple of positional arguments for match_payment_file
+    :return: MatchedPaymentFile
+    '''
+    return match_payment_file(*job, **worker_indexes)
 
 class Parser():
     '''
@@ -463,6 +1309,8 @@ class Parser():
         self.doi2zd_dict = {}
         self.oa2zd_dict = {}
         self.parsed_payments = {}
+        self.publication_date_normaliser = DateNormaliser(dayfirst=True)
+        self.query_indexes = {}
         self.grant_report = {}
         self.grant_report_requester = None
         self.grant_report_start_date = None
@@ -470,9 +1318,14 @@ class Parser():
         self.invoice2zd_dict = {}
         self.output_map = None
         self.rejected_payments = {}
+        self.ticket_store = None
+        self.title_indexes = {}
+        self.canonical_title_indexes = {}
         self.title2zd_dict = {}
         self.title2zd_dict_COAF = {}
         self.title2zd_dict_RCUK = {}
+        self.payment_ledger = PaymentLedger()
+        self.use_payment_ledger = False  # add CUFS payments to tickets in bulk (see PaymentLedger)
         self.zd2oa_dups_dict = {}
         self.zd2zd_dict = {}
         self.zd_dict = {}
@@ -480,108 +1333,266 @@ class Parser():
         self.zd_dict_RCUK = {}
         self.zd_dict_with_payments = {}
         self.zd_fields = ZdFieldsMapping()
+        self.zd_row_digests = {}
         self.zenexport = zenexport
         self.zenexport_fieldnames = None
 
-    def index_zd_data(self):
+    # Attributes populated by index_zd_data and saved in snapshots
+    snapshot_attributes = [
+        'apollo2zd_dict',
+        'doi2zd_dict',
+        'invoice2zd_dict',
+        'oa2zd_dict',
+        'title2zd_dict',
+        'title2zd_dict_COAF',
+        'title2zd_dict_RCUK',
+        'zd2oa_dups_dict',
+        'zd2zd_dict',
+        'zd_dict',
+        'zd_dict_COAF',
+        'zd_dict_RCUK',
+        'zd_row_digests',
+        'zenexport_fieldnames',
+    ]
+
+    def index_zd_data(self, use_snapshot=True):
         """ This function parses a csv file exported from the UoC OSC zendesk account
             and returns several dictionaries with the contained data
 
             :param self.zenexport: path of the csv file exported from zendesk
+            :param use_snapshot: if True, load the dictionaries from a snapshot of a previous run on the same
+                    export if there is one. Otherwise, start from an out of date snapshot of the export or the most
+                    recent snapshot of another export (see ParserSnapshot.load_previous) and only parse tickets that
+                    were added or changed since, then save a snapshot of the result
             :param zd_dict: dictionary of Ticket objects indexed by zendesk ticket number (one Ticket object per number)
             :param title2zd_dict: dictionary of Ticket objects indexed by publication titles (list of objects per title)
-            :param doi2zd_dict: dictionary of Ticket objects indexed by DOIs (list of objects per DOI)
+            :param doi2zd_dict: dictionary of Ticket objects indexed by normalised DOIs (see doi.normalise_doi; list of
+                    objects per DOI)
             :param oa2zd_dict: dictionary of Ticket objects indexed by OA- numbers (list of objects per OA- number)
             :param apollo2zd_dict: dictionary of Ticket objects indexed by Apollo handles (list of objects per handle)
             :param zd2zd_dict: dictionary matching zendesk numbers to zendesk numbers IS THIS USED ANYWHERE?
             :return: zd_dict, title2zd_dict, doi2zd_dict, oa2zd_dict, apollo2zd_dict, zd2zd_dict
         """
+        previous = {}
+        if use_snapshot:
+            snapshot = ParserSnapshot(self.zenexport)
+            attributes = snapshot.load()
+            if attributes is not None:
+                logger.info('Loading indexed Zendesk data from snapshot {}'.format(snapshot.filename))
+                for a in self.snapshot_attributes:
+                    setattr(self, a, attributes[a])
+                self.ticket_store = attributes['ticket_store']
+                return self.indexes()
+            previous = snapshot.load_previous()
 
-        def convert_date_str_to_yyyy_mm_dd(string, dateutil_options):
-            '''
-            Function to convert dates to format YYYY-MM-DD
-            :param string: original date string
-            :param dateutil_options: options to be passed to dateutil
-            :return: converted date or empty string if failed to convert
-            '''
-            try:
-                d = dateutil.parser.parse(string, dateutil_options)
-            except ValueError:
-                d = datetime.datetime(1, 1, 1)
-            d = d.strftime('%Y-%m-%d')
-            if d == '1-01-01':
-                return ('')
+        logger.info('Indexing Zendesk data')
+        with open(self.zenexport, encoding = "utf-8") as csvfile:
+            reader = csv.DictReader(csvfile)
+            self.zenexport_fieldnames = reader.fieldnames
+            self.ticket_store = TicketStore(self.zenexport_fieldnames)
+            if previous and (previous['zenexport_fieldnames'] == self.zenexport_fieldnames):
+                logger.info('Updating Zendesk data indexed from {}'.format(previous['zenexport']))
+                self._update_index(reader, previous)
             else:
-                return (d)
+                for row in reader:
+                    digest = row_digest(row)
+                    t = self._ticket_from_row(row)
+                    self._index_ticket(t)
+                    self.zd_row_digests[t.number] = digest
 
-        def initiate_or_append_list(v_list, dict, zd_number):
-            # logger.debug('v_list: {}'.format(v_list))
+        if use_snapshot:
+            try:
+                attributes = {a: getattr(self, a) for a in self.snapshot_attributes}
+                attributes['zenexport'] = self.zenexport
+                snapshot.save(attributes, self.ticket_store)
+                ParserSnapshot.prune(snapshot.folder)
+            except OSError as e:
+                logger.warning('Could not save snapshot {}: {}'.format(snapshot.filename, e))
+        return self.indexes()
+
+    def _ticket_from_row(self, row):
+        '''
+        Creates a Ticket from a row of the Zendesk export and adds its metadata to ticket_store. DOI and
+        publication date are normalised in row too
+        :param row: a row of the Zendesk export, as read by csv.DictReader
+        :return: Ticket
+        '''
+        row[self.zd_fields.doi] = clean_doi(row[self.zd_fields.doi])
+        row[self.zd_fields.publication_date] = self.publication_date_normaliser(
+            row[self.zd_fields.publication_date])
+        metadata = self.ticket_store.append(row)
+        # string values of the store are interned, so interning the attributes of the ticket shares them too
+        intern = self.ticket_store.intern
+
+        t = Ticket()  # create a new Ticket object
+        t.number = intern(row[self.zd_fields.id])
+        t.dup_of = intern(row[self.zd_fields.duplicate_of])
+        t.external_id = intern(row[self.zd_fields.external_id])
+        t.article_title = intern(row[self.zd_fields.manuscript_title].upper())
+        t.rcuk_payment = intern(row[self.zd_fields.rcuk_payment])
+        t.rcuk_policy = intern(row[self.zd_fields.rcuk_policy])
+        t.coaf_payment = intern(row[self.zd_fields.coaf_payment])
+        t.coaf_policy = intern(row[self.zd_fields.coaf_policy])
+        t.invoice_apc = intern(row[self.zd_fields.apc_invoice_number])
+        t.invoice_page = intern(row[self.zd_fields.pagecolour_invoice_number])
+        t.invoice_membership = intern(row[self.zd_fields.membership_invoice_number])
+        t.apollo_handle = intern(row[self.zd_fields.repository_link].replace(
+            'https://www.repository.cam.ac.uk/handle/' , ''))
+        t.doi = intern(row[self.zd_fields.doi])
+        t.publication_date = intern(row[self.zd_fields.publication_date])
+
+        # Old OA- tickets (created before October 2014) do not have field external_id populated, so check if
+        # subject line contains OA- reference number
+        if (t.external_id in ['', '-']) and (row[self.zd_fields.subject][:23] == 'Open Access enquiry OA-'):
+            t.external_id = intern(row[self.zd_fields.subject][20:])
+
+        t.metadata = metadata
+        return t
+
+    def _ticket_index_values(self, t):
+        '''
+        :param t: Ticket
+        :return: list of tuples (dictionary, list of keys) under which t is indexed in each translation dictionary
+        '''
+        index_values = [
+            (self.apollo2zd_dict, [t.apollo_handle]),
+            (self.title2zd_dict, [t.article_title]),
+            (self.doi2zd_dict, [normalise_doi(t.doi)]),
+            (self.oa2zd_dict, [t.external_id]),
+            (self.invoice2zd_dict, [
+                t.invoice_apc.lower(),
+                t.invoice_page.lower(),
+                t.invoice_membership.lower()
+            ]),
+        ]
+        if (t.rcuk_payment == 'yes') or (t.rcuk_policy == 'yes'):
+            index_values.append((self.title2zd_dict_RCUK, [t.article_title.upper()]))
+        if (t.coaf_payment == 'yes') or (t.coaf_policy == 'yes'):
+            index_values.append((self.title2zd_dict_COAF, [t.article_title.upper()]))
+        return index_values
+
+    def _index_ticket(self, t):
+        '''
+        Adds a Ticket to zd_dict and to all translation dictionaries
+        :param t: Ticket
+        '''
+        for dict, v_list in self._ticket_index_values(t):
             for value in v_list:
                 if value not in ['', '-']:
                     if value in dict.keys():
-                        dict[value].append(zd_number)
+                        dict[value].append(t.number)
                     else:
-                        dict[value] = [zd_number]
+                        dict[value] = [t.number]
 
-        logger.info('Indexing Zendesk data')
-        t_oa = re.compile("OA[ \-]?[0-9]{4,8}")
-        with open(self.zenexport, encoding = "utf-8") as csvfile:
-            # header_reader = csv.reader(csvfile)
-            # self.zenexport_fieldnames = next(header_reader)
-            reader = csv.DictReader(csvfile)
-            self.zenexport_fieldnames = next(reader).keys()
-            for row in reader:
-                t = Ticket()  # create a new Ticket object
-                t.number = row[self.zd_fields.id]
-                t.dup_of = row[self.zd_fields.duplicate_of]
-                t.external_id = row[self.zd_fields.external_id]
-                t.article_title = row[self.zd_fields.manuscript_title].upper()
-                t.rcuk_payment = row[self.zd_fields.rcuk_payment]
-                t.rcuk_policy = row[self.zd_fields.rcuk_policy]
-                t.coaf_payment = row[self.zd_fields.coaf_payment]
-                t.coaf_policy = row[self.zd_fields.coaf_policy]
-                t.invoice_apc = row[self.zd_fields.apc_invoice_number]
-                t.invoice_page = row[self.zd_fields.pagecolour_invoice_number]
-                t.invoice_membership = row[self.zd_fields.membership_invoice_number]
-                t.apollo_handle = row[self.zd_fields.repository_link].replace('https://www.repository.cam.ac.uk/handle/' , '')
-                t.doi = prune_and_cleanup_string(row[self.zd_fields.doi], DOI_CLEANUP, DOI_FIX)
+        self.zd2zd_dict[t.number] = [t]
+        self.zd_dict[t.number] = t
+
+        if (t.rcuk_payment == 'yes') or (t.rcuk_policy == 'yes'):
+            self.zd_dict_RCUK[t.number] = t
+        if (t.coaf_payment == 'yes') or (t.coaf_policy == 'yes'):
+            self.zd_dict_COAF[t.number] = t
+        if t.dup_of not in ['', '-']:
+            self.zd2oa_dups_dict[t.number] = [t.dup_of]
+
+    def _unindex_ticket(self, t):
+        '''
+        Removes a Ticket from zd_dict and from all translation dictionaries
+        :param t: Ticket
+        '''
+        for dict, v_list in self._ticket_index_values(t):
+            for value in v_list:
+                if t.number in dict.get(value, []):
+                    dict[value].remove(t.number)
+                    if not dict[value]:
+                        del dict[value]
+        for dict in [self.zd2zd_dict, self.zd_dict, self.zd_dict_RCUK, self.zd_dict_COAF, self.zd2oa_dups_dict,
+                     self.zd_row_digests]:
+            dict.pop(t.number, None)
+
+    def _update_index(self, reader, previous):
+        '''
+        Populates this parser from the dictionaries indexed from a previous export, parsing only rows of reader
+        that were added or changed since. The result is the same as indexing the whole export from scratch.
+        :param reader: csv.DictReader of the new export
+        :param previous: dictionary of Parser attributes loaded from a snapshot of the previous export
+        '''
+        for a in self.snapshot_attributes:
+            if a != 'zenexport_fieldnames':
+                setattr(self, a, previous[a])
+        previous_zd_dict = self.zd_dict
+        order = {}
+        # keys of translation dictionaries whose lists of tickets changed
+        touched = collections.defaultdict(set)
+
+        def touch(t):
+            for dict, v_list in self._ticket_index_values(t):
+                touched[id(dict)].update(v_list)
+        changed_counter = 0
+        for row in reader:
+            digest = row_digest(row)
+            zd_number = row[self.zd_fields.id]
+            order[zd_number] = len(order)
+            if self.zd_row_digests.get(zd_number) == digest:
+                # unchanged ticket; its normalised DOI and publication date are reused
+                t = previous_zd_dict[zd_number]
                 row[self.zd_fields.doi] = t.doi
-                dateutil_options = dateutil.parser.parserinfo(dayfirst=True)
-                t.publication_date = convert_date_str_to_yyyy_mm_dd(row[self.zd_fields.publication_date], dateutil_options)
                 row[self.zd_fields.publication_date] = t.publication_date
+                t.metadata = self.ticket_store.append(row)
+                continue
+            changed_counter += 1
+            if zd_number in previous_zd_dict:
+                old_ticket = previous_zd_dict[zd_number]
+                touch(old_ticket)
+                self._unindex_ticket(old_ticket)
+            t = self._ticket_from_row(row)
+            self._index_ticket(t)
+            self.zd_row_digests[t.number] = digest
+            touch(t)
+
+        removed = [zd_number for zd_number in self.zd_dict.keys() if zd_number not in order]
+        for zd_number in removed:
+            t = self.zd_dict[zd_number]
+            touch(t)
+            self._unindex_ticket(t)
+        logger.info('{} tickets added or changed, {} removed since previous export'.format(changed_counter,
+                                                                                          len(removed)))
 
-                # Old OA- tickets (created before October 2014) do not have field external_id populated, so check if
-                # subject line contains OA- reference number
-                if (t.external_id in ['', '-']) and (row[self.zd_fields.subject][:23] == 'Open Access enquiry OA-'):
-                    t.external_id = row[self.zd_fields.subject][20:]
-
-                for v, dict in [
-                        ([t.apollo_handle], self.apollo2zd_dict),
-                        ([t.article_title], self.title2zd_dict),
-                        ([t.doi], self.doi2zd_dict),
-                        ([t.external_id], self.oa2zd_dict),
-                        ([
-                            row[self.zd_fields.apc_invoice_number].lower(),
-                            row[self.zd_fields.pagecolour_invoice_number].lower(),
-                            row[self.zd_fields.membership_invoice_number].lower()
-                          ], self.invoice2zd_dict)
-                        ]:
-                    initiate_or_append_list(v, dict, t.number)
-
-                self.zd2zd_dict[t.number] = [t]
-                self.zd_dict[t.number] = t
-
-                if (t.rcuk_payment == 'yes') or (t.rcuk_policy == 'yes'):
-                    self.zd_dict_RCUK[t.number] = t
-                    initiate_or_append_list([t.article_title.upper()], self.title2zd_dict_RCUK, t.number)
-                if (t.coaf_payment == 'yes') or (t.coaf_policy == 'yes'):
-                    self.zd_dict_COAF[t.number] = t
-                    initiate_or_append_list([t.article_title.upper()], self.title2zd_dict_COAF, t.number)
-                if t.dup_of not in ['', '-']:
-                    self.zd2oa_dups_dict[t.number] = [t.dup_of]
-
-                t.metadata = row
+        # Restore export order, so that iterating over the dictionaries gives the same results as a full re-index
+        position = order.__getitem__
+        for a in ['zd2zd_dict', 'zd_dict', 'zd_dict_COAF', 'zd_dict_RCUK', 'zd2oa_dups_dict', 'zd_row_digests']:
+            d = getattr(self, a)
+            setattr(self, a, {k: d[k] for k in sorted(d.keys(), key=position)})
+        for a in ['apollo2zd_dict', 'title2zd_dict', 'doi2zd_dict', 'oa2zd_dict', 'invoice2zd_dict',
+                  'title2zd_dict_RCUK', 'title2zd_dict_COAF']:
+            d = getattr(self, a)
+            for k in touched[id(d)]:
+                if k in d:
+                    d[k].sort(key=position)
+            if touched[id(d)]:
+                setattr(self, a, {k: d[k] for k in self._index_order(d, position)})
 
+    def _index_order(self, dict, position):
+        '''
+        :param dict: a translation dictionary whose lists of tickets are in export order
+        :param position: function returning the position of a ticket in the export
+        :return: list of the keys of dict in the order a full re-index inserts them: by their first ticket, and the
+                keys of the same ticket in the order of _ticket_index_values (e.g. APC, page and membership invoices)
+        '''
+        keys = sorted(dict.keys(), key=lambda k: position(dict[k][0]))
+        ordered = []
+        for zd_number, group in itertools.groupby(keys, key=lambda k: dict[k][0]):
+            group = list(group)
+            if len(group) > 1:
+                v_list = [v for d, v_list in self._ticket_index_values(self.zd_dict[zd_number]) if d is dict
+                          for v in v_list]
+                group.sort(key=v_list.index)
+            ordered.extend(group)
+        return ordered
+
+    def indexes(self):
+        '''
+        :return: list of the dictionaries populated by index_zd_data
+        '''
         return [
                 self.apollo2zd_dict,
                 self.doi2zd_dict,
@@ -597,6 +1608,111 @@ class Parser():
                 self.zd_dict_RCUK,
                 ]
 
+    def get_title_index(self, policy=None):
+        '''
+        Returns a TitleIndex of the titles in title2zd_dict, building it on first use. Use it to find tickets
+        by similarity of title without comparing a title to every ticket.
+        :param policy: if 'rcuk' or 'coaf', index only titles in title2zd_dict_RCUK or title2zd_dict_COAF
+        :return: TitleIndex
+        '''
+        title_dict = self.get_title_dict(policy)
+        index = self.title_indexes.get(policy)
+        if (index is None) or (len(index) != len(title_dict)):
+            index = TitleIndex(title_dict.keys())
+            self.title_indexes[policy] = index
+        return index
+
+    def get_title_dict(self, policy=None):
+        '''
+        :param policy: None, 'rcuk' or 'coaf'
+        :return: title2zd_dict, title2zd_dict_RCUK or title2zd_dict_COAF
+        '''
+        if policy == 'rcuk':
+            return self.title2zd_dict_RCUK
+        elif policy == 'coaf':
+            return self.title2zd_dict_COAF
+        return self.title2zd_dict
+
+    def get_canonical_titles(self, policy=None):
+        '''
+        Returns a secondary index of title2zd_dict by canonical title (see canonical_title), building it on first
+        use. Titles differing only in case, punctuation, markup or whitespace are then found without comparing
+        them by similarity
+        :param policy: if 'rcuk' or 'coaf', index only titles in title2zd_dict_RCUK or title2zd_dict_COAF
+        :return: dictionary of keys of the title dictionary, indexed by canonical title (see canonical_index)
+        '''
+        title_dict = self.get_title_dict(policy)
+        index, size = self.canonical_title_indexes.get(policy, (None, None))
+        if (index is None) or (size != len(title_dict)):
+            index = canonical_index(title_dict)
+            self.canonical_title_indexes[policy] = (index, len(title_dict))
+        return index
+
+    def find_by_title(self, title, policy=None):
+        '''
+        :param title: a publication title
+        :param policy: None, 'rcuk' or 'coaf' (see get_title_dict)
+        :return: list of zendesk numbers of tickets with this title in upper case or with the same canonical title,
+                or None
+        '''
+        title_dict = self.get_title_dict(policy)
+        zd_list = title_dict.get(title.upper())
+        if zd_list is None:
+            key = self.get_canonical_titles(policy).get(canonical_title(title))
+            if key is not None:
+                zd_list = title_dict[key]
+        return zd_list
+
+    def match_titles(self, titles, policy=None, processes=None):
+        '''
+        Finds the tickets with the titles most similar to each of titles, in a pool of worker processes (see
+        TitleMatcher)
+        :param titles: iterable of titles
+        :param policy: if 'rcuk' or 'coaf', titles are matched to tickets in title2zd_dict_RCUK or title2zd_dict_COAF
+                first, and to other tickets only if none is similar enough
+        :param processes: maximum number of worker processes; defaults to the number of CPUs
+        :return: list of TitleMatch, in the order of titles
+        '''
+        policy_title2zd_dict = None
+        policy_title_index = None
+        policy_canonical_titles = None
+        if policy in ['rcuk', 'coaf']:
+            policy_title2zd_dict = self.get_title_dict(policy)
+            policy_title_index = self.get_title_index(policy)
+            policy_canonical_titles = self.get_canonical_titles(policy)
+        matcher = TitleMatcher(self.title2zd_dict, policy_title2zd_dict, processes=processes,
+                               title_index=self.get_title_index(), policy_title_index=policy_title_index,
+                               canonical_titles=self.get_canonical_titles(),
+                               policy_canonical_titles=policy_canonical_titles)
+        return matcher.match(titles)
+
+    def get_query_index(self, case_sensitive=False):
+        '''
+        Returns a TicketQueryIndex of the metadata of tickets in zd_dict, building it on first use
+        :param case_sensitive: see TicketQueryIndex
+        :return: TicketQueryIndex
+        '''
+        index = self.query_indexes.get(case_sensitive)
+        if (index is None) or (len(index.tickets) != len(self.zd_dict)):
+            index = TicketQueryIndex({k: t.metadata for k, t in self.zd_dict.items()}, case_sensitive)
+            self.query_indexes[case_sensitive] = index
+        return index
+
+    def set_payment_mappings(self, cufs_export_type='rcuk', funder='rcuk'):
+        '''
+        Sets self.cufs_map and self.output_map for a CUFS report, exiting if cufs_export_type or funder
+        are not supported
+        :param cufs_export_type: type of report exported by CUFS. Supported values are 'rcuk', 'coaf' and 'rge'
+        :param funder: 'rcuk' if paymentsfile is a report of a RCUK grant; 'coaf' if it is of a COAF grant
+        '''
+        self.cufs_map = get_cufs_map(cufs_export_type)
+        if funder == 'rcuk':
+            self.output_map = cufs.RcukOutputMapping()
+        elif funder == 'coaf':
+            self.output_map = cufs.CoafOutputMapping()
+        else:
+            sys.exit('{} is not a supported funder'.format(funder))
+
     def plug_in_payment_data(self, paymentsfile, cufs_export_type='rcuk', funder='rcuk', file_encoding='utf-8'):
         #TODO: Add support for other financial codes that were used in the past for OA charges: VEJE.EDDK.EBKH , GAAB.EBDU
         #TODO: If a OA or ZD number reference is not found in the CUFS report being parsed, try to find a match using invoice number
@@ -611,275 +1727,161 @@ class Parser():
         coming from zendesk
 
         :param paymentsfile: path of input CSV file containing payment data
-        :param cufs_export_type: type of report exported by CUFS. Supported values are 'rcuk' and 'coaf'
+        :param cufs_export_type: type of report exported by CUFS. Supported values are 'rcuk', 'coaf' and 'rge'
         :param funder: 'rcuk' if paymentsfile is a report of a RCUK grant; 'coaf' if it is of a COAF grant
         :param file_encoding: enconding of paymentsfile
+        :return: number of rows of paymentsfile
         '''
+        self.set_payment_mappings(cufs_export_type, funder)
+        matched_file = match_payment_file(paymentsfile, cufs_export_type, funder, file_encoding,
+                                          oa2zd_dict=self.oa2zd_dict, invoice2zd_dict=self.invoice2zd_dict)
+        self.apply_payment_matches(matched_file)
+        return len(matched_file.matches)
 
-        def calculate_balance(self, payments_dict, zd_number, payments_type):
-            '''
-            Sums a payment associated with a ZD number to the balance of payments already processed that were also
-            associated with that number.
+    def plug_in_payment_files(self, paymentfiles, processes=None):
+        '''
+        Parses several CUFS reports at once. Reports are read and their rows matched to zd tickets in parallel,
+        in a pool of worker processes; payments are then added to tickets one report at a time, in the order
+        of paymentfiles, so the result is the same as calling plug_in_payment_data for each report in turn.
 
-            :param payments_dict:
-            :param zd_number:
-            :param payments_type:
-            :return:
-            '''
-            if payments_type == 'apc':
-                balance_field = self.cufs_map.total_apc
-            elif payments_type == 'other':
-                balance_field = self.cufs_map.total_other
-            existing_payment = payments_dict[zd_number]
-            p_amount = float(existing_payment[balance_field].replace(',', ''))
-            n_amount = float(row[self.cufs_map.amount_field].replace(',', ''))
-            return existing_payment, str(p_amount + n_amount)
+        :param paymentfiles: list of CUFS reports, each being a list in the format [filename, format, funder]
+                or [filename, format, funder, encoding]
+        :param processes: maximum number of worker processes; defaults to the number of CPUs. If 1 (or there
+                is only one report), reports are parsed in this process
+        :return: total number of rows of the reports
+        '''
+        jobs = []
+        for paymentfile in paymentfiles:
+            paymentsfile, cufs_export_type, funder = paymentfile[:3]
+            file_encoding = paymentfile[3] if len(paymentfile) > 3 else 'utf-8'
+            # Exit before starting any work if a report is not supported
+            self.set_payment_mappings(cufs_export_type, funder)
+            jobs.append((paymentsfile, cufs_export_type, funder, file_encoding))
 
+        processes = min(processes or os.cpu_count() or 1, len(jobs))
+        row_counter = 0
+        if processes < 2:
+            # descriptions recurring across reports are resolved once
+            resolver = cufs.ReferenceResolver(self.oa2zd_dict, self.invoice2zd_dict, MANUAL_OA2ZD_DICT)
+            matched_files = (match_payment_file(*job, resolver=resolver) for job in jobs)
+            for matched_file in matched_files:
+                self.apply_payment_matches(matched_file)
+                row_counter += len(matched_file.matches)
+        else:
+            logger.info('Matching payments in {} CUFS reports using {} processes'.format(len(jobs), processes))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_payment_worker,
+                                                        initargs=(self.oa2zd_dict, self.invoice2zd_dict,
+                                                                  lowest_enabled_level(logger))) as executor:
+                # map returns results in the order of jobs, whichever process finishes first
+                for matched_file in executor.map(match_payment_file_in_worker, jobs):
+                    self.apply_payment_matches(matched_file)
+                    row_counter += len(matched_file.matches)
+        return row_counter
+
+    def apply_payment_matches(self, matched_file):
+        '''
+        Adds the payments in a CUFS report to the zd tickets they were matched to, and outputs rejected
+        payments to debug files. If self.use_payment_ledger is True, amounts are added to ticket totals in bulk
+        by a PaymentLedger rather than one row at a time.
+        :param matched_file: MatchedPaymentFile returned by match_payment_file
+        '''
         def process_zd_number(self, zd_number):
-            logger.debug('--- Working on ZD ticket {}'.format(zd_number))
+            logger.debug('--- Working on ZD ticket %s', zd_number)
             if zd_number in cufs.ZD_NUMBER_TYPOS.keys():
-                logger.debug('Corrected typo in ZD number; from {} to {}'.format(zd_number,
-                                                                                 cufs.ZD_NUMBER_TYPOS[zd_number]))
+                logger.debug('Corrected typo in ZD number; from %s to %s', zd_number, cufs.ZD_NUMBER_TYPOS[zd_number])
                 zd_number = cufs.ZD_NUMBER_TYPOS[zd_number]
 
             t = self.zd_dict[zd_number]
             self.zd_dict_with_payments[zd_number] = t
 
+            if (ledger is not None) and (charge in PaymentLedger.charge_columns):
+                ledger.add(t, charge, row[self.cufs_map.amount_field])
+                return
             row_amount = float(row[self.cufs_map.amount_field].replace(',', ''))
-            if funder == 'coaf':
-                # Payments spreadsheet does not contain transaction field, so assume all payments are APCs
+            if charge == COAF_APC:
                 t.coaf_apc_total += row_amount
                 t.apc_grand_total += row_amount
-                logger.debug('Funder is COAF. Increased APC amount charged to COAF grant and total APC amount '
-                             'by {}; t.coaf_apc_total = {}; t.apc_grand_total = {}'.format(row_amount,
-                                                                                           t.coaf_apc_total,
-                                                                                           t.apc_grand_total))
-            elif funder == 'rcuk':
-                if cufs_export_type == 'rcuk':
-
-                    logger.debug('Funder and report format are RCUK. Checking payment codes...')
-
-                    if [row[self.cufs_map.cost_centre],
-                        row[self.cufs_map.source_of_funds]] in valid_cc_sof_combos:
-
-                        logger.debug('Checking transaction codes. Row cost centre ({}) and source of funds ({}) '
-                                     'codes in list of codes used for publication charges: {}'.format(
-                            row[self.cufs_map.cost_centre],
-                            row[self.cufs_map.source_of_funds], valid_cc_sof_combos))
-
-                        if row[self.cufs_map.transaction_code] in APC_TRANSACTION_CODES:
-                            t.rcuk_apc_total += row_amount
-                            t.apc_grand_total += row_amount
-                            logger.debug('Row contains APC payment (transaction code {}). Increased APC amount '
-                                         'charged to RCUK grant and total APC amount by {}; t.rcuk_apc_total '
-                                         '= {}; t.apc_grand_total'
-                                         ' = {}'.format(row[self.cufs_map.transaction_code], row_amount,
-                                                        t.rcuk_apc_total, t.apc_grand_total))
-
-                        elif row[self.cufs_map.transaction_code] in OTHER_PUB_CHARGES_TRANSACTION_CODES:
-                            t.rcuk_other_total += row_amount
-                            t.other_grand_total += row_amount
-                            logger.debug('Row contains publication charges unrelated to Open Access '
-                                         '(transaction code {}). Increased other amount charged to RCUK grant '
-                                         'and total other amount by {}; t.rcuk_other_total = {}; t.other_grand_total = '
-                                         '{}'.format(row[self.cufs_map.transaction_code],
-                                                     row_amount, t.rcuk_other_total, t.other_grand_total))
-                        else:
-                            # Not a supported transaction code
-                            key = 'not_supported_transaction_code_payment_' + str(row_counter)
-                            self.rejected_payments[key] = row
-                            debug_filename = os.path.join(os.getcwd(),
-                                                          nonEBDU_payment_file_prefix + paymentsfile.split('/')[-1])
-                            logger.debug('Row transaction code ({}) not supported. '
-                                         'Adding row to {}'.format(row[self.cufs_map.transaction_code],
-                                                                   debug_filename))
-                            output_debug_csv(debug_filename, row, fileheader)
+                logger.debug('Increased APC amount charged to COAF grant and total APC amount '
+                             'by %s; t.coaf_apc_total = %s; t.apc_grand_total = %s', row_amount, t.coaf_apc_total,
+                             t.apc_grand_total)
+            elif charge == RCUK_APC:
+                t.rcuk_apc_total += row_amount
+                t.apc_grand_total += row_amount
+                logger.debug('Increased APC amount charged to RCUK grant and total APC amount by %s; '
+                             't.rcuk_apc_total = %s; t.apc_grand_total = %s', row_amount, t.rcuk_apc_total,
+                             t.apc_grand_total)
+            elif charge == RCUK_OTHER:
+                t.rcuk_other_total += row_amount
+                t.other_grand_total += row_amount
+                logger.debug('Increased other amount charged to RCUK grant and total other amount by %s; '
+                             't.rcuk_other_total = %s; t.other_grand_total = %s', row_amount, t.rcuk_other_total,
+                             t.other_grand_total)
+            elif charge == UNSUPPORTED_TRANSACTION_CODE:
+                key = 'not_supported_transaction_code_payment_' + str(row_counter)
+                self.rejected_payments[key] = row
+                debug_filename = os.path.join(debug_folder, nonEBDU_payment_file_prefix + debug_suffix)
+                logger.debug('Row transaction code (%s) not supported. Adding row to %s',
+                             row[self.cufs_map.transaction_code], debug_filename)
+                output_debug_csv(debug_filename, row, matched_file.fileheader)
+            elif charge == UNSUPPORTED_CC_SOF:
+                key = 'not_supported_cc_sof_payment_' + str(row_counter)
+                self.rejected_payments[key] = row
+                debug_filename = os.path.join(debug_folder, nonJUDB_payment_file_prefix + debug_suffix)
+                logger.debug('Adding row to %s. Row cost centre (%s) and source of funds (%s) codes not '
+                             'in list of codes used for publication charges', debug_filename,
+                             row[self.cufs_map.cost_centre], row[self.cufs_map.source_of_funds])
+                output_debug_csv(debug_filename, row, matched_file.fileheader)
 
-                    else:
-                        # Not a supported cost centre/sof combo
-                        key = 'not_supported_cc_sof_payment_' + str(row_counter)
-                        self.rejected_payments[key] = row
-                        debug_filename = os.path.join(os.getcwd(),
-                                                      nonJUDB_payment_file_prefix + paymentsfile.split('/')[-1])
-                        logger.debug('Adding row to {}. Row cost centre ({}) and source of funds ({}) codes not '
-                                     'in list of codes used for publication charges: {}'.format(
-                            debug_filename, row[self.cufs_map.cost_centre],
-                            row[self.cufs_map.source_of_funds], valid_cc_sof_combos))
-                        output_debug_csv(debug_filename, row, fileheader)
-
-                elif cufs_export_type == 'coaf':
-                    t.rcuk_apc_total += row_amount
-                    t.apc_grand_total += row_amount
-                    logger.debug(
-                        'Funder is RCUK but CUFS report format is coaf. Increased APC amount charged to RCUK '
-                        'grant and total APC amount by {}; t.rcuk_apc_total = {}; t.apc_grand_total = {}'.format(
-                            row_amount, t.rcuk_apc_total, t.apc_grand_total))
-                # TODO: The elif case for rge export type below is an identical copy of the elif for coaf export type; this should be fine for reports where funder is coaf; for rcuk reports, this might need refinement
-                elif cufs_export_type == 'rge':
-                    t.rcuk_apc_total += row_amount
-                    t.apc_grand_total += row_amount
-                    logger.debug(
-                        'Funder is RCUK but CUFS report format is rge. Increased APC amount charged to RCUK '
-                        'grant and total APC amount by {}; t.rcuk_apc_total = {}; t.apc_grand_total = {}'.format(
-                            row_amount, t.rcuk_apc_total, t.apc_grand_total))
-                else:
-                    sys.exit('{} is not a supported type of financial report (cufs_export_type)'.format(
-                        cufs_export_type))
+        self.set_payment_mappings(matched_file.cufs_export_type, matched_file.funder)
+        debug_suffix = matched_file.paymentsfile.split('/')[-1]
+        # debug files are written to the current folder
+        debug_folder = os.getcwd()
+        ledger = self.payment_ledger if self.use_payment_ledger else None
+        for m in matched_file.matches:
+            row = m.row
+            row_counter = m.row_counter
+            charge = m.charge
+            for level, message in m.messages:
+                logger.log(level, message)
+            if m.aggregated_breakdowns:
+                if ledger is not None:
+                    # breakdowns overwrite ticket totals, so payments of earlier rows must be added first
+                    ledger.post()
+                for breakdown in m.aggregated_breakdowns:
+                    t = self.zd_dict[breakdown.zd_number]
+                    t.rcuk_apc_total = breakdown.rcuk_apc
+                    t.coaf_apc_total = breakdown.coaf_apc
+                    t.apc_grand_total = t.rcuk_apc_total + t.coaf_apc_total
+                    t.rcuk_other_total = breakdown.rcuk_other
+                    if ledger is not None:
+                        ledger.rebase(t)
+                    process_zd_number(self, breakdown.zd_number)
+            elif cufs.ZD_NUMBER_TYPOS.get(m.zd_number, m.zd_number) in self.zd_dict:
+                process_zd_number(self, m.zd_number)
+            elif m.zd_number:
+                # Payment linked to a ticket that is not in the export (e.g. pruned by output_pruned_zendesk_export)
+                key = 'no_zd_match_' + str(row_counter)
+                self.rejected_payments[key] = row
+                debug_filename = os.path.join(debug_folder, unmatched_payment_file_prefix + debug_suffix)
+                logger.warning('ZD number %s is not in the Zendesk export. Adding row to %s', m.zd_number,
+                               debug_filename)
+                output_debug_csv(debug_filename, row, matched_file.fileheader)
             else:
-                sys.exit('{} is not a supported funder'.format(funder))
-
-        if cufs_export_type == 'rcuk':
-            self.cufs_map = cufs.RcukFieldsMapping()
-        elif cufs_export_type == 'coaf':
-            self.cufs_map = cufs.CoafFieldsMapping()
-        elif cufs_export_type == 'rge':
-            self.cufs_map = cufs.RgeFieldsMapping()
-        else:
-            sys.exit('{} is not a supported type of financial report (cufs_export_type)'.format(cufs_export_type))
+                # Payment could not be linked to a zendesk number
+                key = 'no_zd_match_' + str(row_counter)
+                self.rejected_payments[key] = row
+                debug_filename = os.path.join(debug_folder, unmatched_payment_file_prefix + debug_suffix)
+                logger.debug('Row could not be matched to a ZD number. Adding it to %s', debug_filename)
+                output_debug_csv(debug_filename, row, matched_file.fileheader)
+        if ledger is not None:
+            ledger.post()
+        if matched_file.unmatched_oa_numbers:
+            logger.warning(
+                "ZD numbers could not be found for the following OA numbers in {}: {}. Data for these OA numbers "
+                "will NOT be exported.".format(matched_file.paymentsfile, matched_file.unmatched_oa_numbers))
 
-        if funder == 'rcuk':
-            self.output_map = cufs.RcukOutputMapping()
-        elif funder == 'coaf':
-            self.output_map = cufs.CoafOutputMapping()
-        else:
-            sys.exit('{} is not a supported funder'.format(funder))
-
-        valid_cc_sof_combos = []
-        for combo in RCUK_FORMAT_COST_CENTRE_SOF_COMBOS:
-            if combo.funder == funder:
-                valid_cc_sof_combos.append([combo.cost_centre, combo.sof])
-        logger.debug('valid_cc_sof_combos = {}'.format(valid_cc_sof_combos))
-
-        fileheader = extract_csv_header(paymentsfile)
-
-        t_oa = re.compile("OA[ \-]?[0-9]{4,8}")
-        t_zd = re.compile("ZD[ \-]{0,3}[0-9]{4,8}")
-        t_invoice_number_in_description = re.compile(", inv:([a-zA-Z0-9\-]{4,})")
-        payments_dict_apc = {}
-        payments_dict_other = {}
-
-        with open(paymentsfile, encoding=file_encoding) as csvfile:
-            reader = csv.DictReader(csvfile)
-            row_counter = 0
-            unmatched_oa_numbers = []
-            for row in reader:
-                logger.debug('-------------- {} Working on {} row: {}'.format(row_counter, csvfile, row))
-
-                descriptions_of_transactions_processed_manually = []
-                if row[self.cufs_map.oa_number] in cufs.AGGREGATED_PAYMENTS.keys():
-                    # Transaction aggregating more than one article (e.g. invoice for several articles)
-                    # Requires manual break down of charges and addition of description to
-                    # descriptions_of_transactions_processed_manually to prevent these aggregated transactions
-                    # to be counted more than once
-                    if row[self.cufs_map.oa_number] not in descriptions_of_transactions_processed_manually:
-                        logger.debug('Aggregated transaction detected ({}). Processing it manually'.format(
-                                        row[self.cufs_map.oa_number]))
-                        for breakdown in cufs.AGGREGATED_PAYMENTS[row[self.cufs_map.oa_number]]:
-                            t = self.zd_dict[breakdown.zd_number]
-                            t.rcuk_apc_total = breakdown.rcuk_apc
-                            t.coaf_apc_total = breakdown.coaf_apc
-                            t.apc_grand_total = t.rcuk_apc_total + t.coaf_apc_total
-                            t.rcuk_other_total = breakdown.rcuk_other
-                            process_zd_number(self, breakdown.zd_number)
-                        descriptions_of_transactions_processed_manually.append(row[self.cufs_map.oa_number])
-                    else:
-                        logger.debug('Transaction skipped because an aggregated transaction matching this description '
-                                    '({}) has already been processed.'.format(self.cufs_map.oa_number))
-                    continue    # Do not proceed with normal processing because ZD number of aggregated payment
-                                # should not be included in report
-
-                elif row[self.cufs_map.oa_number] in cufs.OA_NUMBER_TYPOS.keys():
-                    logger.debug('Corrected typo in OA number; from {} to {}'.format(row[self.cufs_map.oa_number],
-                                                        cufs.OA_NUMBER_TYPOS[row[self.cufs_map.oa_number]]))
-                    row[self.cufs_map.oa_number] = cufs.OA_NUMBER_TYPOS[row[self.cufs_map.oa_number]]
-
-                m_oa = t_oa.search(row[self.cufs_map.oa_number].upper())
-                m_zd = t_zd.search(row[self.cufs_map.oa_number].upper())
-                m_invoice_number_in_description = t_invoice_number_in_description.search(row[self.cufs_map.oa_number])
-                zd_number = None
-
-                if m_zd:
-                    zd_number = m_zd.group().replace(" ","-").strip('ZDzd -')
-                    logger.debug('Matched row to ZD number {}'.format(zd_number))
-
-                elif m_oa:
-                    oa_number = m_oa.group().upper().replace("OA" , "OA-").replace(" ","").replace('--', '-')
-                    logger.debug('Matched row to OA number {}'.format(oa_number))
-                    try:
-                        zd_number = MANUAL_OA2ZD_DICT[oa_number]
-                    except KeyError:
-                        try:
-                            zd_number_list = self.oa2zd_dict[oa_number]
-                            if len(zd_number_list) > 1:
-                                logging.error('More than one ZD number is linked to OA number {} {}. Using earliest'
-                                              'ZD ticket as match to avoid "TypeError: unhashable type: '
-                                              'list". Map OA number manually to ZD number using MANUAL_OA2ZD_DICT to '
-                                              'solve this error'.format(oa_number, zd_number_list))
-                                zd_number = str(sorted([ int(x) for x in zd_number_list ])[0])
-                            else:
-                                zd_number = zd_number_list[0]
-                        except KeyError:
-                            if oa_number not in unmatched_oa_numbers:
-                                unmatched_oa_numbers.append(oa_number)
-                    if zd_number:
-                        logger.debug('Matched row to ZD number {} via OA number {}'.format(zd_number, oa_number))
-
-                elif row[self.cufs_map.invoice_field].strip() in cufs.INVOICE2ZD_NUMBER.keys():
-                    # try match by invoice number
-                    zd_number = cufs.INVOICE2ZD_NUMBER[row[self.cufs_map.invoice_field]]
-                    logger.debug('Matched row to ZD number {} via invoice number {}'.format(zd_number,
-                                                                            row[self.cufs_map.invoice_field]))
-
-                elif row[self.cufs_map.oa_number].strip() in cufs.DESCRIPTION2ZD_NUMBER.keys():
-                    # try match by description
-                    zd_number = cufs.DESCRIPTION2ZD_NUMBER[row[self.cufs_map.oa_number]]
-                    logger.debug('Matched row to ZD number {} via description: {}'.format(zd_number,
-                                                                                        row[self.cufs_map.oa_number]))
-
-                elif row[self.cufs_map.invoice_field].strip().lower() in self.invoice2zd_dict.keys():
-                    zd_number_list = self.invoice2zd_dict[row[self.cufs_map.invoice_field].strip().lower()]
-                    if len(zd_number_list) > 1:
-                        logger.warning('More than one ZD ticket ({}) matched invoice number {}. Arbitrarily using '
-                                       'the first match'.format(zd_number_list,
-                                                                row[self.cufs_map.invoice_field].strip()))
-                    zd_number = zd_number_list[0]
-                    logger.debug('Matched row to ZD number {} via invoice number {} '
-                                 'resolved with invoice2zd_dict'.format(zd_number, row[self.cufs_map.invoice_field]))
-
-                elif m_invoice_number_in_description:
-                    inv_n = m_invoice_number_in_description.group(1)
-                    logger.debug('Invoice number found in description field: {}'.format(inv_n))
-                    if inv_n in cufs.INVOICE2ZD_NUMBER.keys():
-                        zd_number = cufs.INVOICE2ZD_NUMBER[inv_n]
-                        logger.debug('Matched row to ZD number {} via invoice number {} '
-                                     'found in description {}'.format(zd_number, inv_n, row[self.cufs_map.oa_number]))
-                    elif inv_n.lower() in self.invoice2zd_dict.keys():
-                        zd_number_list = self.invoice2zd_dict[inv_n.lower()]
-                        if len(zd_number_list) > 1:
-                            logger.warning('More than one ZD ticket ({}) matched invoice number {}. Arbitrarily using '
-                                       'the first match'.format(zd_number_list, inv_n))
-                        zd_number = zd_number_list[0]
-                        logger.debug('Matched row to ZD number {} via invoice number {} '
-                                 'found in description {} resolved with invoice2zd_dict'.format(zd_number,
-                                                                                inv_n, row[self.cufs_map.oa_number]))
-
-                if zd_number:
-                    process_zd_number(self, zd_number)
-                else:
-                    # Payment could not be linked to a zendesk number
-                    key = 'no_zd_match_' + str(row_counter)
-                    self.rejected_payments[key] = row
-                    debug_filename = os.path.join(os.getcwd(), unmatched_payment_file_prefix + paymentsfile.split('/')[-1])
-                    logger.debug('Row could not be matched to a ZD number. Adding it to {}'.format(debug_filename))
-                    output_debug_csv(debug_filename, row, fileheader)
-                row_counter += 1
-            if unmatched_oa_numbers:
-                unmatched_oa_numbers.sort()
-                logger.warning(
-                    "ZD numbers could not be found for the following OA numbers in {}: {}. Data for these OA numbers "
-                    "will NOT be exported.".format(paymentsfile, unmatched_oa_numbers))
-
-    def plug_in_metadata(self, metadata_file, matching_field, translation_dict, warning_message='', file_encoding='utf-8'):
+    def plug_in_metadata(self, metadata_file, matching_field, translation_dict, warning_message='', file_encoding='utf-8',
+                         fields=None, semi_join=False):
         '''
         This function appends data from various sources (Apollo, etc) to the dictionaries
         produced from the zendesk export (zd_dict and zd_dict_with_payments)
@@ -888,22 +1890,203 @@ class Parser():
         :param translation_dict: dictionary to be used to match new data to a zendesk number
         :param warning_message: message to print if a match could not be found
         :param file_encoding: encoding of input file
+        :param fields: if not None, only columns of metadata_file in this collection are added to tickets (e.g.
+                midas_constants.ReportTemplate.source_fields()); other columns are not parsed into dictionaries
+        :param semi_join: if True, lines of metadata_file whose matching_field is not in translation_dict are
+                rejected before being parsed as CSV (see _semi_join_metadata_rows). Use this for large files of
+                which only a few rows match (e.g. the Europe PMC PMID_PMCID_DOI map); file_encoding must be
+                ASCII compatible (e.g. utf-8)
+        :return: number of rows of metadata_file added to tickets or left unmatched (with semi_join, rows
+                rejected before parsing are not counted)
         '''
+        if semi_join:
+            with open(metadata_file, 'rb') as binfile:
+                return self._merge_metadata_rows(
+                    self._semi_join_metadata_rows(binfile, matching_field, translation_dict, warning_message,
+                                                  file_encoding, fields),
+                    matching_field, translation_dict, warning_message)
         with open(metadata_file, encoding=file_encoding) as csvfile:
-            reader = csv.DictReader(csvfile)
-            row_counter = 0
-            for row in reader:
-                mf = row[matching_field]
-                if matching_field in ['doi', 'DOI']:
-                    mf = prune_and_cleanup_string(mf, DOI_CLEANUP)
-                try:
-                    zd_number_list = translation_dict[mf]
-                except KeyError:
-                    if warning_message:
+            if fields is None:
+                reader = csv.DictReader(csvfile)
+                rows = ((row[matching_field], row) for row in reader)
+            else:
+                rows = self._project_metadata_rows(csv.reader(csvfile), matching_field, fields)
+            return self._merge_metadata_rows(rows, matching_field, translation_dict, warning_message)
+
+    def _merge_metadata_rows(self, rows, matching_field, translation_dict, warning_message):
+        '''
+        Adds rows of a metadata file to the metadata of the tickets they match (see plug_in_metadata)
+        :param rows: iterable of tuples (value of matching_field, dictionary of the row)
+        :return: number of rows
+        '''
+        row_counter = 0
+        for mf, row in rows:
+            if matching_field in ['doi', 'DOI']:
+                mf = normalise_doi(mf)
+            try:
+                zd_number_list = translation_dict[mf]
+            except KeyError:
+                if warning_message:
+                    logger.warning(warning_message)
+                zd_number_list = []
+
+            if zd_number_list:
+                for zd in zd_number_list:
+                    self.zd_dict[zd].metadata.update(row)
+            row_counter += 1
+        return row_counter
+
+    def plug_in_europepmc_index(self, index, translation_dict=None, fields=None):
+        '''
+        Adds the rows of a Europe PMC map matching tickets by DOI to their metadata, like
+        plug_in_metadata(pmc_map, 'DOI', self.doi2zd_dict), but looking up each DOI in a europepmc.EuropePmcIndex of
+        the map instead of reading the whole map. Rows are merged in the order of the map, as plug_in_metadata does,
+        so the same row wins when several rows update a ticket
+        :param index: europepmc.EuropePmcIndex
+        :param translation_dict: dictionary of lists of zd numbers indexed by DOI; defaults to self.doi2zd_dict
+        :param fields: see plug_in_metadata
+        :return: number of rows of the map added to tickets
+        '''
+        if translation_dict is None:
+            translation_dict = self.doi2zd_dict
+        matching_field = index.meta['matching_field']
+
+        def rows():
+            matches = []
+            for doi in translation_dict.keys():
+                if normalise_doi(doi) != doi:
+                    # rows of the map are matched by their normalised DOI, so they can never match this key
+                    continue
+                for position, row in index.lookup_with_positions(doi):
+                    if fields is not None:
+                        row = {k: v for k, v in row.items() if k in fields}
+                    matches.append((position, doi, row))
+            matches.sort(key=operator.itemgetter(0))
+            for position, doi, row in matches:
+                yield doi, row
+
+        return self._merge_metadata_rows(rows(), matching_field, translation_dict, '')
+
+    @staticmethod
+    def _project_metadata_rows(reader, matching_field, fields):
+        '''
+        :param reader: csv.reader of a metadata file
+        :param matching_field: see plug_in_metadata
+        :param fields: see plug_in_metadata
+        :return: generator of tuples (value of matching_field, dictionary of the columns of the row in fields),
+                skipping blank rows and filling missing values with None like csv.DictReader
+        '''
+        header = next(reader, None)
+        if header is None:
+            return
+        # like csv.DictReader, the last of several columns with the same name wins
+        positions = {name: i for i, name in enumerate(header)}
+        match_position = positions[matching_field]
+        projection = [(name, i) for name, i in positions.items() if name in fields]
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < len(header):
+                row = row + [None] * (len(header) - len(row))
+            yield row[match_position], {name: row[i] for name, i in projection}
+
+    @staticmethod
+    def _semi_join_metadata_rows(binfile, matching_field, translation_dict, warning_message='', file_encoding='utf-8',
+                                 fields=None):
+        '''
+        Reads a metadata file as bytes and yields only the rows whose matching_field may be in translation_dict.
+        The file is read in blocks (see read_csv_blocks); the value of matching_field in every line of a block is
+        cut out with a regular expression and looked up in a set of encoded keys of translation_dict, and only
+        lines that match are decoded and parsed as CSV. Blocks containing quotes are checked line by line instead.
+        DOIs are looked up stripped and in lower case, which is how normalise_doi changes ASCII DOIs without a
+        prefix; values that may be changed in other ways (see DOI_PREFIX_PATTERN) are normalised one by one.
+        :param binfile: metadata file opened in binary mode
+        :param matching_field: see plug_in_metadata
+        :param translation_dict: see plug_in_metadata
+        :param warning_message: see plug_in_metadata; logged for every rejected line
+        :param file_encoding: encoding of binfile
+        :param fields: see plug_in_metadata
+        :return: generator of tuples (value of matching_field, dictionary of the row) as in _project_metadata_rows,
+                or as csv.DictReader would return if fields is None
+        '''
+        header_line = binfile.readline()
+        if not header_line:
+            return
+        header = next(csv.reader([header_line.decode(file_encoding)]))
+        positions = {name: i for i, name in enumerate(header)}
+        match_position = positions[matching_field]
+        if fields is not None:
+            projection = [(name, i) for name, i in positions.items() if name in fields]
+        is_doi = matching_field in ['doi', 'DOI']
+        keys = set()
+        for k in translation_dict.keys():
+            try:
+                keys.add(k.encode(file_encoding))
+            except (AttributeError, UnicodeError):
+                pass
+        # DOIs matching this may have a prefix, non-ASCII characters, control characters removed by str.strip or a
+        # typo in DOI_FIX, so they are normalised with normalise_doi before being looked up
+        special_doi_regex = re.compile(b'|'.join([rb'[\x1c-\x1f\x80-\xff]', DOI_PREFIX_PATTERN.encode('ascii')] +
+                                                 [re.escape(typo.encode('ascii')) for typo in DOI_FIX]), re.I)
+        # matches every line; group 1 is the value of matching_field, or empty in rows with fewer columns
+        value_regex = re.compile(rb'^(?:(?:[^,\n]*,){%d}([^,\n]*).*|.*)$' % match_position, re.M)
+
+        def normalise(value):
+            value = value.rstrip(b'\r')
+            if is_doi:
+                return normalise_doi(value.decode(file_encoding)).encode(file_encoding)
+            return value
+
+        def candidate_lines(block):
+            '''
+            :return: lines of block that may match translation_dict
+            '''
+            if (b'"' in block) or warning_message:
+                # check line by line, keeping quoted fields spanning several lines together
+                record = b''
+                for line in block.splitlines(keepends=True):
+                    record += line
+                    if record.count(b'"') % 2:
+                        continue
+                    line, record = record, b''
+                    value = value_regex.match(line).group(1)
+                    if (b'"' in line) or (value is None):
+                        # quoted values are only known after parsing; short and blank lines are left to the parser
+                        yield line
+                    elif normalise(value) in keys:
+                        yield line
+                    elif warning_message:
                         logger.warning(warning_message)
-                    zd_number_list = []
+                if record:
+                    yield record
+                return
+            values = value_regex.findall(block)
+            if is_doi:
+                hits = list(itertools.compress(itertools.count(), map(
+                    keys.__contains__, map(bytes.lower, map(bytes.strip, values)))))
+                special_lines = set(itertools.compress(itertools.count(), map(special_doi_regex.search, values)))
+                if special_lines:
+                    hits = sorted(set(hits).difference(special_lines).union(
+                        i for i in special_lines if normalise(values[i]) in keys))
+            else:
+                hits = list(itertools.compress(itertools.count(),
+                                               map(keys.__contains__, (v.rstrip(b'\r') for v in values))))
+            if hits:
+                lines = block.split(b'\n')
+                for i in hits:
+                    yield lines[i]
 
-                if zd_number_list:
-                    for zd in zd_number_list:
-                        self.zd_dict[zd].metadata.update(row)
-                row_counter += 1
\ No newline at end of file
+        for block in read_csv_blocks(binfile):
+            for line in candidate_lines(block):
+                values = next(csv.reader(io.StringIO(line.decode(file_encoding), newline=None)), None)
+                if not values:
+                    continue
+                if len(values) < len(header):
+                    values = values + [None] * (len(header) - len(values))
+                if fields is not None:
+                    row = {name: values[i] for name, i in projection}
+                else:
+                    row = dict(zip(header, values))
+                    if len(values) > len(header):
+                        row[None] = values[len(header):]
+                yield values[match_position], row
\ No newline at end of file
@@ -13,9 +13,9 @@ Simple script to filter a CSV export downloaded from Zendesk
 import argparse
 import datetime
 import logging
-import logging.config
 import os
 
+from common.oatslogging import configure_logging
 from common.oatsutils import get_latest_csv
 from common.zendesk import filter_zendesk_export as zd_filter
 from common.zendesk import ZdFieldsMapping as FieldMap
@@ -83,7 +83,7 @@ http://www.gnu.org/copyleft/gpl.html
         os.makedirs(working_folder)
 
     logfilename = os.path.join(working_folder, 'filter_zendesk_export.log')
-    logging.config.fileConfig('logging.conf', defaults={'logfilename': logfilename})
+    configure_logging('logging.conf', logfilename)
     logger = logging.getLogger('filter_zendesk_export')
 
     os.chdir(working_folder)
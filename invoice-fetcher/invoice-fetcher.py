@@ -11,6 +11,10 @@ from pprint import pprint
 sys.path.append(os.path.relpath('..'))#this only works if this script is executed from its containing folder.
 #sys.path.append(os.path.abspath('/home/asartori/afs_support_files/Scripts/PythonScripts'))
 import common
+from common.cufs import ReferenceResolver, SINGLE_ZD_SEPARATOR_PATTERN
+from common.invoices import get_invoice_index, GOOD_MATCH
+from common.zendesk import TicketQueryIndex
+from pdfapps.helpers import CopyScheduler
 
 # parser = argparse.ArgumentParser(description='Fetch invoices from the OSC shared folder based on zendesk ticket matches.')
 # parser.add_argument('-p', '--publisher', help='the publisher that issued the invoices of interest')
@@ -29,67 +33,30 @@ def plog(*args):
     # logfile.write('\n')
     pass
 
+query_indexes = {}
+
 def query_zd_dict(case_sensitive=False, match_all=True, **kwargs):
     '''
     This function returns a dictionary containing only zendesk tickets that match ANY or ALL
     conditions specified in a query (depending on the value of parameter match_all);
     if the query contains a list of possible values for a particular kwarg,
-    then this list will be evaluated on a OR match basis
+    then this list will be evaluated on a OR match basis. Queries are answered by a
+    TicketQueryIndex of zd_dict, built on first use
     :param kwargs: the query
     :return:
     '''
-    zd_matches = {}
-    if match_all == True:
-        for t in zd_dict:
-            is_match = True
-            for a in kwargs:
-                if type(kwargs[a]) == type([0,1]): #if list, match with OR
-                    subarg_match = False
-                    for b in kwargs[a]:
-                        if case_sensitive==False:
-                            if zd_dict[t][a].upper().strip() == b.upper().strip():
-                                subarg_match = True
-                        elif case_sensitive == True:
-                            if zd_dict[t][a].strip() == b.strip():
-                                subarg_match = True
-                    if not subarg_match == True:
-                        is_match = False
-                else:
-                    if case_sensitive == False:
-                        if not zd_dict[t][a].upper().strip() == kwargs[a].upper().strip():
-                            is_match = False
-                    elif case_sensitive == True:
-                        if not zd_dict[t][a].strip() == kwargs[a].strip():
-                            is_match = False
-            if is_match == True:
-                zd_matches[t] = zd_dict[t]
-    elif match_all == False:
-        for t in zd_dict:
-            is_match = False
-            for a in kwargs:
-                if type(kwargs[a]) == type([0,1]): #if list, match with OR
-                    subarg_match = False
-                    for b in kwargs[a]:
-                        if case_sensitive==False:
-                            if zd_dict[t][a].upper().strip() == b.upper().strip():
-                                subarg_match = True
-                        elif case_sensitive == True:
-                            if zd_dict[t][a].strip() == b.strip():
-                                subarg_match = True
-                    if subarg_match == True:
-                        is_match = True
-                else:
-                    if case_sensitive == False:
-                        if zd_dict[t][a].upper().strip() == kwargs[a].upper().strip():
-                            is_match = True
-                    elif case_sensitive == True:
-                        if zd_dict[t][a].strip() == kwargs[a].strip():
-                            is_match = True
-            if is_match == True:
-                zd_matches[t] = zd_dict[t]
-    else:
+    if match_all not in [True, False]:
         print('query_zd_dict: ERROR: match_all can only be True or False.')
-    return(zd_matches)
+        return({})
+    if case_sensitive not in query_indexes.keys():
+        query_indexes[case_sensitive] = TicketQueryIndex(zd_dict, case_sensitive=case_sensitive)
+    return(query_indexes[case_sensitive].query(match_all=match_all, **kwargs))
+
+# finds ZD and OA numbers in descriptions of payments (memoised); only one space or hyphen is accepted after "ZD"
+reference_resolver = ReferenceResolver(zd_separator=SINGLE_ZD_SEPARATOR_PATTERN)
+
+# copies invoice files found by copy_invoice_to_current_folder (closed at the end of the script)
+copy_scheduler = CopyScheduler()
 
 ###MANUAL FIXES FOR PAYMENT FILES
 zd_number_typos = {} #{'30878':'50878'}
@@ -110,8 +77,6 @@ def get_invoice_variables_from_finance_report(paymentsfile, oa_number_field, inv
                                     for APC payments (EBDU) or page/colour (EBDV)
     :param source_funds_code_field: name of field in input file containing the source of funds code (JUDB)
     '''
-    t_oa = re.compile("OA[ \-]?[0-9]{4,8}")
-    t_zd = re.compile("ZD[ \-]?[0-9]{4,8}")
     invoicevariables = []
     with open(paymentsfile, encoding=file_encoding) as csvfile:
         reader = csv.DictReader(csvfile)
@@ -122,12 +87,10 @@ def get_invoice_variables_from_finance_report(paymentsfile, oa_number_field, inv
             oa_number = ''
             if row[oa_number_field] in oa_number_typos.keys():
                 row[oa_number_field] = oa_number_typos[row[oa_number_field]]
-            # print('\n', 'oa_number_field:', oa_number_field)
-            m_oa = t_oa.search(row[oa_number_field].upper())
-            m_zd = t_zd.search(row[oa_number_field].upper())
-            # before = row[oa_number_field]
-            if m_oa:
-                oa_number = m_oa.group().upper().replace("OA", "OA-").replace(" ", "").replace('--','-')
+            description = row[oa_number_field]
+            zd_reference, oa_reference = reference_resolver.find_references(description)[:2]
+            if oa_reference:
+                oa_number = oa_reference.replace("OA", "OA-").replace(" ", "").replace('--','-')
                 try:
                     zd_number = oa2zd_dict[oa_number]
                 except KeyError:
@@ -138,8 +101,8 @@ def get_invoice_variables_from_finance_report(paymentsfile, oa_number_field, inv
                         print("WARNING: A ZD number could not be found for", oa_number, "in",
                               paymentsfile + ". Data for this OA number will NOT be exported.")
                         zd_number = ''
-            elif m_zd:
-                zd_number = m_zd.group().replace(" ", "-").strip('ZDzd -')
+            elif zd_reference:
+                zd_number = zd_reference.replace(" ", "-").strip('ZDzd -')
             else:
                 zd_number = ''
             if invoice_number in invoice2zd_number.keys():
@@ -163,49 +126,24 @@ def copy_invoice_to_current_folder(invoicefolder, oa_number, zd_number, invoice_
     :param destfolder: path of the destination folder where the invoice will be copied to
     :return:
     '''
-    invoice_number = invoice_number.strip()
-    oa_number = oa_number.strip()
-    zd_number = zd_number.strip()
     dubiousfolder = os.path.join(destfolder, 'matches_on_invoice_number_alone')
     status = False
     matchquality = 0  # 'false'
     if not os.path.exists(dubiousfolder):
         os.makedirs(dubiousfolder)
-    # for i in os.listdir(invoicefolder):
-    #     status = False
-    #     if (invoice_number in i) and ((oa_number in i) or (zd_number in i)):
-    #         status = True
-    #         matchquality = 10  # 'good'
-    #         shutil.copy2(os.path.join(invoicefolder, i), destfolder)
-    #     elif invoice_number in i:
-    #         status = True
-    #         matchquality = 5  # 'satisfactory'
-    #         shutil.copy2(os.path.join(invoicefolder, i), dubiousfolder)
-    #     else:
-    #         matchquality = 0  # 'false'
-    #     return (status, matchquality)
-    for root, dirs, files in os.walk(invoicefolder, topdown=False):
-        plog('ROOT:', root)
-        for i in files:
-            plog(i)
-            plog(invoice_number, oa_number, zd_number)
-            if case_sensitive == False:
-                i = i.upper()
-                invoice_number = invoice_number.upper()
-                oa_number = oa_number.upper()
-                zd_number = zd_number.upper()
-            if (invoice_number in i) and ((oa_number != '') or (zd_number != '')) and ((oa_number in i) or (zd_number in i)):
-                plog('Good match!')
-                status = True
-                matchquality = 10 #'good'
-                shutil.copy2(os.path.join(root, i), destfolder)
-            elif invoice_number in i:
-                plog('Satisfactory match!')
-                status = True
-                matchquality = 5  # 'satisfactory'
-                shutil.copy2(os.path.join(root, i), dubiousfolder)
-            else:
-                plog('No match!')
+    # the invoice folder is only walked once per run (see common.invoices.InvoiceFileIndex); files are copied
+    # in the background and deduplicated by copy_scheduler
+    for path, quality in get_invoice_index(invoicefolder).find(invoice_number, oa_number, zd_number,
+                                                               case_sensitive=case_sensitive):
+        plog(path, quality)
+        status = True
+        matchquality = quality
+        if quality == GOOD_MATCH:
+            plog('Good match!')
+            copy_scheduler.copy(path, destfolder)
+        else:
+            plog('Satisfactory match!')
+            copy_scheduler.copy(path, dubiousfolder)
     plog(status, matchquality)
     return (status, matchquality)
 
@@ -231,6 +169,7 @@ def search_using_cufs_data(*args):
         print('Parsing finance report:', report)
         plog('Parsing finance report:', report)
         invoices = get_invoice_variables_from_finance_report(os.path.join(financereportsfolder, report), 'Description')
+        get_invoice_index(invoicefolder).prepare([i[0] for i in invoices])
         for i in invoices:
             (invoicenumber, source_funds_code, transaction_code, oanumber, zdnumber) = i
             # print(invoicenumber, source_funds_code, transaction_code, oanumber, zdnumber)
@@ -267,6 +206,7 @@ def search_using_zendesk_data(user_query):
     '''
     logfile = open(logfilename, 'a')
     logfile.write('Began search for invoices using Zendesk data')
+    get_invoice_index(invoicefolder).prepare([matches[m][n] for m in matches for n in invoicenumberfields])
     for m in matches:
         zdnumber = m
         t = matches[m]
@@ -357,4 +297,8 @@ elif search_method in ['both']:
                            'VEJI TRX REPORT JAN 12 - MAR 17.csv')
     search_using_zendesk_data(user_query)
 else:
-    print('ERROR: Search method', search_method, 'unknown!')
\ No newline at end of file
+    print('ERROR: Search method', search_method, 'unknown!')
+try:
+    copy_scheduler.close()
+except PermissionError as e:
+    sys.exit(str(e))
@@ -14,16 +14,19 @@ import datetime
 import dateutil.parser
 import collections
 import logging
-import logging.config
 import sys
 # import xlsxwriter
 from pprint import pprint
 from difflib import SequenceMatcher
 
 import common.cufs as cufs
+import common.europepmc as europepmc
 import common.midas_constants as mc
+import common.oatslogging as oatslogging
+import common.profiling as profiling
 import common.zendesk as zendesk
-from common.oatsutils import convert_date_str_to_yyyy_mm_dd, extract_csv_header, get_latest_csv, output_debug_csv
+from common.oatsutils import close_debug_csvs, convert_date_str_to_yyyy_mm_dd, extract_csv_header, get_latest_csv, \
+    output_debug_csv
 
 # create logger
 logger = logging.getLogger(__name__)
@@ -80,6 +83,10 @@ class Report():
         self.articles=[]
 
     def output_csv(self):
+        '''
+        Writes self.articles to a CSV report in the current folder
+        :return: the filename of the report
+        '''
         filename = '{}_midas_report.csv'.format(datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
         with open(filename, 'w') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=self.fieldnames, extrasaction='ignore')
@@ -100,21 +107,24 @@ class Report():
                     writer.writerow(ticket)
                 # else:
                 #     excluded_recs[ticket] = report_dict[ticket]
+        return filename
 
-    def parse_cufs_data(self, cufs_datasources=None):
+    def parse_cufs_data(self, cufs_datasources=None, processes=None):
         '''
         Populates self.zd_parser.zd_dict with data from CUFS reports. Once all CUFS reports have been parsed,
         add zendesk.Ticket.apc_grand_total and other total amount fields as kwargs to self.zd_parser.zd_dict and
         self.zd_parser.zd_dict_with_payments   
 
         :param cufs_datasources: An array of CUFS reports, each being a list in the format [filename, format, funder]
+        :param processes: maximum number of processes used to parse CUFS reports in parallel (see
+                zendesk.Parser.plug_in_payment_files)
+        :return: number of rows of the CUFS reports
         '''
 
         if not self.zd_parser.zd_dict.keys():
             self.zd_parser.index_zd_data()
-        for datasource in cufs_datasources:
-            logger.info('Parsing CUFS report {}'.format(datasource))
-            self.zd_parser.plug_in_payment_data(datasource[0], datasource[1], datasource[2])
+        logger.info('Parsing CUFS reports {}'.format(cufs_datasources))
+        row_counter = self.zd_parser.plug_in_payment_files(cufs_datasources, processes=processes)
 
         for dict in [self.zd_parser.zd_dict, self.zd_parser.zd_dict_with_payments]:
             for k, t in dict.items():
@@ -125,18 +135,25 @@ class Report():
                     t.metadata['ticket.coaf_other_total'] = str(t.coaf_other_total)
                     t.metadata['ticket.rcuk_apc_total'] = str(t.rcuk_apc_total)
                     t.metadata['ticket.rcuk_other_total'] = str(t.rcuk_other_total)
+        return row_counter
 
-    def plugin_apollo(self, apollo_exports=None):
+    def plugin_apollo(self, apollo_exports=None, fields=None):
         '''
         Populates self.zd_parser.zd_dict with data from Apollo reports
 
         :param apollo_exports: A list of Apollo reports
+        :param fields: if not None, only these columns of Apollo reports are stored in tickets (e.g.
+                midas_constants.ReportTemplate.source_fields())
+        :return: number of rows of the Apollo reports
         '''
         if not self.zd_parser.zd_dict.keys():
             self.zd_parser.index_zd_data()
+        row_counter = 0
         for datasource in apollo_exports:
             logger.info('Parsing Apollo export {}'.format(datasource))
-            self.zd_parser.plug_in_metadata(datasource, 'handle', self.zd_parser.apollo2zd_dict)
+            row_counter += self.zd_parser.plug_in_metadata(datasource, 'handle', self.zd_parser.apollo2zd_dict,
+                                                           fields=fields)
+        return row_counter
 
     def parse_old_payments_spreadsheet(self, csv_path=None):
         #TODO: This function can probably be deleted. Pluging in data from this old spreadsheet is probably the wrong way to go about this. It is probably better to use this old sheet only to try to identify CUFS transactions that could not be easily linked to ZD
@@ -158,16 +175,29 @@ class Report():
         logger.info('Parsing old payment spreadsheet {}'.format(csv_path))
         self.zd_parser.plug_in_metadata(csv_path, 'Zendesk Number', self.zd_parser.zd2zd_dict)
 
-    def plugin_pmc(self, pmc_exports=None):
+    def plugin_pmc(self, pmc_exports=None, fields=None, use_index=True):
         '''
         Populates self.zd_parser.zd_dict with data from Europe PMC
         :param pmc_exports: A list of PMC exports
+        :param fields: if not None, only these columns of PMC exports are stored in tickets (e.g.
+                midas_constants.ReportTemplate.source_fields())
+        :param use_index: if True, DOIs are looked up in an index of each export, built the first time a version
+                of the export is used (see common.europepmc); otherwise the whole export is read
+        :return: number of rows of the PMC exports matching DOIs in Zendesk
         '''
         if not self.zd_parser.zd_dict.keys():
             self.zd_parser.index_zd_data()
+        row_counter = 0
         for datasource in pmc_exports:
             logger.info('Parsing EuropePMC export {}'.format(datasource))
-            self.zd_parser.plug_in_metadata(datasource, 'DOI', self.zd_parser.doi2zd_dict)
+            if use_index:
+                with europepmc.get_europepmc_index(datasource) as index:
+                    row_counter += self.zd_parser.plug_in_europepmc_index(index, fields=fields)
+            else:
+                # the PMC map has tens of millions of rows, of which only those with a DOI in Zendesk are parsed
+                row_counter += self.zd_parser.plug_in_metadata(datasource, 'DOI', self.zd_parser.doi2zd_dict,
+                                                               fields=fields, semi_join=True)
+        return row_counter
 
     def populate_invoiced_articles(self, debug_csv='Midas_debug_tickets_without_payments_from_report_requester_or_a_'
                                                    'balance_of_zero.csv'):
@@ -178,14 +208,14 @@ class Report():
         for k, t in self.zd_parser.zd_dict_with_payments.items():
             if self.rcuk and (t.rcuk_apc_total or t.rcuk_other_total):
                 self.articles.append(t)
-                logger.debug('ZD number {} contains RCUK payments. Adding ticket to Report.articles'.format(k))
+                logger.debug('ZD number %s contains RCUK payments. Adding ticket to Report.articles', k)
             elif self.coaf and (t.coaf_apc_total or t.coaf_other_total):
                 self.articles.append(t)
-                logger.debug('ZD number {} contains COAF payments. Adding ticket to Report.articles'.format(k))
+                logger.debug('ZD number %s contains COAF payments. Adding ticket to Report.articles', k)
             else:
-                logger.debug('Adding ZD ticket info to {}. ZD number {} either does not contain payments from report requester '
+                logger.debug('Adding ZD ticket info to %s. ZD number %s either does not contain payments from report requester '
                              '(e.g. RCUK and/or COAF) or the balance of payments is zero. It will '
-                             'not be included in Report.articles'.format(debug_csv, k))
+                             'not be included in Report.articles', debug_csv, k)
                 t.output_payment_summary_as_csv(os.path.join(working_folder, debug_csv))
 
     def populate_report_fields(self, report_template, default_publisher='', default_pubtype='',
@@ -274,6 +304,7 @@ def valid_date(s):
         raise argparse.ArgumentTypeError(msg)
 
 def clear_debug_files(wf):
+    close_debug_csvs()
     for i in os.listdir(wf):
         if not os.path.isdir(i):
             if i[0:12] == 'Midas_debug_':
@@ -339,21 +370,43 @@ def main(arguments):
 
     # get the report object
     rep = Report(zenexport, report_type=report_type)
+    rep.zd_parser.use_payment_ledger = arguments.payment_ledger
     # logger.info('arguments.coaf: {}; arguments.rcuk: {}; report_type: {}; rep.coaf: {}; '
     #             'rep.rcuk: {}'.format(arguments.coaf, arguments.rcuk, report_type, rep.coaf, rep.rcuk))
-    rep.zd_parser.index_zd_data()
 
+    # time and memory used by each stage (only measured with --profile)
+    profiler = profiling.StageProfiler(enabled=arguments.profile, cprofile=arguments.cprofile,
+                                       output_folder=working_folder, prefix='midas_profile')
+    with profiler.stage('index_zd_data') as stage:
+        rep.zd_parser.index_zd_data()
+        stage.rows = len(rep.zd_parser.zd_dict)
+
+    # only metadata used by the report is stored in tickets
+    report_template = mc.ReportTemplate()
     if not arguments.ignore_apollo:
-        rep.plugin_apollo(apollo_exports)
+        with profiler.stage('plugin_apollo') as stage:
+            stage.rows = rep.plugin_apollo(apollo_exports, fields=report_template.source_fields())
     if not arguments.ignore_pmc:
-        rep.plugin_pmc(pmc_exports)
+        with profiler.stage('plugin_pmc') as stage:
+            stage.rows = rep.plugin_pmc(pmc_exports, fields=report_template.source_fields())
 
     # rep.parse_old_payments_spreadsheet(os.path.join(working_folder, 'LST_AllFinancialData_V3_20160721_Main_Sheet.csv'))
-    rep.parse_cufs_data(paymentfiles)
-
-    rep.populate_invoiced_articles()
-    rep.populate_report_fields(report_template=mc.ReportTemplate())
-    rep.output_csv()
+    with profiler.stage('parse_cufs_data') as stage:
+        stage.rows = rep.parse_cufs_data(paymentfiles)
+
+    with profiler.stage('populate_invoiced_articles') as stage:
+        rep.populate_invoiced_articles()
+        stage.rows = len(rep.zd_parser.zd_dict_with_payments)
+    with profiler.stage('populate_report_fields') as stage:
+        rep.populate_report_fields(report_template=report_template)
+        stage.rows = len(rep.articles)
+    with profiler.stage('output_csv') as stage:
+        report_filename = rep.output_csv()
+        stage.rows = len(rep.articles)
+    close_debug_csvs()
+    if arguments.profile:
+        profiler.log_summary(logger)
+        profiler.save_json(os.path.splitext(report_filename)[0] + '_profile.json')
 
 if __name__ == '__main__':
 
@@ -415,8 +468,17 @@ http://www.gnu.org/copyleft/gpl.html
                         help='Path to folder where {} should save output files (default: %(default)s)'.format(
                             '%(prog)s'),
                         default=os.path.join(home, 'OATs', 'Midas-wd'))
+    parser.add_argument('--payment-ledger', dest='payment_ledger', action='store_true',
+                        help='Add CUFS payments to tickets in bulk, keeping totals in integer pence so that they are '
+                             'exact to the penny (default: %(default)s)')
     parser.add_argument('-p', '--ignore-pmc', dest='ignore_pmc', action='store_true',
                         help='Do not include metadata exported from Europe PMC (default: %(default)s)')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Measure the time and memory used by each stage; a summary is written to midas.log '
+                             'and the measurements to a JSON file next to the report (default: %(default)s)')
+    parser.add_argument('--cprofile', dest='cprofile', action='store_true',
+                        help='With --profile, also run cProfile during each stage and save pstats and '
+                             'collapsed-stack files to the output folder (default: %(default)s)')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s {}'.format(__version__))
     parser.add_argument('-w', '--wiley', dest='wiley', default=True, type=bool, metavar='True or False',
                         help='Include articles approved via Wiley institutional account (default: %(default)s)')
@@ -436,7 +498,8 @@ http://www.gnu.org/copyleft/gpl.html
         os.makedirs(working_folder)
 
     logfilename = os.path.join(working_folder, 'midas.log')
-    logging.config.fileConfig('logging.conf', defaults={'logfilename': logfilename})
+    # records are written to the log file by a background thread
+    oatslogging.configure_logging('logging.conf', logfilename)
     logger = logging.getLogger('midas')
 
     os.chdir(working_folder)
@@ -9,7 +9,7 @@ import time
 import subprocess
 
 from common.oatsutils import oatslogger
-from pdfapps.helpers import oats_copy, oats_move
+from pdfapps.helpers import oats_copy, oats_move, CopyScheduler
 
 start_time = time.time()
 
@@ -229,7 +229,10 @@ else:
 # REPLACE FIRST PAGE WITH STAMPED COPY
 src = os.path.join(oasisfolder, "overlay.pdf")
 dst = os.path.join(oasisfolder, "tempinv01.pdf")
-oats_copy(src, dst)
+try:
+    oats_copy(src, dst)
+except PermissionError as e:
+    sys.exit(str(e))
 
 # MERGE PAGES AGAIN IF INVOICE HAS MORE THAN ONE PAGE OR RENAME 1 PAGE INVOICES
 stampedinvoice = os.path.join(oasisfolder, "stamped_invoice.pdf")
@@ -241,7 +244,10 @@ if nopages > 1 and not pdftk_error:
 else:
     src = os.path.join(oasisfolder, "tempinv01.pdf")
     dst = stampedinvoice
-    oats_copy(src, dst)
+    try:
+        oats_copy(src, dst)
+    except PermissionError as e:
+        sys.exit(str(e))
 
 # OBTAIN INVOICE DATA AND RENAME THE FILE TO <OA/ZD NUMBER>_<INVOICE NUMBER>.PDF
 invno = ""
@@ -270,7 +276,10 @@ invfilename = refno + "_" + invno + ".pdf"
 logger.plog("OASIS: Renaming invoice to {}.pdf".format(invfilename))
 src = stampedinvoice
 dst = os.path.join(oasisfolder, invfilename)
-oats_move(src, dst)
+try:
+    oats_move(src, dst)
+except PermissionError as e:
+    sys.exit(str(e))
 
 tpublisher = re.compile('%%PUBLISHER: .+')
 mpublisher = tpublisher.search(varcontent)
@@ -296,37 +305,43 @@ if magent:
     agent = magent.group(1)
 
 # COPY FILE TO PRINTFOLDERS AND FILE IT ON THE O: DRIVE
-if invfilename not in os.listdir(printfolder):
-    src = os.path.join(oasisfolder, invfilename)
-    dst = os.path.join(printfolder, invfilename)
-    oats_copy(src, dst)
-    logger.plog("OASIS: copied stamped invoice to", printfolder)
-else:
-    msg = "Invoice " + invfilename + " already exists in " + printfolder
-    overwrite = input("OASIS: " + msg + ". Would you like to overwrite it? (y/n)[n]")
-    if overwrite in ["Y", 'y']:
-        src = os.path.join(oasisfolder, invfilename)
-        dst = os.path.join(printfolder, invfilename)
-        oats_copy(src, dst)
-        logger.plog("OASIS: copied stamped invoice to", printfolder)
-    else:
-        sys.exit("OASIS ERROR:", msg)
-
-if invfilename not in os.listdir(filingfolder):
-    src = os.path.join(oasisfolder, invfilename)
-    dst = os.path.join(filingfolder, invfilename)
-    oats_move(src, dst)
-    logger.plog("OASIS: moved stamped invoice to", filingfolder)
-else:
-    msg = "Invoice " + invfilename + " already exists in " + filingfolder
-    overwrite = input("OASIS: " + msg + ". Would you like to overwrite it? (y/n)[n]")
-    if overwrite in ["Y", 'y']:
-        src = os.path.join(oasisfolder, invfilename)
-        dst = os.path.join(filingfolder, invfilename)
-        oats_move(src, dst)
-        logger.plog("OASIS: moved stamped invoice to", filingfolder)
-    else:
-        sys.exit("OASIS ERROR:", msg)
+# both transfers to the shared drive run at the same time; the local copy is only deleted after both finished
+try:
+    with CopyScheduler() as copy_scheduler:
+        if invfilename not in os.listdir(printfolder):
+            src = os.path.join(oasisfolder, invfilename)
+            dst = os.path.join(printfolder, invfilename)
+            copy_scheduler.copy(src, dst)
+            logger.plog("OASIS: copying stamped invoice to", printfolder)
+        else:
+            msg = "Invoice " + invfilename + " already exists in " + printfolder
+            overwrite = input("OASIS: " + msg + ". Would you like to overwrite it? (y/n)[n]")
+            if overwrite in ["Y", 'y']:
+                src = os.path.join(oasisfolder, invfilename)
+                dst = os.path.join(printfolder, invfilename)
+                copy_scheduler.copy(src, dst)
+                logger.plog("OASIS: copying stamped invoice to", printfolder)
+            else:
+                sys.exit("OASIS ERROR:", msg)
+
+        if invfilename not in os.listdir(filingfolder):
+            src = os.path.join(oasisfolder, invfilename)
+            dst = os.path.join(filingfolder, invfilename)
+            copy_scheduler.move(src, dst)
+            logger.plog("OASIS: moving stamped invoice to", filingfolder)
+        else:
+            msg = "Invoice " + invfilename + " already exists in " + filingfolder
+            overwrite = input("OASIS: " + msg + ". Would you like to overwrite it? (y/n)[n]")
+            if overwrite in ["Y", 'y']:
+                src = os.path.join(oasisfolder, invfilename)
+                dst = os.path.join(filingfolder, invfilename)
+                copy_scheduler.move(src, dst)
+                logger.plog("OASIS: moving stamped invoice to", filingfolder)
+            else:
+                sys.exit("OASIS ERROR:", msg)
+except PermissionError as e:
+    sys.exit(str(e))
+logger.plog("OASIS:", copy_scheduler.summary())
 
 # WARN USER IF THERE ARE INVOICES THAT SHOULD BE PRINTED SOON
 maxnoinvtoprint = 10
@@ -99,7 +99,10 @@ else:
 waiver_filename = refno + "_waiver.pdf"
 src = os.path.join(outlawfolder, 'OutLAW_overlay.pdf')
 dst = os.path.join(outlawfolder, waiver_filename)
-oats_copy(src, dst)
+try:
+    oats_copy(src, dst)
+except PermissionError as e:
+    sys.exit(str(e))
 
 # GET RID OF THE REMAINING TEMPORARY FILES
 os.system(rm_cmd + " OutLAW_overlay.aux OutLAW_overlay.log OutLAW_overlay.synctex.gz")
\ No newline at end of file
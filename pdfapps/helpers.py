@@ -1,19 +1,212 @@
-import sys
+import concurrent.futures
+import hashlib
+import logging
+import os
 import shutil
+import threading
+import time
+
+# create logger
+logger = logging.getLogger(__name__)
 
 perm_err = 'ERROR: You do not have permission to write to {}. Close any application that might be accessing that ' \
            'file and/or try running this program again as a superuser/administrator.'
 
+# Maximum number of files copied at the same time by a CopyScheduler
+COPY_WORKERS = 4
+# Modification times closer than this (in seconds) are considered equal, because network drives and FAT file
+# systems store them with a resolution of up to 2 seconds
+MTIME_TOLERANCE = 2
+
 def oats_copy(src, dst):
+    '''
+    :raise PermissionError: with message perm_err if dst cannot be written
+    '''
     try:
         shutil.copy(src, dst)
-    except PermissionError:
-        sys.exit(perm_err.format(dst))
+    except PermissionError as e:
+        raise PermissionError(perm_err.format(dst)) from e
 
 
 def oats_move(src, dst):
+    '''
+    :raise PermissionError: with message perm_err if dst cannot be written
+    '''
     try:
         shutil.move(src, dst)
-    except PermissionError:
-        sys.exit(perm_err.format(dst))
+    except PermissionError as e:
+        raise PermissionError(perm_err.format(dst)) from e
+
+
+class CopyScheduler():
+    '''
+    Copies and moves files in a pool of threads, so that the latency of each copy to or from a network drive
+    overlaps with the others instead of adding up.
+
+    Copies are deduplicated: a file is not copied again to a destination it was already scheduled to be copied
+    to, and a copy is skipped if the destination already has the same content (same size, modification time
+    and SHA-1 hash, or same hash as a file copied there during this run). Operations on the same destination,
+    and a move after copies of the same source, run in the order they were scheduled.
+
+    Use as a context manager, or call close() to wait for all scheduled operations to finish. Errors are raised
+    there rather than in the threads; a destination that cannot be written raises PermissionError with message
+    perm_err.
+    '''
+    def __init__(self, max_workers=COPY_WORKERS):
+        '''
+        :param max_workers: maximum number of files copied at the same time
+        '''
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.scheduled = {}  # (source, destination) -> future
+        self.last_by_destination = {}  # destination -> future of last operation writing to it
+        self.by_source = {}  # source -> futures of operations reading it
+        self.written = set()  # destinations written to during this run
+        self.digests = {}
+        self.copied_counter = 0
+        self.skipped_counter = 0
+        self.copied_bytes = 0
+        self.start_time = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def destination_file(src, dst):
+        '''
+        :return: path of the file that shutil.copy2(src, dst) would write
+        '''
+        if os.path.isdir(dst):
+            return os.path.join(dst, os.path.basename(src))
+        return dst
+
+    def digest(self, path):
+        '''
+        :param path: path of a file
+        :return: SHA-1 hash of the file, memoised for as long as its size and modification time do not change
+        '''
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            digest = self.digests.get(key)
+        if digest is None:
+            # hashed outside the lock, so that other files can be hashed and copied meanwhile
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha1.update(chunk)
+            digest = sha1.hexdigest()
+            with self.lock:
+                self.digests[key] = digest
+        return digest
+
+    def is_up_to_date(self, src, dst):
+        '''
+        :return: True if dst already has the same content as src
+        '''
+        if not os.path.exists(dst):
+            return False
+        src_stat = os.stat(src)
+        dst_stat = os.stat(dst)
+        if src_stat.st_size != dst_stat.st_size:
+            return False
+        if dst in self.written:
+            # the modification time of dst is that of the file copied there earlier
+            return self.digest(src) == self.digest(dst)
+        if abs(src_stat.st_mtime - dst_stat.st_mtime) > MTIME_TOLERANCE:
+            return False
+        return self.digest(src) == self.digest(dst)
+
+    def copy(self, src, dst):
+        '''
+        Schedules a copy of src to dst, as shutil.copy2 (i.e. preserving modification time)
+        :param src: path of the file to copy
+        :param dst: path of the destination file or folder
+        :return: concurrent.futures.Future, whose result is True if the file was copied and False if skipped
+        '''
+        return self._schedule(src, dst, move=False)
+
+    def move(self, src, dst):
+        '''
+        Schedules a move of src to dst: src is copied like in copy, then deleted after any other copies of it
+        scheduled before have finished
+        :param src: path of the file to move
+        :param dst: path of the destination file or folder
+        :return: concurrent.futures.Future
+        '''
+        return self._schedule(src, dst, move=True)
+
+    def _schedule(self, src, dst, move):
+        dst = self.destination_file(src, dst)
+        key = (os.path.abspath(src), os.path.abspath(dst))
+        with self.lock:
+            if (not move) and (key in self.scheduled):
+                return self.scheduled[key]
+            waits = []
+            if key[1] in self.last_by_destination:
+                waits.append(self.last_by_destination[key[1]])
+            if move:
+                waits.extend(self.by_source.get(key[0], []))
+            future = self.executor.submit(self._run, key[0], key[1], move, waits)
+            self.scheduled[key] = future
+            self.last_by_destination[key[1]] = future
+            self.by_source.setdefault(key[0], []).append(future)
+            self.futures.append(future)
+        return future
+
+    def _run(self, src, dst, move, waits):
+        # earlier operations on the same files; they were submitted first, so they are already running or queued
+        # ahead of this one
+        concurrent.futures.wait(waits)
+        try:
+            if self.is_up_to_date(src, dst):
+                logger.debug('Skipped copy of {} to {}: destination is up to date'.format(src, dst))
+                copied = False
+            else:
+                size = os.path.getsize(src)
+                shutil.copy2(src, dst)
+                with self.lock:
+                    self.written.add(dst)
+                    self.copied_counter += 1
+                    self.copied_bytes += size
+                copied = True
+            if move:
+                os.remove(src)
+        except PermissionError as e:
+            raise PermissionError(perm_err.format(dst)) from e
+        if not copied:
+            with self.lock:
+                self.skipped_counter += 1
+        return copied
+
+    def summary(self):
+        '''
+        :return: string reporting the number of files copied and skipped, and the throughput
+        '''
+        elapsed = time.monotonic() - self.start_time
+        return '{} files copied ({:.1f} MB, {:.2f} MB/s), {} skipped as already up to date'.format(
+            self.copied_counter, self.copied_bytes / 1e6, self.copied_bytes / 1e6 / max(elapsed, 1e-6),
+            self.skipped_counter)
+
+    def wait(self):
+        '''
+        Waits for all scheduled operations to finish, raising the first error if any failed
+        '''
+        with self.lock:
+            futures = list(self.futures)
+        for f in futures:
+            f.result()
 
+    def close(self):
+        '''
+        Waits for all scheduled operations to finish and stops the threads
+        '''
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
+            logger.info(self.summary())
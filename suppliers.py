@@ -6,10 +6,10 @@ Extracts a list of unique supplier names from reports exported from CUFS
 
 import csv
 import logging
-import logging.config
 import os
 import sys
 from common.cufs import CoafFieldsMapping, RcukFieldsMapping, RgeFieldsMapping
+from common.oatslogging import configure_logging
 
 # create logger
 logger = logging.getLogger(__name__)
@@ -31,7 +31,7 @@ if __name__ == '__main__':
     working_folder = os.path.join(home, "OATs", "cufs-reports")
 
     logfilename = os.path.join(working_folder, 'suppliers.log')
-    logging.config.fileConfig('logging.conf', defaults={'logfilename': logfilename})
+    configure_logging('logging.conf', logfilename)
     logger = logging.getLogger('suppliers')
 
     os.chdir(working_folder)
@@ -65,8 +65,8 @@ if __name__ == '__main__':
             reader = csv.DictReader(csvfile)
             row_counter = 0
             for row in reader:
-                logger.debug('-------------- {} [{}] Working on {} row: {}'.format(general_counter, row_counter,
-                                                                                   csvfile, row))
+                logger.debug('-------------- %s [%s] Working on %s row: %s', general_counter, row_counter, csvfile,
+                             row)
                 sup_key = row[cufs_map.supplier].lower().strip()
                 if sup_key:
                     amount = float(row[cufs_map.amount_field].replace(',', ''))
@@ -84,6 +84,6 @@ if __name__ == '__main__':
             out_s = suppliers[s]
             writer.writerow(out_s)
             # writer.writerow([out_s])
-            logger.debug("Output: {}".format(out_s))
+            logger.debug("Output: %s", out_s)
 
     logger.info("Finished processing {} transactions".format(general_counter + 1))
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# tests import the packages of the repository (e.g. common) like the scripts at its root do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from benchmarks.synthetic import SyntheticData
+
+
+@pytest.fixture(scope='session')
+def synthetic_data(tmp_path_factory):
+    '''
+    :return: manifest of synthetic data at scale 1 (see benchmarks.synthetic.SyntheticData.generate)
+    '''
+    return SyntheticData(str(tmp_path_factory.mktemp('synthetic'))).generate()
@@ -0,0 +1,67 @@
+import re
+
+import pytest
+
+from common import cufs
+from common.cufs import ReferenceResolver, SINGLE_ZD_SEPARATOR_PATTERN
+from common.zendesk import MANUAL_OA2ZD_DICT
+
+DESCRIPTIONS = ['APC for ZD-12345', 'APC zd 12345 and OA-001234', 'ZD  12345', 'ZD --12345, OA 1234',
+                'oa1234 then ZD12345678', 'No reference', 'INV ZD-1234-5, inv:ZD-99999', 'ZD-123']
+
+
+def test_single_zd_separator_matches_invoice_fetcher():
+    # patterns used by invoice-fetcher before it shared ReferenceResolver
+    t_oa = re.compile(r"OA[ \-]?[0-9]{4,8}")
+    t_zd = re.compile(r"ZD[ \-]?[0-9]{4,8}")
+    resolver = ReferenceResolver(zd_separator=SINGLE_ZD_SEPARATOR_PATTERN)
+    for description in DESCRIPTIONS:
+        m_zd = t_zd.search(description.upper())
+        m_oa = t_oa.search(description.upper())
+        expected = (m_zd.group() if m_zd else None, m_oa.group() if m_oa else None)
+        assert resolver.find_references(description)[:2] == expected, description
+    # by default, up to three separators are accepted
+    assert ReferenceResolver().find_references('ZD  12345')[0] == 'ZD  12345'
+
+
+OA2ZD_DICT = {'OA-10468': ['10468'], 'OA-002000': ['300', '25'], 'OA-1267': ['1']}
+INVOICE2ZD_DICT = {'inv-abc1': ['500', '400'], 'apc-0002': ['600']}
+# description, invoice number, rule and zd number found by the cascade of plug_in_payment_data before
+# ReferenceResolver
+CASCADE = [
+    ('Aggregated payment', 'INV-ABC1', cufs.AGGREGATED_PAYMENT_RULE, None),
+    ('OA 10768', '', cufs.OA_NUMBER_RULE, '10468'),
+    ('APC for ZD-12345 and OA-002000', 'INV-ABC1', cufs.ZD_NUMBER_RULE, '12345'),
+    ('apc for zd 12345', '', cufs.ZD_NUMBER_RULE, '12345'),
+    ('ZD --12345', '', cufs.ZD_NUMBER_RULE, '12345'),
+    ('Bank chg, inv:APC2018ZD54321_SUPPLIER', 'INV-ABC1', cufs.ZD_NUMBER_RULE, '54321'),
+    ('OA-1267', '', cufs.OA_NUMBER_RULE, '3965'),
+    ('oa1267', '', cufs.OA_NUMBER_RULE, '3965'),
+    ('OA 002000', '', cufs.OA_NUMBER_RULE, '25'),
+    ('oa-002000', '', cufs.OA_NUMBER_RULE, '25'),
+    # an OA number that cannot be resolved stops the cascade
+    ('OA-9999', 'INV-ABC1', None, None),
+    ('Payment', 'P09819649', cufs.MANUAL_INVOICE_RULE, '28975'),
+    ('Payment, inv:APC-0002', 'P09819649', cufs.MANUAL_INVOICE_RULE, '28975'),
+    ("OPEN ACCESS FOR R DERVAN'S ARTICLE 'ON K-STABILITY OF FINITE COVERS' IN THE LMS BULLETIN", 'INV-ABC1',
+     cufs.MANUAL_DESCRIPTION_RULE, '16490'),
+    ('Bank chg USD IPO:VE 20632, inv:APC6000011159_COPYRIGHT CLEARANCE _U.VE.VEAG.MAEB.EZZC.', '',
+     cufs.MANUAL_DESCRIPTION_RULE, '217113'),
+    ('Payment', ' inv-ABC1 ', cufs.INVOICE_RULE, '500'),
+    ('Payment, inv:APC-0002', 'APC-0002', cufs.INVOICE_RULE, '600'),
+    ('Bank chg, inv:Polymers-123512', '', cufs.INVOICE_IN_DESCRIPTION_RULE, '15589'),
+    ('Bank chg, inv:APC-0002_SUPPLIER', 'unknown', cufs.INVOICE_IN_DESCRIPTION_RULE, '600'),
+    ('Bank chg, inv:UNKNOWN-1', '', None, None),
+    ('Bank chg inv:APC-0002', '', None, None),
+    ('No reference', '', None, None),
+]
+
+
+@pytest.mark.parametrize('description, invoice_number, rule, zd_number', CASCADE)
+def test_resolver_follows_payment_cascade(monkeypatch, description, invoice_number, rule, zd_number):
+    monkeypatch.setitem(cufs.AGGREGATED_PAYMENTS, 'Aggregated payment',
+                        [cufs.Aggregated_breakdown(zd_number='700', rcuk_apc=1)])
+    resolver = ReferenceResolver(OA2ZD_DICT, INVOICE2ZD_DICT, MANUAL_OA2ZD_DICT)
+    resolution = resolver.resolve(description, invoice_number)
+    assert (resolution.rule, resolution.zd_number) == (rule, zd_number)
+    assert resolver.resolve(description, invoice_number) is resolution
@@ -0,0 +1,48 @@
+import datetime
+
+import dateutil.parser
+import pytest
+
+from common.dateparsing import DateNormaliser
+
+DATES = [
+    # year first
+    '2016-04-21', '2016/04/21', '2016-4-1', '2016-04-21T10:11:12Z', '2016-04-21 10:11', '2016-04-21T10:11:12.123456',
+    '2016-01-05', '2016-05-01', '2016-12-12', '2016-13-01', '2016-01-13', '2016-02-30', '2016-00-10', ' 2016-04-21 ',
+    '2016-04-21T25:00:00', '2016-04-21 24:00',
+    # year last
+    '21/04/2016', '04/21/2016', '01/05/2016', '05/01/2016', '21.04.2016', '21-04-2016', '1/5/2016', '31/02/2016',
+    '29/02/2016', '29/02/2015', '13/13/2016', '32/01/2016', '00/01/2016', '12/31/2016',
+    # month name
+    '21-APR-2016', '21 April 2016', '21-Sept-2016', '21-sep-2016', '1 jan 2016', '31-FEB-2016', '21-Foo-2016',
+    '21 Apr-2016',
+    # left to dateutil
+    'April 21, 2016', '2016', '21 Apr 16', '20160421', 'not a date', '', '2016-04-21 25:00',
+]
+
+
+def dateutil_date(string, dayfirst):
+    '''
+    Converts string as common.oatsutils.convert_date_str_to_yyyy_mm_dd did before DateNormaliser
+    '''
+    try:
+        d = dateutil.parser.parse(string, dateutil.parser.parserinfo(dayfirst=dayfirst))
+    except ValueError:
+        d = datetime.datetime(1, 1, 1)
+    d = d.strftime('%Y-%m-%d')
+    return '' if d == '1-01-01' else d
+
+
+@pytest.mark.parametrize('dayfirst', [True, False])
+@pytest.mark.parametrize('string', DATES)
+def test_normaliser_matches_dateutil(string, dayfirst):
+    assert DateNormaliser(dayfirst=dayfirst)(string) == dateutil_date(string, dayfirst)
+
+
+@pytest.mark.parametrize('dayfirst', [True, False])
+def test_shared_normaliser_matches_dateutil(dayfirst):
+    # the inferred format changes between values, and repeated values come from the memo
+    normaliser = DateNormaliser(dayfirst=dayfirst)
+    for string in DATES + DATES[::-1]:
+        assert normaliser(string) == dateutil_date(string, dayfirst), string
+    assert normaliser.dateutil_calls < len(DATES)
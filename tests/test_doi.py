@@ -0,0 +1,44 @@
+import pytest
+
+from common.doi import clean_doi, normalise_doi
+
+DOI = '10.1002/Anie.201607289'
+
+
+@pytest.mark.parametrize('written', [
+    DOI,
+    ' 10.1002/Anie.201607289 ',
+    'https://doi.org/10.1002/Anie.201607289',
+    'http://dx.doi.org/10.1002/Anie.201607289',
+    'HTTPS://DX.DOI.ORG/10.1002/Anie.201607289',
+    'doi.org/10.1002/Anie.201607289',
+    'https://onlinelibrary.wiley.com/doi/full/10.1002/Anie.201607289',
+    'doi:10.1002/Anie.201607289',
+    'DOI: 10.1002/Anie.201607289',
+    'info:doi/10.1002/Anie.201607289',
+])
+def test_clean_doi_removes_prefixes_and_keeps_case(written):
+    assert clean_doi(written) == DOI
+    assert normalise_doi(written) == '10.1002/anie.201607289'
+
+
+@pytest.mark.parametrize('written', ['10.1002/ANIE.201607289', '10.1002/anie.201607289',
+                                     'https://doi.org/10.1002/aNiE.201607289'])
+def test_normalise_doi_ignores_case(written):
+    assert normalise_doi(written) == normalise_doi(DOI)
+
+
+@pytest.mark.parametrize('written', ['0.1136/jmedgenet-2016-104295', 'https://doi.org/0.1136/jmedgenet-2016-104295',
+                                     '0.1136/JMEDGENET-2016-104295'])
+def test_doi_typos_are_fixed(written):
+    assert normalise_doi(written) == '10.1136/jmedgenet-2016-104295'
+
+
+def test_doi_typo_is_fixed_when_cleaned_up():
+    assert clean_doi(' 0.1136/jmedgenet-2016-104295') == '10.1136/jmedgenet-2016-104295'
+
+
+@pytest.mark.parametrize('written', [DOI, '10.1136/jmedgenet-2016-104295', '10.1371/journal.pone.0123456', '',
+                                     'not a DOI'])
+def test_doi_without_prefix_is_unchanged(written):
+    assert clean_doi(written) == written
@@ -0,0 +1,35 @@
+import csv
+
+from common.europepmc import get_europepmc_index
+from common.zendesk import Parser
+
+FIELDS = ['PMID', 'PMCID', 'DOI']
+# rows of a map; all DOIs belong to the same ticket, and the first one differs from the last only in case
+MAP_ROWS = [['1', 'PMC1', '10.1234/A'], ['2', 'PMC2', '10.1234/b'], ['3', '', ''], ['4', 'PMC4', '10.1234/a']]
+
+
+def merged_metadata(data, tmp_path, use_index):
+    parser = Parser(data['zenexport'])
+    parser.index_zd_data(use_snapshot=False)
+    zd_number = next(iter(parser.zd_dict))
+    # the last row of the map matching the ticket is not one of those found for its last DOI
+    translation_dict = {'10.1234/a': [zd_number], '10.1234/b': [zd_number]}
+    pmc_map = str(tmp_path / 'PMID_PMCID_DOI.csv')
+    with open(pmc_map, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        writer.writerows(MAP_ROWS)
+    if use_index:
+        with get_europepmc_index(pmc_map, index_folder=str(tmp_path / 'index')) as index:
+            assert index.lookup_with_positions('10.1234/A')[1][0] == 3
+            row_counter = parser.plug_in_europepmc_index(index, translation_dict, fields=FIELDS)
+    else:
+        row_counter = parser.plug_in_metadata(pmc_map, 'DOI', translation_dict, fields=FIELDS)
+    return row_counter, {f: parser.zd_dict[zd_number].metadata.get(f) for f in FIELDS}
+
+
+def test_index_merges_rows_in_map_order(synthetic_data, tmp_path):
+    row_counter, metadata = merged_metadata(synthetic_data, tmp_path, use_index=True)
+    assert row_counter == 3
+    assert metadata == {'PMID': '4', 'PMCID': 'PMC4', 'DOI': '10.1234/a'}
+    assert merged_metadata(synthetic_data, tmp_path, use_index=False)[1] == metadata
@@ -0,0 +1,37 @@
+import os
+import re
+import shutil
+
+import pytest
+
+from pdfapps import helpers
+from pdfapps.helpers import CopyScheduler
+
+
+def test_permission_error_is_raised_when_closing(tmp_path, monkeypatch):
+    def copy2(src, dst):
+        raise PermissionError(13, 'Permission denied', dst)
+    monkeypatch.setattr(helpers.shutil, 'copy2', copy2)
+    src = tmp_path / 'invoice.pdf'
+    src.write_bytes(b'%PDF')
+    dst = str(tmp_path / 'copy.pdf')
+    copy_scheduler = CopyScheduler(max_workers=2)
+    future = copy_scheduler.copy(str(src), dst)
+    with pytest.raises(PermissionError, match=re.escape(helpers.perm_err.format(dst))):
+        copy_scheduler.close()
+    assert isinstance(future.exception(), PermissionError)
+
+
+def test_copies_of_identical_files_are_skipped(tmp_path):
+    src_folder = tmp_path / 'src'
+    dst_folder = tmp_path / 'dst'
+    src_folder.mkdir()
+    dst_folder.mkdir()
+    for i in range(8):
+        (src_folder / '{}.pdf'.format(i)).write_bytes(b'same content')
+        shutil.copy2(str(src_folder / '{}.pdf'.format(i)), str(dst_folder))
+    with CopyScheduler(max_workers=4) as copy_scheduler:
+        futures = [copy_scheduler.copy(str(src_folder / name), str(dst_folder)) for name in os.listdir(src_folder)]
+    assert [f.result() for f in futures] == [False] * 8
+    assert copy_scheduler.skipped_counter == 8
+    assert len(copy_scheduler.digests) == 16
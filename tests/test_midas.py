@@ -0,0 +1,38 @@
+import csv
+
+import midas
+import common.midas_constants as mc
+from common.oatsutils import close_debug_csvs
+from common.zendesk import output_pruned_zendesk_export
+
+
+def report_tickets(zenexport, paymentfiles):
+    '''
+    :return: numbers of the tickets included in a Midas report built from zenexport and paymentfiles
+    '''
+    report = midas.Report(zenexport)
+    report.zd_parser.index_zd_data(use_snapshot=False)
+    report.parse_cufs_data(paymentfiles, processes=1)
+    report.populate_invoiced_articles()
+    close_debug_csvs()
+    return [t.number for t in report.articles]
+
+
+def test_pruned_export_drops_excluded_groups_from_report(synthetic_data, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(midas, 'working_folder', str(tmp_path), raising=False)
+    zenexport = synthetic_data['zenexport']
+    pruned_zenexport = str(tmp_path / 'pruned.csv')
+    output_pruned_zendesk_export(zenexport, pruned_zenexport, **{'Group': mc.ZENDESK_EXCLUDED_GROUPS})
+    with open(zenexport, encoding='utf-8') as f:
+        groups = {row['Id']: row['Group'] for row in csv.DictReader(f)}
+    with open(pruned_zenexport, encoding='utf-8') as f:
+        pruned = [row['Id'] for row in csv.DictReader(f)]
+    assert pruned == [k for k, v in groups.items() if v not in mc.ZENDESK_EXCLUDED_GROUPS]
+
+    # previously no ticket was pruned, so tickets in excluded groups made it into the report
+    full_report = report_tickets(zenexport, synthetic_data['paymentfiles'])
+    excluded = [k for k in full_report if groups[k] in mc.ZENDESK_EXCLUDED_GROUPS]
+    assert excluded
+    pruned_report = report_tickets(pruned_zenexport, synthetic_data['paymentfiles'])
+    assert pruned_report == [k for k in full_report if k not in excluded]
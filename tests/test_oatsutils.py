@@ -0,0 +1,26 @@
+import csv
+
+import pytest
+
+from common.oatsutils import DebugCsvSink
+
+
+def test_debug_csv_rows_are_copied_when_written(tmp_path):
+    outcsv = str(tmp_path / 'debug.csv')
+    sink = DebugCsvSink(outcsv, ['a', 'b'])
+    row = {'a': '1', 'b': '2'}
+    sink.writerow(row)
+    row['a'] = 'changed'
+    values = ['3', '4']
+    sink.writerow(values)
+    values[0] = 'changed'
+    sink.close()
+    with open(outcsv) as f:
+        assert list(csv.reader(f)) == [['a', 'b'], ['1', '2'], ['3', '4']]
+
+
+def test_debug_csv_rejects_unknown_fields_when_written(tmp_path):
+    sink = DebugCsvSink(str(tmp_path / 'debug.csv'), ['a'])
+    with pytest.raises(ValueError):
+        sink.writerow({'a': '1', 'unknown': '2'})
+    sink.close()
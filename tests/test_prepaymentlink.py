@@ -0,0 +1,64 @@
+from common.linkcache import LinkCache, ticket_digests
+from common.prepaymentlink import POLICY_FLAGS, STAGE_APOLLO, STAGE_DOI, STAGE_SIMILAR_TITLE, STAGE_TITLE, \
+    PrepaymentLinker
+
+TITLE = 'Quantum spin dynamics of magnetic nanoparticles in disordered lattices'
+
+
+def ticket(title, policy=True):
+    row = {f: 'yes' if policy else 'no' for f in POLICY_FLAGS}
+    row['#Manuscript title [txt]'] = title
+    return row
+
+
+def link(tmp_path, zd_dict, doi2zd_dict=None, doi2apollo=None, apollo2zd_dict=None, records=None):
+    '''
+    Links records (by default, a single record with TITLE) using a link cache saved in tmp_path
+    :return: the Link of the first record
+    '''
+    title2zd_dict = {row['#Manuscript title [txt]'].upper(): zd_number for zd_number, row in zd_dict.items()}
+    records = records or {0: ('10.1234/abc', TITLE)}
+    with LinkCache(ticket_digests(zd_dict), str(tmp_path / 'links.sqlite3')) as cache:
+        linker = PrepaymentLinker(zd_dict, doi2zd_dict or {}, title2zd_dict, doi2apollo, apollo2zd_dict,
+                                  processes=1, link_cache=cache, source='Wiley')
+        return linker.link(records)[0]
+
+
+def test_cached_doi_link(tmp_path):
+    zd_dict = {'1': ticket('Another title')}
+    first = link(tmp_path, zd_dict, {'10.1234/abc': ['1']})
+    assert (first.zd_number, first.stage, first.cached) == ('1', STAGE_DOI, False)
+    # DOIs are looked up by their normalised form
+    second = link(tmp_path, zd_dict, {'10.1234/abc': ['1']}, records={0: ('https://doi.org/10.1234/ABC', TITLE)})
+    assert (second.zd_number, second.stage, second.cached) == ('1', STAGE_DOI, True)
+
+
+def test_doi_link_invalidated_by_other_ticket(tmp_path):
+    zd_dict = {'1': ticket('Another title', policy=False), '2': ticket('A third title')}
+    assert link(tmp_path, zd_dict, {'10.1234/abc': ['2']}).zd_number == '2'
+    # a ticket included in a policy gained the DOI before the linked one; the linked ticket did not change
+    zd_dict['1'] = ticket('Another title')
+    relinked = link(tmp_path, zd_dict, {'10.1234/abc': ['1', '2']})
+    assert (relinked.zd_number, relinked.stage, relinked.cached) == ('1', STAGE_DOI, False)
+
+
+def test_apollo_link_invalidated_by_handle(tmp_path):
+    zd_dict = {'1': ticket('Another title'), '2': ticket('A third title')}
+    apollo2zd_dict = {'1810/1': ['1'], '1810/2': ['2']}
+    assert link(tmp_path, zd_dict, doi2apollo={'10.1234/abc': '1810/1'},
+                apollo2zd_dict=apollo2zd_dict).zd_number == '1'
+    cached = link(tmp_path, zd_dict, doi2apollo={'10.1234/abc': '1810/1'}, apollo2zd_dict=apollo2zd_dict)
+    assert (cached.zd_number, cached.stage, cached.cached) == ('1', STAGE_APOLLO, True)
+    relinked = link(tmp_path, zd_dict, doi2apollo={'10.1234/abc': '1810/2'}, apollo2zd_dict=apollo2zd_dict)
+    assert (relinked.zd_number, relinked.cached) == ('2', False)
+
+
+def test_similar_title_link_invalidated_by_new_ticket(tmp_path):
+    zd_dict = {'1': ticket(TITLE.replace('dynamics', 'dynamic'))}
+    suggestion = link(tmp_path, zd_dict)
+    assert (suggestion.zd_number, suggestion.stage) == ('1', STAGE_SIMILAR_TITLE)
+    assert link(tmp_path, zd_dict).cached
+    # the ticket of the record is added; the suggested ticket did not change
+    zd_dict['2'] = ticket(TITLE)
+    relinked = link(tmp_path, zd_dict)
+    assert (relinked.zd_number, relinked.stage, relinked.cached) == ('2', STAGE_TITLE, False)
@@ -0,0 +1,82 @@
+import random
+from difflib import SequenceMatcher
+
+from common.titlematch import SIMILARITY_THRESHOLD, TitleIndex, TitleMatcher, canonical_index, canonical_title, \
+    get_by_canonical_title
+
+WORDS = ['QUANTUM', 'SPIN', 'DYNAMICS', 'OF', 'MAGNETIC', 'NANOPARTICLES', 'IN', 'DISORDERED', 'LATTICES', 'THE',
+         'CELL', 'BRAIN', 'GRAPHENE', 'SURFACE', 'FLOW', 'RISK', 'A', 'STUDY', 'ON', 'MODEL']
+
+
+def full_scan(title, titles, threshold=SIMILARITY_THRESHOLD):
+    '''
+    Matching by title as ART heuristic_match_by_title did before titles were indexed
+    '''
+    possible_matches = []
+    for t in titles:
+        similarity = SequenceMatcher(None, title, t).ratio()
+        if similarity > threshold:
+            possible_matches.append((similarity, t))
+    possible_matches.sort(reverse=True)
+    return possible_matches[0] if possible_matches else None
+
+
+def shuffled_titles(words, count, seed):
+    rng = random.Random(seed)
+    titles = set()
+    while len(titles) < count:
+        w = list(words)
+        rng.shuffle(w)
+        titles.add(' '.join(w))
+    return list(titles)
+
+
+def test_match_outside_shortlist():
+    title = 'QUANTUM SPIN DYNAMICS OF MAGNETIC NANOPARTICLES IN DISORDERED LATTICES'
+    query = 'QUANTUM SPIN DYNAMIC5 OF MAGNETIC NANOPARTICLE5 IN DIS0RDERED LATTICE5'
+    # decoys share more n-grams with the query than title does, so title is not shortlisted, but they are much less
+    # similar; unrelated titles keep the n-grams of the decoys below max_df
+    unrelated = ['TITLE {} ABOUT SOMETHING ELSE ENTIRELY'.format(i) for i in range(400)]
+    titles = shuffled_titles(query.split(), 80, seed=0) + [title] + unrelated
+    index = TitleIndex(titles)
+    assert title not in index.candidates(query)
+    expected = full_scan(query, titles)
+    assert expected == (SequenceMatcher(None, query, title).ratio(), title)
+    assert index.best_match(query, exact=True) == expected
+    assert index.matches(query, exact=True)[0] == expected
+    # without exact, the wider shortlist finds it, as none of the first k candidates is similar enough
+    assert index.best_match(query) == expected
+
+
+def test_best_match_equals_full_scan():
+    rng = random.Random(1)
+    titles = list({' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 9))) for _ in range(150)})
+    index = TitleIndex(titles)
+    queries = []
+    for _ in range(80):
+        t = list(rng.choice(titles))
+        for _ in range(rng.randint(0, 6)):
+            t[rng.randrange(len(t))] = rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 ')
+        queries.append(''.join(t))
+    queries += ['', 'A', 'SPIN']
+    for query in queries:
+        assert index.best_match(query, exact=True) == full_scan(query, titles), query
+        assert index.best_match(query, threshold=0.6, exact=True) == full_scan(query, titles, threshold=0.6), query
+
+
+def test_empty_titles():
+    index = TitleIndex(['', 'SPIN'])
+    assert index.best_match('', exact=True) == full_scan('', ['', 'SPIN']) == (1.0, '')
+
+
+def test_canonical_title_keeps_comparisons():
+    assert canonical_title('Effect size p<0.05 and q>1 in trials') == 'effect size p 0 05 and q 1 in trials'
+    assert canonical_title('The “Hot” &amp; <i>cold</i> stars.') == canonical_title('THE HOT & COLD STARS')
+    assert canonical_title('H<sub>2</sub>O at \\textit{high} pressure') == 'h 2 o at high pressure'
+
+
+def test_empty_canonical_titles_do_not_match():
+    title_dict = {'???': ['1'], 'A TITLE': ['2']}
+    assert list(canonical_index(title_dict)) == ['a title']
+    assert get_by_canonical_title(title_dict, canonical_index(title_dict), '...') is None
+    assert [m.zd_number for m in TitleMatcher(title_dict, processes=1).match(['!!!'])] == ['']
@@ -0,0 +1,32 @@
+from common.oatsutils import close_debug_csvs
+from common.zendesk import Parser, parse_pence
+
+TOTALS = ['coaf_apc_total', 'rcuk_apc_total', 'apc_grand_total', 'rcuk_other_total', 'other_grand_total']
+
+
+def payment_totals(data, use_payment_ledger):
+    '''
+    :return: dictionary of the totals of each ticket with payments in the CUFS reports of data
+    '''
+    parser = Parser(data['zenexport'])
+    parser.index_zd_data(use_snapshot=False)
+    parser.use_payment_ledger = use_payment_ledger
+    for paymentsfile, cufs_export_type, funder in data['paymentfiles']:
+        parser.plug_in_payment_data(paymentsfile, cufs_export_type, funder)
+    close_debug_csvs()
+    return {k: [getattr(t, a) for a in TOTALS] for k, t in parser.zd_dict_with_payments.items()}
+
+
+def test_parse_pence():
+    assert list(parse_pence(['1,234.56', '0.1', '-7', ' 12.30 '])) == [123456, 10, -700, 1230]
+
+
+def test_ledger_totals_equal_row_totals(synthetic_data, tmp_path, monkeypatch):
+    # debug CSVs are written to the current folder
+    monkeypatch.chdir(tmp_path)
+    row_totals = payment_totals(synthetic_data, use_payment_ledger=False)
+    ledger_totals = payment_totals(synthetic_data, use_payment_ledger=True)
+    assert row_totals
+    assert list(ledger_totals) == list(row_totals)
+    for k, totals in row_totals.items():
+        assert ledger_totals[k] == [round(v, 2) for v in totals], k
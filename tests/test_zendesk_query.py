@@ -0,0 +1,28 @@
+import csv
+
+import pytest
+
+from common.zendesk import TicketQueryIndex, write_filtered_zendesk_export
+
+QUERY = {'Publisher [txt]': [' royal society of chemistry', 'PLOS'], 'Status': 'solved '}
+
+
+def read_tickets(path):
+    '''
+    :return: dictionary of the rows of the export at path, indexed by ticket id
+    '''
+    with open(path, encoding='utf-8') as f:
+        return {row['Id']: row for row in csv.DictReader(f)}
+
+
+@pytest.mark.parametrize('match_type', ['or', 'and'])
+@pytest.mark.parametrize('ignore_case', [True, False])
+def test_filter_matches_index(synthetic_data, tmp_path, match_type, ignore_case):
+    zenexport = synthetic_data['zenexport']
+    output_filename = str(tmp_path / 'filtered.csv')
+    write_filtered_zendesk_export(zenexport, output_filename, QUERY, match_type, ignore_case)
+    index = TicketQueryIndex(read_tickets(zenexport), case_sensitive=not ignore_case)
+    expected = index.query(match_all=(match_type == 'and'), **QUERY)
+    assert list(read_tickets(output_filename)) == list(expected)
+    if ignore_case:
+        assert expected
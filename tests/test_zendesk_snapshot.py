@@ -0,0 +1,79 @@
+import csv
+import shutil
+
+import pytest
+
+from common import zendesk
+from common.zendesk import Parser, ParserSnapshot, Ticket
+
+
+@pytest.fixture
+def snapshot_folder(tmp_path, monkeypatch):
+    folder = str(tmp_path / 'snapshots')
+    monkeypatch.setattr(ParserSnapshot.__init__, '__defaults__', (folder,))
+    return folder
+
+
+def ticket_numbers(parser):
+    '''
+    :return: the items of the dictionaries of parser (see Parser.indexes), in order, with Ticket objects replaced by
+            their numbers
+    '''
+    def number(v):
+        return v.number if isinstance(v, Ticket) else v
+
+    return [[(k, [number(t) for t in v] if isinstance(v, list) else number(v)) for k, v in d.items()]
+            for d in parser.indexes()]
+
+
+def edit_export(path, count=5):
+    '''
+    Changes the titles of the first count tickets of the export at path, keeping its path. The first ticket also
+    takes the DOI of the last ticket with an APC invoice, a new APC invoice number and, as its page/colour invoice
+    number, the APC invoice number of that ticket
+    '''
+    with open(path, encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    for row in rows[:count]:
+        row['#Manuscript title [txt]'] = 'Edited ' + row['#Manuscript title [txt]']
+    last = [row for row in rows if row['APC invoice number [txt]'] not in ['', '-']][-1]
+    rows[0]['#DOI (like 10.123/abc456) [txt]'] = last['#DOI (like 10.123/abc456) [txt]']
+    rows[0]['APC invoice number [txt]'] = 'APC-0001'
+    rows[0]['Page/colour invoice number [txt]'] = last['APC invoice number [txt]']
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def test_export_downloaded_again_is_updated_from_its_snapshot(synthetic_data, tmp_path, snapshot_folder,
+                                                               monkeypatch):
+    zenexport = str(tmp_path / 'export.csv')
+    shutil.copy(synthetic_data['zenexport'], zenexport)
+    Parser(zenexport).index_zd_data()
+    edit_export(zenexport)
+
+    updates = []
+    update_index = Parser._update_index
+    monkeypatch.setattr(Parser, '_update_index', lambda self, *args: updates.append(args) or update_index(self, *args))
+    fingerprints = []
+    compute_fingerprint = ParserSnapshot._compute_fingerprint
+    monkeypatch.setattr(ParserSnapshot, '_compute_fingerprint',
+                        lambda self: fingerprints.append(self) or compute_fingerprint(self))
+    updated = Parser(zenexport)
+    updated.index_zd_data()
+    assert len(updates) == 1
+    assert len(fingerprints) == 1
+
+    full = Parser(zenexport)
+    full.index_zd_data(use_snapshot=False)
+    assert ticket_numbers(updated) == ticket_numbers(full)
+    assert ({n: dict(t.metadata) for n, t in updated.zd_dict.items()} ==
+            {n: dict(t.metadata) for n, t in full.zd_dict.items()})
+
+    # the snapshot saved after the update is used as it is
+    reloaded = Parser(zenexport)
+    reloaded.index_zd_data()
+    assert ticket_numbers(reloaded) == ticket_numbers(full)